@@ -1,6 +1,8 @@
 from django.contrib.sitemaps import Sitemap
+from django.http import HttpResponse
+from expdj.apps.experiments.cache import SITEMAP_CACHE, get_or_set_versioned
 from expdj.apps.experiments.models import ExperimentTemplate
-from expdj.apps.experiments.utils import get_experiment_type
+from expdj.apps.experiments.utils import EXPERIMENT_TYPE_TEMPLATES
 
 class BaseSitemap(Sitemap):
     priority = 0.5
@@ -15,14 +17,33 @@ class BaseSitemap(Sitemap):
 class ExperimentTemplateSitemap(BaseSitemap):
     changefreq = "weekly"
     def items(self):
-        return [x for x in ExperimentTemplate.objects.all() if get_experiment_type(x) == "experiments"]
+        return ExperimentTemplate.objects.filter(template__in=EXPERIMENT_TYPE_TEMPLATES["experiments"]).order_by('exp_id')
 
 class SurveyTemplateSitemap(BaseSitemap):
     changefreq = "weekly"
     def items(self):
-        return [x for x in ExperimentTemplate.objects.all() if get_experiment_type(x) == "surveys"]
+        return ExperimentTemplate.objects.filter(template__in=EXPERIMENT_TYPE_TEMPLATES["surveys"]).order_by('exp_id')
 
 class GameTemplateSitemap(BaseSitemap):
     changefreq = "weekly"
     def items(self):
-        return [x for x in ExperimentTemplate.objects.all() if get_experiment_type(x) == "games"]
+        return ExperimentTemplate.objects.filter(template__in=EXPERIMENT_TYPE_TEMPLATES["games"]).order_by('exp_id')
+
+
+def cached_sitemap_view(view):
+    '''cached_sitemap_view wraps a django sitemap view (index or sitemap) to serve
+    the generated XML from the cache. It is generated again only after an
+    experiment template is installed or deleted (see experiments/models.py)
+    '''
+    def cached_view(request,sitemaps,section=None,**kwargs):
+        name = "%s:%s:%s" %(request.get_host(),section or "index",request.GET.get("p",1))
+        def generate():
+            if section == None:
+                response = view(request,sitemaps,**kwargs)
+            else:
+                response = view(request,sitemaps,section=section,**kwargs)
+            response.render()
+            return response.content
+        content = get_or_set_versioned(SITEMAP_CACHE,"templates",name,generate)
+        return HttpResponse(content,content_type="application/xml")
+    return cached_view
@@ -0,0 +1,158 @@
+'''assets.py: fingerprinted, precompressed and shared experiment assets
+
+When an experiment version is installed (see versions.py), each of its files
+is stored once, by content, in MEDIA_ROOT/.assets (shared by all experiments
+and versions), and the file in the version folder becomes a hard link to the
+stored copy. Experiments carrying the same jsPsych core and plugins then use
+the disk once, and load them from the same url, so a browser downloads them
+once per battery. Css that loads files by relative url is instead given a
+fingerprinted copy (name.<md5>.ext) next to it. Compressible files get .gz
+(and, with the brotli package, .br) siblings for nginx to serve as is. An
+assets.json manifest maps the paths in the version folder to the shared urls
+or fingerprinted paths, used by versions.get_experiment_load to point the
+expfactory load tags at them, so a browser can cache them forever.
+'''
+
+from expdj.settings import BASE_DIR,MEDIA_ROOT,MEDIA_URL
+import hashlib
+import gzip
+import json
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
+
+SHARED_FOLDER = ".assets"
+MANIFEST_FILE = "assets.json"
+FINGERPRINT_EXTENSIONS = [".js",".css"]
+COMPRESS_EXTENSIONS = [".js",".css",".html",".json",".svg",".txt"]
+
+# Parsed manifests, by version folder (a version's files never change)
+manifests = dict()
+
+
+def get_shared_folder():
+    return os.path.join(media_dir,SHARED_FOLDER)
+
+
+def get_shared_url(filename):
+    return "%s%s/%s" %(MEDIA_URL,SHARED_FOLDER,filename)
+
+
+def get_fingerprint(content):
+    return hashlib.md5(content).hexdigest()[:12]
+
+
+def write_file(path,content):
+    '''write_file writes a file with a rename, so it is never read half written'''
+    tmp_path = "%s.tmp%s" %(path,os.getpid())
+    with open(tmp_path,"wb") as filey:
+        filey.write(content)
+    os.rename(tmp_path,path)
+
+
+def write_compressed(path,content):
+    '''write_compressed writes .gz (and .br) siblings of a file'''
+    tmp_path = "%s.gz.tmp%s" %(path,os.getpid())
+    gz = gzip.GzipFile(tmp_path,"wb",9,mtime=0)
+    try:
+        gz.write(content)
+    finally:
+        gz.close()
+    os.rename(tmp_path,"%s.gz" %(path))
+    if brotli != None:
+        write_file("%s.br" %(path),brotli.compress(content))
+
+
+def share_file(path,content):
+    '''share_file stores a file once in the shared folder, by content, and replaces
+    it with a hard link to the stored copy. Returns the name of the stored copy, or
+    None if the file can't be shared (eg, the shared folder is on another file system)
+    '''
+    name,ext = os.path.splitext(path)
+    filename = "%s%s" %(hashlib.md5(content).hexdigest(),ext)
+    shared_path = os.path.join(get_shared_folder(),filename)
+    try:
+        # The first copy of this content is stored as is
+        os.link(path,shared_path)
+        if ext in COMPRESS_EXTENSIONS:
+            write_compressed(shared_path,content)
+    except OSError:
+        try:
+            tmp_path = "%s.tmp%s" %(path,os.getpid())
+            os.link(shared_path,tmp_path)
+            os.rename(tmp_path,path)
+        except OSError:
+            pass
+    if os.path.exists(shared_path) and os.path.samefile(path,shared_path):
+        return filename
+
+
+def build_assets(folder):
+    '''build_assets shares the files of an experiment folder, and writes compressed
+    siblings, fingerprinted copies and the manifest, returning the manifest
+    :param folder: the (not yet published) folder of an experiment version
+    '''
+    if not os.path.exists(get_shared_folder()):
+        try:
+            os.makedirs(get_shared_folder())
+        except OSError:
+            pass # made by another install
+
+    manifest = dict()
+    for root,dirs,files in os.walk(folder):
+        for filename in files:
+            path = os.path.join(root,filename)
+            relative = os.path.relpath(path,folder)
+            name,ext = os.path.splitext(filename)
+            with open(path,"rb") as filey:
+                content = filey.read()
+            shared = share_file(path,content)
+            if ext in COMPRESS_EXTENSIONS:
+                write_compressed(path,content)
+            if ext not in FINGERPRINT_EXTENSIONS:
+                continue
+
+            # Css can load files relative to itself, so it can only move if it doesn't
+            if shared != None and (ext != ".css" or "url(" not in content):
+                manifest[relative] = get_shared_url(shared)
+            else:
+                fingerprinted = "%s.%s%s" %(name,get_fingerprint(content),ext)
+                write_file(os.path.join(root,fingerprinted),content)
+                write_compressed(os.path.join(root,fingerprinted),content)
+                manifest[relative] = os.path.join(os.path.dirname(relative),fingerprinted)
+    with open(os.path.join(folder,MANIFEST_FILE),"w") as filey:
+        json.dump(manifest,filey,indent=4,sort_keys=True)
+    return manifest
+
+
+def get_manifest(folder):
+    '''get_manifest returns the asset manifest of an experiment version folder'''
+    if folder not in manifests:
+        manifest_file = os.path.join(folder,MANIFEST_FILE)
+        if not os.path.exists(manifest_file):
+            return dict()
+        with open(manifest_file,"r") as filey:
+            manifests[folder] = json.load(filey)
+    return manifests[folder]
+
+
+def collect_shared_assets():
+    '''collect_shared_assets removes the shared files no longer linked from any
+    experiment version folder (and their compressed siblings)
+    '''
+    shared_folder = get_shared_folder()
+    if not os.path.exists(shared_folder):
+        return
+    for filename in os.listdir(shared_folder):
+        if filename.endswith(".gz") or filename.endswith(".br") or ".tmp" in filename:
+            continue
+        path = os.path.join(shared_folder,filename)
+        if os.stat(path).st_nlink == 1:
+            for stored in [path,"%s.gz" %(path),"%s.br" %(path)]:
+                if os.path.exists(stored):
+                    os.remove(stored)
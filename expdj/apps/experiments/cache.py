@@ -0,0 +1,75 @@
+'''cache.py: versioned cache keys for battery and experiment data
+
+Cached data about a battery (or experiment template, or HIT) is stored under
+a key that includes the object's current version. Signals on the models
+(see the bottom of experiments/models.py and turk/models.py) bump the
+version whenever the object or anything it is built from changes, so every
+uwsgi process and celery worker sharing the redis cache stops reading the
+stale entry at once, and it expires on its own.
+'''
+
+import time
+
+from django.core.cache import cache
+
+
+# Namespaces of versioned objects
+BATTERY_CACHE = "battery"
+EXPERIMENT_TEMPLATE_CACHE = "experiment_template"
+HIT_CACHE = "hit"
+USER_PERMISSIONS_CACHE = "user_permissions"
+SITEMAP_CACHE = "sitemap"
+
+# Seconds to keep a versioned entry, stale versions simply expire
+VERSIONED_CACHE_SECONDS = 24 * 60 * 60
+
+
+def get_version_key(namespace,object_id):
+    return "expdj:version:%s:%s" %(namespace,object_id)
+
+
+def new_version():
+    # A version number never used before, if a version key is evicted
+    return int(time.time() * 1000)
+
+
+def get_cache_version(namespace,object_id):
+    '''get_cache_version returns the current version of an object's cached data
+    :param namespace: the kind of object, eg BATTERY_CACHE
+    :param object_id: the id (primary key) of the object
+    '''
+    key = get_version_key(namespace,object_id)
+    version = cache.get(key)
+    if version == None:
+        cache.add(key,new_version(),None)
+        version = cache.get(key) or new_version()
+    return version
+
+
+def bump_cache_version(namespace,object_id):
+    '''bump_cache_version invalidates all cached data of an object'''
+    key = get_version_key(namespace,object_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key,new_version(),None):
+            cache.incr(key)
+
+
+def get_versioned_key(namespace,object_id,name):
+    '''get_versioned_key returns the cache key for data of an object, at its current version
+    :param name: the name of the cached data, eg "snapshot"
+    '''
+    return "expdj:%s:%s:%s:v%s" %(namespace,object_id,name,get_cache_version(namespace,object_id))
+
+
+def get_or_set_versioned(namespace,object_id,name,build,timeout=VERSIONED_CACHE_SECONDS):
+    '''get_or_set_versioned returns cached data of an object, calling build() to
+    make (and cache) it when there is no entry for the current version
+    '''
+    key = get_versioned_key(namespace,object_id,name)
+    value = cache.get(key)
+    if value == None:
+        value = build()
+        cache.set(key,value,timeout)
+    return value
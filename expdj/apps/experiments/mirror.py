@@ -0,0 +1,129 @@
+'''mirror.py: persistent local mirrors of the expfactory repositories
+
+Each expfactory repository (experiments, surveys, games) is kept as a bare
+git mirror under EXPFACTORY_MIRROR_ROOT, brought up to date with an
+incremental fetch (at most every EXPFACTORY_MIRROR_FETCH_SECONDS, whether
+or not the last one worked, and killed after EXPFACTORY_MIRROR_FETCH_TIMEOUT
+seconds) under a file lock shared by the uwsgi and celery processes. The experiments in a
+repository (their parsed config.json) are cached by commit, so listing them
+doesn't need a clone, or even a checkout, until the repository changes.
+'''
+
+from contextlib import contextmanager
+from django.core.cache import cache
+from expdj.settings import (EXPFACTORY_MIRROR_ROOT, EXPFACTORY_MIRROR_FETCH_SECONDS,
+                            EXPFACTORY_MIRROR_FETCH_TIMEOUT, EXPFACTORY_REPOSITORY_URL)
+from expfactory.experiment import get_experiments
+from git import Repo
+import tarfile
+import tempfile
+import shutil
+import fcntl
+import time
+import os
+
+# Seconds to keep the experiments of a commit, which never change
+INDEX_CACHE_SECONDS = 7 * 24 * 60 * 60
+
+# Touched on each fetch, even a failed one (FETCH_HEAD is only written on success)
+LAST_FETCH_FILE = "last_fetch"
+
+
+def get_mirror_path(repo_type):
+    return os.path.join(EXPFACTORY_MIRROR_ROOT,"%s.git" %(repo_type))
+
+
+@contextmanager
+def mirror_lock(repo_type):
+    '''mirror_lock holds an exclusive lock on the mirror of a repository, across processes'''
+    if not os.path.exists(EXPFACTORY_MIRROR_ROOT):
+        os.makedirs(EXPFACTORY_MIRROR_ROOT)
+    with open(os.path.join(EXPFACTORY_MIRROR_ROOT,"%s.lock" %(repo_type)),"w") as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+
+
+def update_mirror(repo_type,force=False):
+    '''update_mirror clones the mirror of a repository the first time, and later
+    fetches what changed, if it wasn't fetched in the last EXPFACTORY_MIRROR_FETCH_SECONDS.
+    Returns the commit of master.
+    :param repo_type: one of experiments, surveys, games
+    :param force: fetch even if the mirror was just fetched
+    '''
+    mirror_path = get_mirror_path(repo_type)
+    with mirror_lock(repo_type):
+        last_fetch = os.path.join(mirror_path,LAST_FETCH_FILE)
+        if not os.path.exists(mirror_path):
+            repo = Repo.clone_from(EXPFACTORY_REPOSITORY_URL %(repo_type),mirror_path,mirror=True)
+            touch_last_fetch(last_fetch)
+        else:
+            repo = Repo(mirror_path)
+            if force or not os.path.exists(last_fetch) or \
+               time.time() - os.path.getmtime(last_fetch) > EXPFACTORY_MIRROR_FETCH_SECONDS:
+                try:
+                    repo.git.fetch("--prune","origin",kill_after_timeout=EXPFACTORY_MIRROR_FETCH_TIMEOUT)
+                except Exception:
+                    # Keep serving the mirror we have if the remote is down
+                    pass
+                # Also after a failure, so a down remote is retried every EXPFACTORY_MIRROR_FETCH_SECONDS
+                touch_last_fetch(last_fetch)
+        return repo.commit("master").hexsha
+
+
+def touch_last_fetch(last_fetch):
+    with open(last_fetch,"w") as filey:
+        filey.write(str(time.time()))
+
+
+def export_commit(repo_type,commit,output_folder):
+    '''export_commit writes the files of a repository at a commit (without .git) to a folder'''
+    repo = Repo(get_mirror_path(repo_type))
+    with tempfile.TemporaryFile() as archive:
+        repo.archive(archive,treeish=commit)
+        archive.seek(0)
+        tar = tarfile.open(fileobj=archive)
+        tar.extractall(output_folder)
+        tar.close()
+
+
+def get_tree_hashes(repo_type,commit):
+    '''get_tree_hashes returns the git tree hash of each folder (experiment) of a
+    repository at a commit, which changes only when a file in the folder does
+    '''
+    tree = Repo(get_mirror_path(repo_type)).commit(commit).tree
+    return dict([(folder.name,folder.hexsha) for folder in tree.trees])
+
+
+@contextmanager
+def checkout_repository(repo_type,commit=None):
+    '''checkout_repository yields a temporary folder with the files of a repository
+    at a commit (default the latest master), removed afterwards
+    '''
+    if commit == None:
+        commit = update_mirror(repo_type)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        export_commit(repo_type,commit,tmpdir)
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def get_experiment_index(repo_type="experiments",commit=None):
+    '''get_experiment_index returns the parsed config.json of each experiment in a
+    repository at a commit (default the latest master), cached by commit
+    :param repo_type: one of experiments, surveys, games
+    '''
+    if commit == None:
+        commit = update_mirror(repo_type)
+    key = "expdj:experiment_index:%s:%s" %(repo_type,commit)
+    experiments = cache.get(key)
+    if experiments == None:
+        with checkout_repository(repo_type,commit) as folder:
+            experiments = get_experiments(folder,load=True,warning=False,repo_type=repo_type)
+        experiments = [x[0] for x in experiments]
+        cache.set(key,experiments,INDEX_CACHE_SECONDS)
+    return experiments
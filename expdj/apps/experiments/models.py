@@ -1,17 +1,22 @@
 import collections
 import operator
 
-from guardian.shortcuts import assign_perm, get_users_with_perms, remove_perm
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import assign_perm
 from jsonfield import JSONField
 from polymorphic.models import PolymorphicModel
 
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Permission, User
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.db.models import Q, DO_NOTHING
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+
+from expdj.apps.experiments.cache import (BATTERY_CACHE, EXPERIMENT_TEMPLATE_CACHE, SITEMAP_CACHE,
+    USER_PERMISSIONS_CACHE, bump_cache_version)
 
 #  trying to import Result object directly from models was giving an import 
 #  error here, even though the import matched views.py exactly.
@@ -21,6 +26,7 @@ class CognitiveAtlasConcept(models.Model):
     name = models.CharField(max_length=1000, null=False, blank=False)
     cog_atlas_id = models.CharField(primary_key=True, max_length=200, null=False, blank=False)
     definition = models.CharField(max_length=5000, null=False, blank=False,default=None)
+    updated = models.DateTimeField(null=True,blank=True,editable=False,help_text="When the concept was last fetched from the Cognitive Atlas")
 
     def __str__(self):
         return self.name
@@ -36,6 +42,7 @@ class CognitiveAtlasTask(models.Model):
     name = models.CharField(max_length=200, null=False, blank=False)
     cog_atlas_id = models.CharField(primary_key=True, max_length=200, null=False, blank=False)
     concepts = models.ManyToManyField(CognitiveAtlasConcept,related_name="concepts",related_query_name="concepts", blank=True,help_text="These are concepts associated with the task.",verbose_name="cognitive atlas associated concepts")
+    updated = models.DateTimeField(null=True,blank=True,editable=False,help_text="When the task was last fetched from the Cognitive Atlas")
 
     def __str__(self):
         return self.name
@@ -90,6 +97,7 @@ class ExperimentTemplate(models.Model):
     reference = models.CharField(max_length=500,help_text="reference or paper associated with the experiment",unique=False)
     template = models.CharField(max_length=100,null=True,blank=False)
     version = models.CharField(max_length=100,null=True,blank=False)
+    content_hash = models.CharField(max_length=40,null=True,blank=True,editable=False,help_text="git tree hash of the installed experiment folder")
 
     def __meta__(self):
         ordering = ["name"]
@@ -115,6 +123,10 @@ class CreditCondition(models.Model):
         ("LESSTHANEQUALTO", operator.le),
         ("NOTEQUALTO", operator.ne),
     )
+
+    # Convenience lookup dictionary for the above list
+    operator_lookup = dict(OPERATOR_CHOICES)
+
     variable = models.ForeignKey(ExperimentVariable,null=False,blank=False)
     value = models.CharField("user selected value",max_length=200,null=False,blank=False,help_text="user selected value to compare the variable with the operator")
     operator = models.CharField("operator to compare variable to value",max_length=200,choices=OPERATOR_CHOICES,null=True,blank=True,help_text="Whether the credit condition is for reward (bonus) or rejection variables.")
@@ -189,6 +201,7 @@ class Battery(models.Model):
         help_text=("Batteries that must not be completed in order for "
                    "this battery to be attempted")
     )
+    pending_deletion = models.BooleanField(default=False,editable=False,help_text="The battery is hidden while its results and HITs are deleted in the background")
 
     def get_absolute_url(self):
         return_cid = self.id
@@ -211,17 +224,140 @@ class Battery(models.Model):
         )
 
 
-def contributors_changed(sender, instance, action, **kwargs):
-    if action in ["post_remove", "post_add", "post_clear"]:
-        current_contributors = set([user.pk for user in get_users_with_perms(instance)])
-        new_contributors = set([user.pk for user in [instance.owner, ] + list(instance.contributors.all())])
+def contributors_changed(sender, instance, action, reverse, **kwargs):
+    '''contributors_changed keeps the edit_battery object permissions in line with
+    the owner and contributors of a battery, with one query to add and one to remove
+    '''
+    if reverse or action not in ["post_remove", "post_add", "post_clear"]:
+        return
+    content_type = ContentType.objects.get_for_model(Battery)
+    permission = Permission.objects.get(content_type=content_type,codename='edit_battery')
+    permissions = UserObjectPermission.objects.filter(permission=permission,content_type=content_type,
+                                                      object_pk=str(instance.pk))
+    current_contributors = set(permissions.values_list('user_id',flat=True))
+    new_contributors = set(instance.contributors.values_list('id',flat=True))
+    new_contributors.add(instance.owner_id)
+
+    UserObjectPermission.objects.bulk_create([UserObjectPermission(permission=permission,
+                                                                   content_type=content_type,
+                                                                   object_pk=str(instance.pk),
+                                                                   user_id=user_id)
+                                              for user_id in new_contributors - current_contributors])
+    removed = current_contributors - new_contributors
+    if len(removed) > 0:
+        permissions.filter(user_id__in=removed).delete()
 
-        for contributor in list(new_contributors - current_contributors):
-            contributor = User.objects.get(pk=contributor)
-            assign_perm('edit_battery', contributor, instance)
+m2m_changed.connect(contributors_changed, sender=Battery.contributors.through)
 
-        for contributor in (current_contributors - new_contributors):
-            contributor = User.objects.get(pk=contributor)
-            remove_perm('edit_battery', contributor, instance)
 
-m2m_changed.connect(contributors_changed, sender=Battery.contributors.through)
+# CACHE INVALIDATION ###########################################################
+# Cached battery and experiment data (see cache.py) is keyed by a version,
+# bumped here when a battery, or anything it is built from, changes.
+
+# Battery many to many relations (through model: field name)
+BATTERY_RELATIONS = {Battery.experiments.through:"experiments",
+                     Battery.contributors.through:"contributors",
+                     Battery.required_batteries.through:"required_batteries",
+                     Battery.restricted_batteries.through:"restricted_batteries"}
+
+def bump_battery_versions(battery_ids):
+    for battery_id in set(battery_ids):
+        bump_cache_version(BATTERY_CACHE,battery_id)
+
+def battery_changed(sender, instance, **kwargs):
+    bump_cache_version(BATTERY_CACHE,instance.pk)
+
+def battery_relation_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''experiments, contributors and dependencies of a battery changed. From the
+    other side (eg, experiment.battery_experiments.add(battery)), pk_set holds
+    the batteries, except on clear, when they are looked up before the clear
+    '''
+    if not reverse and action in ["post_add","post_remove","post_clear"]:
+        bump_cache_version(BATTERY_CACHE,instance.pk)
+    elif reverse and action in ["post_add","post_remove"]:
+        bump_battery_versions(pk_set)
+    elif reverse and action == "pre_clear":
+        field_name = BATTERY_RELATIONS[sender]
+        bump_battery_versions(Battery.objects.filter(**{field_name:instance}).values_list('id',flat=True))
+
+def bump_user_permissions(user_ids):
+    for user_id in set(user_ids):
+        if user_id != None:
+            bump_cache_version(USER_PERMISSIONS_CACHE,user_id)
+
+def battery_loaded(sender, instance, **kwargs):
+    # The owner loaded (or last saved), who loses permissions if the owner changes
+    instance._saved_owner_id = instance.__dict__.get('owner_id')
+
+def battery_owner_changed(sender, instance, **kwargs):
+    bump_user_permissions([instance.owner_id,getattr(instance,'_saved_owner_id',None)])
+    instance._saved_owner_id = instance.owner_id
+
+def battery_deleted(sender, instance, **kwargs):
+    bump_user_permissions([instance.owner_id] + list(instance.contributors.values_list('id',flat=True)))
+
+def battery_contributors_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''the batteries a user can edit changed. From a battery, pk_set holds the
+    users (looked up before a clear), and from a user, the user is instance
+    '''
+    if reverse and action in ["post_add","post_remove","post_clear"]:
+        bump_user_permissions([instance.pk])
+    elif not reverse and action in ["post_add","post_remove"]:
+        bump_user_permissions(pk_set)
+    elif not reverse and action == "pre_clear":
+        bump_user_permissions(instance.contributors.values_list('id',flat=True))
+
+def experiment_changed(sender, instance, **kwargs):
+    bump_battery_versions(Battery.objects.filter(experiments=instance).values_list('id',flat=True))
+
+def credit_conditions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ["post_add","post_remove","pre_clear"]:
+        return
+    if not reverse:
+        batteries = Battery.objects.filter(experiments=instance)
+    elif action == "pre_clear":
+        batteries = Battery.objects.filter(experiments__credit_conditions=instance)
+    else:
+        batteries = Battery.objects.filter(experiments__in=pk_set)
+    bump_battery_versions(batteries.values_list('id',flat=True))
+
+def credit_condition_changed(sender, instance, **kwargs):
+    bump_battery_versions(Battery.objects.filter(experiments__credit_conditions=instance).values_list('id',flat=True))
+
+def experiment_template_changed(sender, instance, **kwargs):
+    bump_cache_version(EXPERIMENT_TEMPLATE_CACHE,instance.pk)
+    bump_battery_versions(Battery.objects.filter(experiments__template=instance).values_list('id',flat=True))
+
+def experiment_templates_upserted(exp_ids):
+    '''experiment templates were written without signals (see utils.upsert_experiment_templates)'''
+    if len(exp_ids) == 0:
+        return
+    for exp_id in exp_ids:
+        bump_cache_version(EXPERIMENT_TEMPLATE_CACHE,exp_id)
+    bump_battery_versions(Battery.objects.filter(experiments__template__in=exp_ids).values_list('id',flat=True))
+    bump_cache_version(SITEMAP_CACHE,"templates")
+
+def experiment_templates_changed(sender, instance, created=True, **kwargs):
+    '''the sitemaps list installed experiment templates, so are regenerated only
+    when one is installed or deleted
+    '''
+    if created:
+        bump_cache_version(SITEMAP_CACHE,"templates")
+
+post_save.connect(battery_changed, sender=Battery)
+post_delete.connect(battery_changed, sender=Battery)
+for through in BATTERY_RELATIONS:
+    m2m_changed.connect(battery_relation_changed, sender=through)
+post_init.connect(battery_loaded, sender=Battery)
+post_save.connect(battery_owner_changed, sender=Battery)
+pre_delete.connect(battery_deleted, sender=Battery)
+m2m_changed.connect(battery_contributors_changed, sender=Battery.contributors.through)
+post_save.connect(experiment_changed, sender=Experiment)
+pre_delete.connect(experiment_changed, sender=Experiment)
+m2m_changed.connect(credit_conditions_changed, sender=Experiment.credit_conditions.through)
+post_save.connect(credit_condition_changed, sender=CreditCondition)
+pre_delete.connect(credit_condition_changed, sender=CreditCondition)
+post_save.connect(experiment_template_changed, sender=ExperimentTemplate)
+pre_delete.connect(experiment_template_changed, sender=ExperimentTemplate)
+post_save.connect(experiment_templates_changed, sender=ExperimentTemplate)
+post_delete.connect(experiment_templates_changed, sender=ExperimentTemplate)
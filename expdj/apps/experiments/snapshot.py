@@ -0,0 +1,78 @@
+'''snapshot.py: a cached, read only view of a battery for the serve path
+
+Serving an experiment needs the battery's presentation order, its
+experiments (with their templates), the intro forms and the ids of the
+batteries it depends on. A BatterySnapshot holds all of these, is built with
+a few queries, and is cached under the battery's version (see cache.py), so
+it is rebuilt only after the battery or one of its experiments changes.
+'''
+
+from collections import namedtuple
+
+from expdj.apps.experiments.cache import BATTERY_CACHE, get_or_set_versioned
+from expdj.apps.experiments.models import Battery
+from expdj.apps.experiments.utils import get_battery_intro, get_experiment_type
+
+
+# An experiment of a battery, with what the serve path needs of its template
+SnapshotExperiment = namedtuple("SnapshotExperiment",["id","exp_id","name","experiment_type","content_hash",
+                                                      "order","include_bonus","include_catch"])
+
+
+class BatterySnapshot(object):
+    '''BatterySnapshot is the serve path's copy of a battery and its experiments'''
+
+    def __init__(self,battery,experiments,required_battery_ids,restricted_battery_ids):
+        self.id = battery.id
+        self.name = battery.name
+        self.active = battery.active
+        self.presentation_order = battery.presentation_order
+        self.intro = get_battery_intro(battery)
+        self.intro_without_advertisement = get_battery_intro(battery,show_advertisement=False)
+        self.experiments = tuple(SnapshotExperiment(id=e.id,exp_id=e.template.exp_id,name=e.template.name,
+                                                    experiment_type=get_experiment_type(e.template),
+                                                    content_hash=e.template.content_hash,order=e.order,
+                                                    include_bonus=e.include_bonus,include_catch=e.include_catch)
+                                 for e in experiments)
+        self.required_battery_ids = tuple(required_battery_ids)
+        self.restricted_battery_ids = tuple(restricted_battery_ids)
+
+    def __repr__(self):
+        return "<BatterySnapshot: %s>" %(self.id)
+
+    @property
+    def experiment_count(self):
+        return len(self.experiments)
+
+    def has_dependencies(self):
+        return len(self.required_battery_ids) > 0 or len(self.restricted_battery_ids) > 0
+
+    def get_experiments(self,exp_ids=None,exclude=None):
+        '''get_experiments returns the experiments of the battery, optionally only
+        those of some templates, or excluding some templates
+        :param exp_ids: ExperimentTemplate exp_ids to include
+        :param exclude: ExperimentTemplate exp_ids to exclude
+        '''
+        return [e for e in self.experiments
+                if (exp_ids == None or e.exp_id in exp_ids) and (exclude == None or e.exp_id not in exclude)]
+
+
+def build_battery_snapshot(battery_id):
+    try:
+        battery = Battery.objects.get(id=battery_id,pending_deletion=False)
+    except Battery.DoesNotExist:
+        return None
+    experiments = battery.experiments.select_related('template').order_by('id')
+    required = battery.required_batteries.values_list('id',flat=True)
+    restricted = battery.restricted_batteries.values_list('id',flat=True)
+    return BatterySnapshot(battery,experiments,required,restricted)
+
+
+def get_battery_snapshot(battery_id):
+    '''get_battery_snapshot returns the cached snapshot of a battery, or None if
+    it doesn't exist (or is being deleted)
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    snapshot = get_or_set_versioned(BATTERY_CACHE,battery_id,"snapshot",
+                                    lambda: build_battery_snapshot(battery_id) or False)
+    return snapshot or None
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Experiment asset tests: the files of an installed experiment version are
+fingerprinted, precompressed and stored once across experiments, and the
+load tags point at them."""
+
+from collections import namedtuple
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from expdj.apps.experiments import assets, versions
+from expdj.apps.experiments.assets import MANIFEST_FILE, build_assets, get_fingerprint, get_manifest
+from expdj.apps.experiments.versions import get_versions_folder, use_asset_urls
+
+
+TestExperiment = namedtuple("TestExperiment",["exp_id","content_hash"])
+
+STYLE = "body { background: url(background.png); }"
+
+
+class AssetTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.originals = {"versions":versions.media_dir,"assets":assets.media_dir}
+        versions.media_dir = self.media_dir
+        assets.media_dir = self.media_dir
+        assets.manifests.clear()
+
+    def tearDown(self):
+        versions.media_dir = self.originals["versions"]
+        assets.media_dir = self.originals["assets"]
+        assets.manifests.clear()
+        shutil.rmtree(self.media_dir)
+
+    def make_version(self,exp_id,content_hash,files):
+        '''make_version writes the files of an experiment version, and builds its assets'''
+        folder = os.path.join(get_versions_folder("experiments",exp_id),content_hash)
+        for path,content in files.items():
+            if not os.path.exists(os.path.dirname(os.path.join(folder,path))):
+                os.makedirs(os.path.dirname(os.path.join(folder,path)))
+            with open(os.path.join(folder,path),"w") as filey:
+                filey.write(content)
+        return folder,build_assets(folder)
+
+    def read(self,path,compressed=False):
+        if compressed:
+            filey = gzip.open(path,"rb")
+        else:
+            filey = open(path,"r")
+        try:
+            return filey.read()
+        finally:
+            filey.close()
+
+
+class AssetTests(AssetTestCase):
+
+    def test_fingerprinted_style(self):
+        # Css loading files relative to itself gets a fingerprinted copy next to it
+        folder,manifest = self.make_version("test_task","a" * 40,{"css/style.css":STYLE,"css/background.png":"png"})
+        fingerprinted = "css/style.%s.css" %(get_fingerprint(STYLE))
+        self.assertEqual(manifest["css/style.css"],fingerprinted)
+        self.assertEqual(self.read(os.path.join(folder,fingerprinted)),STYLE)
+        self.assertEqual(self.read(os.path.join(folder,"%s.gz" %(fingerprinted)),compressed=True),STYLE)
+        self.assertNotIn("css/background.png",manifest)
+
+    def test_compressed(self):
+        folder,manifest = self.make_version("test_task","a" * 40,{"index.html":"<p>task</p>","image.png":"png"})
+        self.assertEqual(self.read(os.path.join(folder,"index.html.gz"),compressed=True),"<p>task</p>")
+        self.assertFalse(os.path.exists(os.path.join(folder,"image.png.gz")))
+
+    def test_manifest(self):
+        folder,manifest = self.make_version("test_task","a" * 40,{"css/style.css":STYLE})
+        with open(os.path.join(folder,MANIFEST_FILE),"r") as filey:
+            self.assertEqual(json.load(filey),manifest)
+        self.assertEqual(get_manifest(folder),manifest)
+        self.assertEqual(get_manifest(os.path.join(self.media_dir,"missing")),{})
+
+    def test_use_asset_urls(self):
+        self.make_version("test_task","a" * 40,{"css/style.css":STYLE,"experiment.js":"var task;"})
+        html = ('<link rel="stylesheet" href="/static/experiments/test_task/css/style.css">'
+                "<script src='/static/experiments/test_task/experiment.js'></script>"
+                '<script src="/static/experiments/test_task/other.js"></script>'
+                '<script src="/static/experiments/other_task/experiment.js"></script>')
+        html = use_asset_urls(html,"experiments",[TestExperiment("test_task","a" * 40),
+                                                  TestExperiment("other_task",None)])
+        version_url = "/static/experiments/.versions/test_task/%s/" %("a" * 40)
+        self.assertIn('href="%scss/style.%s.css"' %(version_url,get_fingerprint(STYLE)),html)
+        # Files not in the manifest are loaded from the version folder
+        self.assertIn('src="%sother.js"' %(version_url),html)
+        self.assertIn("src='%s'" %(get_manifest(os.path.join(get_versions_folder("experiments","test_task"),
+                                                             "a" * 40))["experiment.js"]),html)
+        # Experiments installed before versions are left alone
+        self.assertIn('src="/static/experiments/other_task/experiment.js"',html)
+
+
+class SharedAssetTests(AssetTestCase):
+
+    def test_shared_file(self):
+        # Identical files of two experiments are stored once
+        first,first_manifest = self.make_version("test_task","a" * 40,{"jspsych.js":"var jsPsych;"})
+        second,second_manifest = self.make_version("other_task","b" * 40,{"jspsych.js":"var jsPsych;"})
+        self.assertEqual(first_manifest["jspsych.js"],second_manifest["jspsych.js"])
+        self.assertTrue(first_manifest["jspsych.js"].startswith("/static/.assets/"))
+        self.assertTrue(os.path.samefile(os.path.join(first,"jspsych.js"),os.path.join(second,"jspsych.js")))
+        shared_path = os.path.join(assets.get_shared_folder(),os.path.basename(first_manifest["jspsych.js"]))
+        self.assertEqual(os.stat(shared_path).st_nlink,3)
+        self.assertEqual(self.read("%s.gz" %(shared_path),compressed=True),"var jsPsych;")
+
+    def test_different_files(self):
+        first,first_manifest = self.make_version("test_task","a" * 40,{"experiment.js":"var first;"})
+        second,second_manifest = self.make_version("other_task","b" * 40,{"experiment.js":"var second;"})
+        self.assertNotEqual(first_manifest["experiment.js"],second_manifest["experiment.js"])
+        self.assertEqual(self.read(os.path.join(second,"experiment.js")),"var second;")
+
+    def test_relative_style_not_shared(self):
+        # The file is still stored once, but loaded from its fingerprinted copy
+        folder,manifest = self.make_version("test_task","a" * 40,{"style.css":STYLE,"plain.css":"p { }"})
+        self.assertFalse(manifest["style.css"].startswith("/static/"))
+        self.assertTrue(manifest["plain.css"].startswith("/static/.assets/"))
+
+    def test_share_file_existing_copy(self):
+        self.make_version("test_task","a" * 40,{"jspsych.js":"var jsPsych;"})
+        folder = tempfile.mkdtemp(dir=self.media_dir)
+        path = os.path.join(folder,"jspsych.js")
+        with open(path,"w") as filey:
+            filey.write("var jsPsych;")
+        filename = assets.share_file(path,"var jsPsych;")
+        self.assertTrue(os.path.samefile(path,os.path.join(assets.get_shared_folder(),filename)))
+        self.assertEqual(self.read(path),"var jsPsych;")
+
+    def test_collect_shared_assets(self):
+        first,first_manifest = self.make_version("test_task","a" * 40,{"jspsych.js":"var jsPsych;",
+                                                                       "experiment.js":"var first;"})
+        second,second_manifest = self.make_version("other_task","b" * 40,{"jspsych.js":"var jsPsych;"})
+        shutil.rmtree(first)
+        assets.collect_shared_assets()
+        shared = os.listdir(assets.get_shared_folder())
+        # The file still linked from the other experiment is kept, with its compressed copy
+        kept = os.path.basename(second_manifest["jspsych.js"])
+        self.assertEqual(sorted(shared),[kept,"%s.gz" %(kept)])
+        shutil.rmtree(second)
+        assets.collect_shared_assets()
+        self.assertEqual(os.listdir(assets.get_shared_folder()),[])
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Versioned cache tests: cached data is read until its object (or anything
+it is built from) changes, and rebuilt after."""
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+
+from expdj.apps.experiments.cache import (BATTERY_CACHE, EXPERIMENT_TEMPLATE_CACHE, bump_cache_version,
+                                          get_cache_version, get_or_set_versioned, get_version_key,
+                                          get_versioned_key)
+from expdj.apps.experiments.models import (Battery, CreditCondition, Experiment, ExperimentNumericVariable,
+                                           ExperimentTemplate, experiment_templates_upserted)
+
+
+LOCMEM_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache',
+                            'LOCATION':'expdj-tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheVersionTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        return {"builds":self.builds}
+
+    def test_bump_cache_version(self):
+        version = get_cache_version(BATTERY_CACHE,1)
+        self.assertEqual(get_cache_version(BATTERY_CACHE,1),version)
+        key = get_versioned_key(BATTERY_CACHE,1,"snapshot")
+        bump_cache_version(BATTERY_CACHE,1)
+        self.assertNotEqual(get_cache_version(BATTERY_CACHE,1),version)
+        self.assertNotEqual(get_versioned_key(BATTERY_CACHE,1,"snapshot"),key)
+        # Other objects (and namespaces) keep their version
+        other_version = get_cache_version(BATTERY_CACHE,2)
+        other_template_version = get_cache_version(EXPERIMENT_TEMPLATE_CACHE,1)
+        bump_cache_version(BATTERY_CACHE,1)
+        self.assertEqual(get_cache_version(BATTERY_CACHE,2),other_version)
+        self.assertEqual(get_cache_version(EXPERIMENT_TEMPLATE_CACHE,1),other_template_version)
+
+    def test_bump_without_version(self):
+        bump_cache_version(BATTERY_CACHE,1)
+        self.assertIsNotNone(cache.get(get_version_key(BATTERY_CACHE,1)))
+
+    def test_get_or_set_versioned(self):
+        self.assertEqual(get_or_set_versioned(BATTERY_CACHE,1,"data",self.build),{"builds":1})
+        self.assertEqual(get_or_set_versioned(BATTERY_CACHE,1,"data",self.build),{"builds":1})
+        self.assertEqual(get_or_set_versioned(BATTERY_CACHE,1,"other",self.build),{"builds":2})
+        bump_cache_version(BATTERY_CACHE,1)
+        self.assertEqual(get_or_set_versioned(BATTERY_CACHE,1,"data",self.build),{"builds":3})
+        self.assertEqual(self.builds,3)
+
+    def test_version_evicted(self):
+        get_or_set_versioned(BATTERY_CACHE,1,"data",self.build)
+        cache.delete(get_version_key(BATTERY_CACHE,1))
+        # A new version starts from the current time, so the old entry isn't read
+        time.sleep(0.01)
+        self.assertEqual(get_or_set_versioned(BATTERY_CACHE,1,"data",self.build),{"builds":2})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BatteryCacheSignalsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=1)
+        self.other_battery = Battery.objects.create(name="other",credentials="credentials",owner=owner,
+                                                    maximum_time=30,number_of_experiments=1)
+        self.template = ExperimentTemplate.objects.create(exp_id="test_task",name="test task",time=5,
+                                                          reference="",template="jspsych")
+        self.experiment = Experiment.objects.create(template=self.template)
+        self.battery.experiments.add(self.experiment)
+
+    def assertBumped(self,change,battery=None):
+        battery = battery or self.battery
+        version = get_cache_version(BATTERY_CACHE,battery.id)
+        other_version = get_cache_version(BATTERY_CACHE,self.other_battery.id)
+        change()
+        self.assertNotEqual(get_cache_version(BATTERY_CACHE,battery.id),version)
+        self.assertEqual(get_cache_version(BATTERY_CACHE,self.other_battery.id),other_version)
+
+    def test_battery_changed(self):
+        def change():
+            self.battery.name = "renamed"
+            self.battery.save()
+        self.assertBumped(change)
+
+    def test_experiments_changed(self):
+        experiment = Experiment.objects.create(template=self.template)
+        self.assertBumped(lambda: self.battery.experiments.add(experiment))
+        self.assertBumped(lambda: self.battery.experiments.remove(experiment))
+        self.assertBumped(lambda: experiment.battery_experiments.add(self.battery))
+        self.assertBumped(lambda: experiment.battery_experiments.clear())
+        self.assertBumped(lambda: self.battery.experiments.clear())
+
+    def test_dependencies_changed(self):
+        self.assertBumped(lambda: self.battery.required_batteries.add(self.other_battery.id),battery=self.battery)
+
+    def test_experiment_changed(self):
+        def change():
+            self.experiment.include_bonus = True
+            self.experiment.save()
+        self.assertBumped(change)
+
+    def test_credit_condition_changed(self):
+        variable = ExperimentNumericVariable.objects.create(name="avg_rt",description="reaction time")
+        condition = CreditCondition.objects.create(variable=variable,operator="LESSTHAN",value="400",amount=1)
+        self.assertBumped(lambda: self.experiment.credit_conditions.add(condition))
+        def change():
+            condition.value = "500"
+            condition.save()
+        self.assertBumped(change)
+        self.assertBumped(lambda: condition.delete())
+
+    def test_template_changed(self):
+        version = get_cache_version(EXPERIMENT_TEMPLATE_CACHE,"test_task")
+        def change():
+            self.template.name = "renamed"
+            self.template.save()
+        self.assertBumped(change)
+        self.assertNotEqual(get_cache_version(EXPERIMENT_TEMPLATE_CACHE,"test_task"),version)
+        self.assertBumped(lambda: experiment_templates_upserted(["test_task"]))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cognitive Atlas snapshot tests: tasks and concepts are fetched only when
+missing or stale, json that can't be saved is left out, and the stored
+snapshot is kept when the API is down."""
+
+from datetime import timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from expdj.apps.experiments import utils
+from expdj.apps.experiments.models import CognitiveAtlasConcept, CognitiveAtlasTask
+from expdj.apps.experiments.utils import (dump_cognitiveatlas_snapshot, fetch_cognitiveatlas,
+                                          get_cognitiveatlas_task, get_cognitiveatlas_tasks, is_valid_concept,
+                                          is_valid_task, load_cognitiveatlas_snapshot)
+
+
+class Response(object):
+
+    def __init__(self,data):
+        self.json = [data]
+
+
+class FakeAPI(object):
+    '''FakeAPI stands in for cognitiveatlas.api get_task or get_concept'''
+
+    def __init__(self,records):
+        self.records = records
+        self.fetched = []
+
+    def __call__(self,id=None):
+        self.fetched.append(id)
+        if id not in self.records:
+            raise ValueError("not found")
+        return Response(self.records[id])
+
+
+def make_task(task_id,*concept_ids):
+    return {"id":task_id,"name":"task %s" %(task_id),"concepts":[{"concept_id":c} for c in concept_ids]}
+
+
+def make_concept(concept_id):
+    return {"id":concept_id,"name":"concept %s" %(concept_id),"definition_text":"a definition"}
+
+
+class CognitiveAtlasValidationTests(SimpleTestCase):
+
+    def test_is_valid_task(self):
+        self.assertTrue(is_valid_task(make_task("trm_1","trm_c1")))
+        self.assertTrue(is_valid_task({"id":"trm_1","name":"task","concepts":None}))
+        self.assertFalse(is_valid_task({"id":"trm_1","name":""}))
+        self.assertFalse(is_valid_task({"id":"trm_1","name":"x" * 1000}))
+        self.assertFalse(is_valid_task({"id":None,"name":"task"}))
+        self.assertFalse(is_valid_task({"id":"trm_1","name":"task","concepts":["trm_c1"]}))
+
+    def test_is_valid_concept(self):
+        self.assertTrue(is_valid_concept(make_concept("trm_c1")))
+        self.assertFalse(is_valid_concept({"id":"trm_c1","name":"concept"}))
+
+    def test_fetch_cognitiveatlas(self):
+        fetch = FakeAPI({"trm_1":make_task("trm_1"),"trm_2":{"id":"trm_2"},"trm_3":"not json"})
+        fetched = fetch_cognitiveatlas(fetch,["trm_1","trm_2","trm_3","trm_4"],is_valid_task)
+        self.assertEqual(fetched,{"trm_1":make_task("trm_1")})
+        self.assertEqual(sorted(fetch.fetched),["trm_1","trm_2","trm_3","trm_4"])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "ON CONFLICT is on PostgreSQL")
+class CognitiveAtlasSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.tasks = FakeAPI({"trm_1":make_task("trm_1","trm_c1","trm_c2"),"trm_2":make_task("trm_2","trm_c2")})
+        self.concepts = FakeAPI({"trm_c1":make_concept("trm_c1"),"trm_c2":make_concept("trm_c2")})
+        self.originals = {"get_task":utils.get_task,"get_concept":utils.get_concept}
+        utils.get_task = self.tasks
+        utils.get_concept = self.concepts
+
+    def tearDown(self):
+        utils.get_task = self.originals["get_task"]
+        utils.get_concept = self.originals["get_concept"]
+
+    def make_stale(self,task_id):
+        updated = timezone.now() - timedelta(days=utils.COGNITIVE_ATLAS_TTL_DAYS + 1)
+        CognitiveAtlasTask.objects.filter(cog_atlas_id=task_id).update(updated=updated)
+
+    def test_fetch_missing(self):
+        tasks = get_cognitiveatlas_tasks(["trm_1","trm_2",None])
+        self.assertEqual(sorted(tasks.keys()),["trm_1","trm_2"])
+        self.assertEqual(sorted(tasks["trm_1"].concepts.values_list('cog_atlas_id',flat=True)),["trm_c1","trm_c2"])
+        # Each concept is fetched once
+        self.assertEqual(sorted(self.concepts.fetched),["trm_c1","trm_c2"])
+
+    def test_fresh_not_fetched(self):
+        get_cognitiveatlas_task("trm_1")
+        self.tasks.fetched = []
+        self.concepts.fetched = []
+        self.assertEqual(get_cognitiveatlas_task("trm_1").name,"task trm_1")
+        self.assertEqual(self.tasks.fetched,[])
+
+    def test_stale_fetched(self):
+        get_cognitiveatlas_task("trm_1")
+        self.make_stale("trm_1")
+        self.tasks.records["trm_1"] = make_task("trm_1","trm_c1")
+        self.tasks.records["trm_1"]["name"] = "renamed"
+        task = get_cognitiveatlas_task("trm_1")
+        self.assertEqual(task.name,"renamed")
+        self.assertEqual(list(task.concepts.values_list('cog_atlas_id',flat=True)),["trm_c1"])
+        # The concepts are still fresh
+        self.assertEqual(sorted(self.concepts.fetched),["trm_c1","trm_c2"])
+
+    def test_api_down(self):
+        get_cognitiveatlas_task("trm_1")
+        self.make_stale("trm_1")
+        self.tasks.records = {}
+        # The stored snapshot is used
+        self.assertEqual(get_cognitiveatlas_task("trm_1").name,"task trm_1")
+        self.assertEqual(get_cognitiveatlas_task("trm_3"),None)
+
+    def test_invalid_json_kept_out(self):
+        self.tasks.records["trm_3"] = {"id":"trm_3","name":"x" * 1000}
+        self.assertEqual(get_cognitiveatlas_tasks(["trm_1","trm_3"]).keys(),["trm_1"])
+
+    def test_snapshot_file(self):
+        get_cognitiveatlas_tasks(["trm_1","trm_2"])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            snapshot_file = os.path.join(tmpdir,"cognitiveatlas.json")
+            self.assertEqual(dump_cognitiveatlas_snapshot(snapshot_file),(2,2))
+            CognitiveAtlasTask.objects.all().delete()
+            CognitiveAtlasConcept.objects.all().delete()
+            self.assertEqual(load_cognitiveatlas_snapshot(snapshot_file),(2,2))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.tasks.records = {}
+        self.assertEqual(sorted(get_cognitiveatlas_task("trm_1").concepts.values_list('cog_atlas_id',flat=True)),
+                         ["trm_c1","trm_c2"])
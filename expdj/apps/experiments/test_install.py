@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Experiment install tests: only experiments whose folder changed (by git
+tree hash) are copied again, and their templates are written with one
+upsert. The copy itself is faked, see test_versions.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.db import connection
+from django.test import TestCase
+
+from expdj.apps.experiments import utils
+from expdj.apps.experiments.models import ExperimentTemplate
+
+
+def get_config(exp_id,name=None):
+    return [{"exp_id":exp_id,"name":name or exp_id,"publish":"True","time":5,"reference":["a paper"],
+             "template":"jspsych","cognitive_atlas_task_id":None}]
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "ON CONFLICT is on PostgreSQL")
+class InstallExperimentFoldersTests(TestCase):
+
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.hashes = {"task_0":"a" * 40,"task_1":"b" * 40}
+        self.copied = []
+        self.failing = []
+        self.originals = dict([(name,getattr(utils,name)) for name in
+                               ["media_dir","get_tree_hashes","install_version","get_cognitiveatlas_tasks"]])
+        utils.media_dir = self.media_dir
+        utils.get_tree_hashes = lambda repo_type,commit: dict(self.hashes)
+        utils.get_cognitiveatlas_tasks = lambda task_ids: {}
+        def install_version(experiment_type,exp_id,content_hash,source_folder):
+            if exp_id in self.failing:
+                raise IOError("copy failed")
+            self.copied.append(exp_id)
+            experiment_folder = os.path.join(self.media_dir,experiment_type,exp_id)
+            if not os.path.exists(experiment_folder):
+                os.makedirs(experiment_folder)
+        utils.install_version = install_version
+
+    def tearDown(self):
+        for name,value in self.originals.items():
+            setattr(utils,name,value)
+        shutil.rmtree(self.media_dir)
+
+    def install(self,*configs):
+        return utils.install_experiment_folders(list(configs),"/repository","commit1")
+
+    def test_install(self):
+        self.assertEqual(self.install(get_config("task_0"),get_config("task_1")),[])
+        self.assertEqual(sorted(self.copied),["task_0","task_1"])
+        template = ExperimentTemplate.objects.get(exp_id="task_0")
+        self.assertEqual(template.content_hash,"a" * 40)
+        self.assertEqual(template.version,"commit1")
+        self.assertEqual(template.reference,"a paper")
+        self.assertTrue(template.publish)
+
+    def test_unchanged_skipped(self):
+        self.install(get_config("task_0"),get_config("task_1"))
+        self.copied = []
+        self.assertEqual(self.install(get_config("task_0"),get_config("task_1")),[])
+        self.assertEqual(self.copied,[])
+
+    def test_changed_installed(self):
+        self.install(get_config("task_0"),get_config("task_1"))
+        self.copied = []
+        self.hashes["task_1"] = "c" * 40
+        self.install(get_config("task_0"),get_config("task_1","renamed"))
+        self.assertEqual(self.copied,["task_1"])
+        template = ExperimentTemplate.objects.get(exp_id="task_1")
+        self.assertEqual(template.content_hash,"c" * 40)
+        self.assertEqual(template.name,"renamed")
+
+    def test_missing_folder_installed(self):
+        self.install(get_config("task_0"))
+        shutil.rmtree(os.path.join(self.media_dir,"experiments","task_0"))
+        self.copied = []
+        self.install(get_config("task_0"))
+        self.assertEqual(self.copied,["task_0"])
+
+    def test_copy_failed(self):
+        self.failing = ["task_1"]
+        self.assertEqual(self.install(get_config("task_0"),get_config("task_1")),["task_1"])
+        self.assertTrue(ExperimentTemplate.objects.filter(exp_id="task_0").exists())
+        self.assertFalse(ExperimentTemplate.objects.filter(exp_id="task_1").exists())
+
+    def test_bad_row_isolated(self):
+        # A duplicate name fails the upsert of its template only
+        ExperimentTemplate.objects.create(exp_id="installed",name="taken",time=5,reference="",template="jspsych")
+        self.assertEqual(self.install(get_config("task_0"),get_config("task_1","taken")),["task_1"])
+        self.assertTrue(ExperimentTemplate.objects.filter(exp_id="task_0").exists())
+        self.assertFalse(ExperimentTemplate.objects.filter(exp_id="task_1").exists())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Repository mirror tests: the expfactory repositories are fetched at most
+every EXPFACTORY_MIRROR_FETCH_SECONDS, and their experiments are read once
+per commit. A local git repository stands in for the remote."""
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from git import Repo
+
+from expdj.apps.experiments import mirror
+
+
+LOCMEM_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache',
+                            'LOCATION':'expdj-tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MirrorTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin = Repo.init(os.path.join(self.tmpdir,"remote","experiments"))
+        self.origin.git.symbolic_ref("HEAD","refs/heads/master")
+        self.commit_experiment("test_task")
+
+        self.originals = dict([(name,getattr(mirror,name)) for name in
+                               ["EXPFACTORY_MIRROR_ROOT","EXPFACTORY_MIRROR_FETCH_SECONDS",
+                                "EXPFACTORY_REPOSITORY_URL","get_experiments"]])
+        mirror.EXPFACTORY_MIRROR_ROOT = os.path.join(self.tmpdir,"mirrors")
+        mirror.EXPFACTORY_MIRROR_FETCH_SECONDS = 300
+        mirror.EXPFACTORY_REPOSITORY_URL = os.path.join(self.tmpdir,"remote","%s")
+        # The experiments are listed by folder, expfactory would validate their config.json
+        self.listed = []
+        def get_experiments(folder,**kwargs):
+            self.listed.append(folder)
+            return [[{"exp_id":name}] for name in sorted(os.listdir(folder))]
+        mirror.get_experiments = get_experiments
+
+    def tearDown(self):
+        for name,value in self.originals.items():
+            setattr(mirror,name,value)
+        shutil.rmtree(self.tmpdir)
+
+    def commit_experiment(self,exp_id):
+        folder = os.path.join(self.origin.working_dir,exp_id)
+        os.mkdir(folder)
+        with open(os.path.join(folder,"config.json"),"w") as filey:
+            filey.write('[{"exp_id":"%s"}]' %(exp_id))
+        self.origin.index.add([os.path.join(exp_id,"config.json")])
+        return self.origin.index.commit("add %s" %(exp_id)).hexsha
+
+    def age_last_fetch(self,seconds):
+        last_fetch = os.path.join(mirror.get_mirror_path("experiments"),mirror.LAST_FETCH_FILE)
+        then = time.time() - seconds
+        os.utime(last_fetch,(then,then))
+
+    def test_fetch_throttled(self):
+        first = self.origin.head.commit.hexsha
+        self.assertEqual(mirror.update_mirror("experiments"),first)
+        second = self.commit_experiment("other_task")
+        # Fetched (once) only after EXPFACTORY_MIRROR_FETCH_SECONDS
+        self.assertEqual(mirror.update_mirror("experiments"),first)
+        self.age_last_fetch(60)
+        self.assertEqual(mirror.update_mirror("experiments"),first)
+        self.age_last_fetch(301)
+        self.assertEqual(mirror.update_mirror("experiments"),second)
+        self.assertEqual(mirror.update_mirror("experiments",force=True),second)
+
+    def test_remote_down(self):
+        first = mirror.update_mirror("experiments")
+        shutil.rmtree(self.origin.working_dir)
+        self.age_last_fetch(301)
+        # The mirror is still served, and the remote retried after the interval
+        self.assertEqual(mirror.update_mirror("experiments"),first)
+        last_fetch = os.path.join(mirror.get_mirror_path("experiments"),mirror.LAST_FETCH_FILE)
+        self.assertLess(time.time() - os.path.getmtime(last_fetch),60)
+
+    def test_tree_hashes(self):
+        first = mirror.update_mirror("experiments")
+        self.commit_experiment("other_task")
+        second = mirror.update_mirror("experiments",force=True)
+        first_hashes = mirror.get_tree_hashes("experiments",first)
+        second_hashes = mirror.get_tree_hashes("experiments",second)
+        self.assertEqual(sorted(second_hashes.keys()),["other_task","test_task"])
+        # An experiment that didn't change keeps its hash
+        self.assertEqual(first_hashes["test_task"],second_hashes["test_task"])
+
+    def test_experiment_index_cached(self):
+        self.assertEqual(mirror.get_experiment_index("experiments"),[{"exp_id":"test_task"}])
+        self.assertEqual(mirror.get_experiment_index("experiments"),[{"exp_id":"test_task"}])
+        self.assertEqual(len(self.listed),1)
+        # The checkout is removed after reading it
+        self.assertFalse(os.path.exists(self.listed[0]))
+        self.commit_experiment("other_task")
+        commit = mirror.update_mirror("experiments",force=True)
+        self.assertEqual(len(mirror.get_experiment_index("experiments",commit)),2)
+        self.assertEqual(len(self.listed),2)
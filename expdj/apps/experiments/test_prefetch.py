@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Asset hint tests: a served experiment preloads its own assets, and
+prefetches those of the experiments that can be served next."""
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from expdj.apps.experiments import versions
+from expdj.apps.experiments.cache import EXPERIMENT_TEMPLATE_CACHE, bump_cache_version
+from expdj.apps.experiments.snapshot import SnapshotExperiment
+from expdj.apps.experiments.utils import get_next_experiments
+from expdj.apps.experiments.versions import get_asset_urls, get_link_header, get_next_asset_urls
+
+
+LOCMEM_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache',
+                            'LOCATION':'expdj-tests'}}
+
+
+def make_experiment(exp_id,order=1):
+    return SnapshotExperiment(id=None,exp_id=exp_id,name=exp_id,experiment_type="experiments",
+                              content_hash="a" * 40,order=order,include_bonus=False,include_catch=False)
+
+
+class Battery(object):
+
+    def __init__(self,presentation_order):
+        self.presentation_order = presentation_order
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PrefetchTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.asset_urls = {"task_0":["/static/.assets/jspsych.js","/static/.assets/task_0.js"],
+                           "task_1":["/static/.assets/jspsych.js","/static/.assets/task_1.js"],
+                           "task_2":["/static/.assets/jspsych.js","/static/.assets/style.css"]}
+        self.loads = []
+        self.get_experiment_load = versions.get_experiment_load
+        def get_experiment_load(experiment_type,experiments):
+            self.loads.append(experiments[0].exp_id)
+            return "".join(['<script src="%s"></script>' %(url) for url in self.asset_urls[experiments[0].exp_id]])
+        versions.get_experiment_load = get_experiment_load
+
+    def tearDown(self):
+        versions.get_experiment_load = self.get_experiment_load
+
+    def test_link_header(self):
+        header = get_link_header(["/static/.assets/jspsych.js","/static/.assets/style.css"],
+                                 ["/static/.assets/jspsych.js","/static/.assets/task_1.js"])
+        self.assertEqual(header,"</static/.assets/jspsych.js>; rel=preload; as=script, "
+                                "</static/.assets/style.css>; rel=preload; as=style, "
+                                "</static/.assets/task_1.js>; rel=prefetch")
+        self.assertEqual(get_link_header([],[]),"")
+
+    def test_next_experiments_specified(self):
+        experiments = [make_experiment("task_0",1),make_experiment("task_1",2),make_experiment("task_2",2)]
+        next_experiments = get_next_experiments(Battery("specified"),experiments,experiments[:1])
+        self.assertEqual([e.exp_id for e in next_experiments],["task_1","task_2"])
+        self.assertEqual(get_next_experiments(Battery("specified"),experiments[:1],experiments[:1]),[])
+
+    def test_next_experiments_random(self):
+        experiments = [make_experiment("task_0",1),make_experiment("task_1",2),make_experiment("task_2",3)]
+        next_experiments = get_next_experiments(Battery("random"),experiments,experiments[1:2])
+        self.assertEqual([e.exp_id for e in next_experiments],["task_0","task_2"])
+
+    def test_next_asset_urls(self):
+        # All the urls of a single next experiment, and those common to several
+        self.assertEqual(get_next_asset_urls([make_experiment("task_1")]),self.asset_urls["task_1"])
+        self.assertEqual(get_next_asset_urls([make_experiment("task_0"),make_experiment("task_1")]),
+                         ["/static/.assets/jspsych.js"])
+        self.assertEqual(get_next_asset_urls([]),[])
+
+    def test_asset_urls_cached(self):
+        self.assertEqual(get_asset_urls("experiments",make_experiment("task_0")),self.asset_urls["task_0"])
+        get_asset_urls("experiments",make_experiment("task_0"))
+        self.assertEqual(self.loads,["task_0"])
+        # A new version of the template has new urls
+        self.asset_urls["task_0"] = ["/static/.assets/jspsych.js"]
+        bump_cache_version(EXPERIMENT_TEMPLATE_CACHE,"task_0")
+        self.assertEqual(get_asset_urls("experiments",make_experiment("task_0")),["/static/.assets/jspsych.js"])
+        self.assertEqual(self.loads,["task_0","task_0"])
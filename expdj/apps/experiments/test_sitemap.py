@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Sitemap tests: each section lists the installed templates of its kind, and
+the XML is served from the cache until a template is installed or deleted."""
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from expdj.apps.experiments.models import ExperimentTemplate
+
+
+LOCMEM_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache',
+                            'LOCATION':'expdj-tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SitemapTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for exp_id,template in [("test_task","jspsych"),("test_survey","survey"),("test_game","phaser")]:
+            ExperimentTemplate.objects.create(exp_id=exp_id,name=exp_id,time=5,reference="",template=template)
+
+    def get_sitemap(self,section):
+        response = self.client.get("/sitemap-%s.xml" %(section))
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response["Content-Type"],"application/xml")
+        return response.content
+
+    def test_sections(self):
+        experiments = self.get_sitemap("experiments")
+        self.assertIn("/experiments/test_task/",experiments)
+        self.assertNotIn("test_survey",experiments)
+        self.assertIn("test_survey",self.get_sitemap("surveys"))
+        self.assertIn("test_game",self.get_sitemap("games"))
+
+    def test_index(self):
+        response = self.client.get("/sitemap.xml")
+        self.assertEqual(response.status_code,200)
+        for section in ["experiments","surveys","games"]:
+            self.assertIn("sitemap-%s.xml" %(section),response.content)
+
+    def test_sitemap_cached(self):
+        self.get_sitemap("experiments")
+        # Written without signals, the cached sitemap is served
+        ExperimentTemplate.objects.filter(exp_id="test_task").update(template="survey")
+        self.assertIn("test_task",self.get_sitemap("experiments"))
+        # Installing a template regenerates it
+        ExperimentTemplate.objects.create(exp_id="new_task",name="new task",time=5,reference="",template="jspsych")
+        experiments = self.get_sitemap("experiments")
+        self.assertIn("new_task",experiments)
+        self.assertNotIn("test_task",experiments)
+
+    def test_template_deleted(self):
+        self.get_sitemap("games")
+        ExperimentTemplate.objects.get(exp_id="test_game").delete()
+        self.assertNotIn("test_game",self.get_sitemap("games"))
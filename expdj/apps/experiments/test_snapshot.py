@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Battery snapshot tests: the serve path reads a cached copy of a battery,
+which is rebuilt after the battery or one of its experiments changes."""
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from expdj.apps.experiments.cache import BATTERY_CACHE, bump_cache_version
+from expdj.apps.experiments.models import Battery, Experiment, ExperimentTemplate
+from expdj.apps.experiments.snapshot import get_battery_snapshot
+from expdj.apps.turk.models import Result, Worker
+from expdj.apps.turk.utils import get_snapshot_experiments
+
+
+LOCMEM_CACHES = {'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache',
+                            'LOCATION':'expdj-tests'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BatterySnapshotTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=2,
+                                              consent="<p>consent</p>",advertisement="<p>advertisement</p>")
+        self.required = Battery.objects.create(name="required",credentials="credentials",owner=owner,
+                                               maximum_time=30,number_of_experiments=1)
+        self.battery.required_batteries.add(self.required)
+        self.templates = [ExperimentTemplate.objects.create(exp_id="task_%s" %(i),name="task %s" %(i),time=5,
+                                                            reference="",template="jspsych") for i in range(2)]
+        self.experiments = [Experiment.objects.create(template=template,order=i)
+                            for i,template in enumerate(self.templates)]
+        self.battery.experiments.add(*self.experiments)
+
+    def test_snapshot(self):
+        snapshot = get_battery_snapshot(self.battery.id)
+        self.assertEqual(snapshot.id,self.battery.id)
+        self.assertEqual(snapshot.experiment_count,2)
+        self.assertEqual([e.exp_id for e in snapshot.experiments],["task_0","task_1"])
+        self.assertEqual([e.experiment_type for e in snapshot.experiments],["experiments","experiments"])
+        self.assertEqual([form["title"] for form in snapshot.intro],["Advertisement","Consent"])
+        self.assertEqual([form["title"] for form in snapshot.intro_without_advertisement],["Consent"])
+        self.assertEqual(snapshot.required_battery_ids,(self.required.id,))
+        self.assertTrue(snapshot.has_dependencies())
+        self.assertFalse(get_battery_snapshot(self.required.id).has_dependencies())
+        self.assertEqual([e.exp_id for e in snapshot.get_experiments(exclude=["task_0"])],["task_1"])
+
+    def test_snapshot_cached(self):
+        get_battery_snapshot(self.battery.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_battery_snapshot(self.battery.id).experiment_count,2)
+
+    def test_battery_changed(self):
+        get_battery_snapshot(self.battery.id)
+        self.battery.presentation_order = "specified"
+        self.battery.save()
+        self.assertEqual(get_battery_snapshot(self.battery.id).presentation_order,"specified")
+
+    def test_experiments_changed(self):
+        get_battery_snapshot(self.battery.id)
+        self.battery.experiments.remove(self.experiments[0])
+        self.assertEqual([e.exp_id for e in get_battery_snapshot(self.battery.id).experiments],["task_1"])
+        self.experiments[1].include_bonus = True
+        self.experiments[1].save()
+        self.assertTrue(get_battery_snapshot(self.battery.id).experiments[0].include_bonus)
+
+    def test_template_changed(self):
+        get_battery_snapshot(self.battery.id)
+        self.templates[0].name = "renamed"
+        self.templates[0].save()
+        self.assertEqual(get_battery_snapshot(self.battery.id).experiments[0].name,"renamed")
+
+    def test_missing_battery(self):
+        self.assertEqual(get_battery_snapshot(self.battery.id + 100),None)
+        # Batteries being deleted are hidden from the serve path
+        Battery.objects.filter(id=self.battery.id).update(pending_deletion=True)
+        bump_cache_version(BATTERY_CACHE,self.battery.id)
+        self.assertEqual(get_battery_snapshot(self.battery.id),None)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_battery_snapshot(self.battery.id),None)
+
+    def test_snapshot_experiments(self):
+        snapshot = get_battery_snapshot(self.battery.id)
+        worker = Worker.objects.create(id="WORKER")
+        Result.objects.create(worker=worker,battery=self.battery,experiment_id="task_0",completed=True)
+        Result.objects.create(worker=worker,battery=self.battery,experiment_id="task_1",completed=False)
+        self.assertEqual([e.exp_id for e in get_snapshot_experiments(worker,snapshot)],["task_1"])
+        self.assertEqual([e.exp_id for e in get_snapshot_experiments(worker,snapshot,completed=True)],["task_0"])
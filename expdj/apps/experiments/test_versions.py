@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Experiment version tests: each version is installed to its own folder,
+the experiment folder is a symlink to the current one, and old versions
+are collected."""
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import SimpleTestCase
+
+from expdj.apps.experiments import assets, versions
+from expdj.apps.experiments.versions import (VERSIONS_FOLDER, collect_versions, get_current_version,
+                                             get_experiment_folder, get_experiment_url, get_versions_folder,
+                                             install_version, remove_experiment)
+
+
+class VersionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.media_dir = os.path.join(self.tmpdir,"media")
+        os.makedirs(os.path.join(self.media_dir,"experiments"))
+        self.originals = {"versions":versions.media_dir,"assets":assets.media_dir}
+        versions.media_dir = self.media_dir
+        assets.media_dir = self.media_dir
+
+    def tearDown(self):
+        versions.media_dir = self.originals["versions"]
+        assets.media_dir = self.originals["assets"]
+        shutil.rmtree(self.tmpdir)
+
+    def make_source(self,content):
+        source = tempfile.mkdtemp(dir=self.tmpdir)
+        with open(os.path.join(source,"experiment.js"),"w") as filey:
+            filey.write(content)
+        with open(os.path.join(source,"config.json"),"w") as filey:
+            filey.write('[{"exp_id":"test_task"}]')
+        return source
+
+    def install(self,content_hash,content):
+        install_version("experiments","test_task",content_hash,self.make_source(content))
+        # Versions are ordered by the time they were installed
+        version_folder = os.path.join(get_versions_folder("experiments","test_task"),content_hash)
+        then = time.time() - 1000 + len(os.listdir(get_versions_folder("experiments","test_task")))
+        os.utime(version_folder,(then,then))
+
+    def read_current(self,filename="experiment.js"):
+        with open(os.path.join(get_experiment_folder("experiments","test_task"),filename),"r") as filey:
+            return filey.read()
+
+    def test_install_version(self):
+        self.install("a" * 40,"var version = 1;")
+        experiment_folder = get_experiment_folder("experiments","test_task")
+        self.assertTrue(os.path.islink(experiment_folder))
+        # Relative, so the media folder can move
+        self.assertEqual(os.readlink(experiment_folder),os.path.join(VERSIONS_FOLDER,"test_task","a" * 40))
+        self.assertEqual(get_current_version("experiments","test_task"),"a" * 40)
+        self.assertEqual(self.read_current(),"var version = 1;")
+        self.assertTrue(os.path.exists(os.path.join(experiment_folder,assets.MANIFEST_FILE)))
+
+    def test_new_version(self):
+        self.install("a" * 40,"var version = 1;")
+        self.install("b" * 40,"var version = 2;")
+        self.assertEqual(get_current_version("experiments","test_task"),"b" * 40)
+        self.assertEqual(self.read_current(),"var version = 2;")
+        # The previous version is kept for pages still loading it
+        self.assertEqual(sorted(os.listdir(get_versions_folder("experiments","test_task"))),["a" * 40,"b" * 40])
+        self.install("c" * 40,"var version = 3;")
+        self.assertEqual(sorted(os.listdir(get_versions_folder("experiments","test_task"))),["b" * 40,"c" * 40])
+
+    def test_reinstall_version(self):
+        self.install("a" * 40,"var version = 1;")
+        self.install("b" * 40,"var version = 2;")
+        # Going back to a kept version doesn't copy it again
+        install_version("experiments","test_task","a" * 40,os.path.join(self.tmpdir,"missing"))
+        self.assertEqual(self.read_current(),"var version = 1;")
+
+    def test_unversioned_folder(self):
+        # A folder installed before versions is replaced, and collected
+        experiment_folder = get_experiment_folder("experiments","test_task")
+        shutil.copytree(self.make_source("var version = 0;"),experiment_folder)
+        self.install("a" * 40,"var version = 1;")
+        self.assertEqual(self.read_current(),"var version = 1;")
+        self.assertIn("unversioned",os.listdir(get_versions_folder("experiments","test_task")))
+        collect_versions("experiments","test_task",keep=1)
+        self.assertEqual(os.listdir(get_versions_folder("experiments","test_task")),["a" * 40])
+
+    def test_remove_experiment(self):
+        self.install("a" * 40,"var version = 1;")
+        remove_experiment("experiments","test_task")
+        self.assertFalse(os.path.lexists(get_experiment_folder("experiments","test_task")))
+        self.assertFalse(os.path.exists(get_versions_folder("experiments","test_task")))
+        # The shared copies of its files are collected
+        self.assertEqual(os.listdir(assets.get_shared_folder()),[])
+
+    def test_experiment_url(self):
+        self.assertEqual(get_experiment_url("experiments","test_task"),"/static/experiments/test_task/")
+        self.assertEqual(get_experiment_url("experiments","test_task","a" * 40),
+                         "/static/experiments/.versions/test_task/%s/" %("a" * 40))
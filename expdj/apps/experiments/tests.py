@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Basic unit tests for Experiments App"""
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from expdj.apps.experiments import views
+from expdj.apps.experiments.cache import USER_PERMISSIONS_CACHE, get_cache_version
+from expdj.apps.experiments.models import Battery, Experiment, ExperimentTemplate
+from expdj.apps.turk.models import Assignment, HIT, Worker, get_assignment_summary
+from expdj.apps.users.models import User as UserRole
+
+
+class DummyBatteryTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="password")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=self.owner,
+                                              maximum_time=30,number_of_experiments=1)
+        template = ExperimentTemplate.objects.create(exp_id="test_task",name="test task",time=5,
+                                                     reference="",template="jspsych")
+        self.battery.experiments.add(Experiment.objects.create(template=template))
+
+        # The experiment files aren't installed, so the expfactory html is faked
+        self.originals = dict([(name,getattr(views,name)) for name in
+                               ["get_experiment_load","get_asset_urls","get_experiment_run"]])
+        views.get_experiment_load = lambda experiment_type,experiments: ""
+        views.get_asset_urls = lambda experiment_type,experiment: []
+        views.get_experiment_run = lambda folders,deployment: {"test_task":"<p>{{next_page}}</p>"}
+
+    def tearDown(self):
+        for name,function in self.originals.items():
+            setattr(views,name,function)
+
+    def test_dummy_battery(self):
+        # The preview has no result (or worker) to check the blacklist for
+        self.client.login(username="owner",password="password")
+        response = self.client.get(reverse('dummy_battery',args=[self.battery.id]))
+        self.assertEqual(response.status_code,200)
+        self.assertContains(response,"javascript:window.location.reload();")
+
+
+class BatteryAssignmentsTests(TestCase):
+
+    def setUp(self):
+        # Rows are bulk created, HIT.save would contact Amazon
+        self.owner = User.objects.create_user(username="owner",password="password")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=self.owner,
+                                              maximum_time=30,number_of_experiments=1)
+        HIT.objects.bulk_create([HIT(battery=self.battery,owner=self.owner,mturk_id="HIT",title="hit",
+                                     description="hit",reward=1,assignment_duration_in_hours=1)])
+        self.hit = HIT.objects.get(mturk_id="HIT")
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(60)])
+
+    def test_new_assignments_paged(self):
+        # Assignments created after the summary was cached are still paged
+        Assignment.objects.create(mturk_id="ASSIGNMENT0",worker_id="WORKER0",hit=self.hit)
+        self.assertEqual(get_assignment_summary(self.battery.id)["none"],1)
+        Assignment.objects.bulk_create([Assignment(mturk_id="ASSIGNMENT%s" %(i),worker_id="WORKER%s" %(i),hit=self.hit)
+                                        for i in range(1,60)])
+        self.client.login(username="owner",password="password")
+        response = self.client.get(reverse('battery_assignments',args=[self.battery.id,"none"]),{"page":2})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.context["assignments"].number,2)
+        self.assertEqual(len(response.context["assignments"].object_list),60 - views.ASSIGNMENTS_PER_PAGE)
+
+
+class UserPermissionsCacheTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner",password="password")
+        self.other = User.objects.create_user(username="other",password="password")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=self.owner,
+                                              maximum_time=30,number_of_experiments=1)
+
+    def get_permissions(self,user):
+        request = type("Request",(object,),{"user":user})()
+        return views.get_user_permissions(request)
+
+    def test_owner_changed(self):
+        self.assertIn(self.battery.id,self.get_permissions(self.owner)["delete"])
+        self.assertNotIn(self.battery.id,self.get_permissions(self.other)["edit"])
+        battery = Battery.objects.get(id=self.battery.id)
+        battery.owner = self.other
+        battery.save()
+        self.assertNotIn(self.battery.id,self.get_permissions(self.owner)["edit"])
+        self.assertNotIn(self.battery.id,self.get_permissions(self.owner)["delete"])
+        self.assertIn(self.battery.id,self.get_permissions(self.other)["delete"])
+
+    def test_contributors_changed(self):
+        self.assertNotIn(self.battery.id,self.get_permissions(self.other)["edit"])
+        self.battery.contributors.add(self.other)
+        self.assertIn(self.battery.id,self.get_permissions(self.other)["edit"])
+        self.assertNotIn(self.battery.id,self.get_permissions(self.other)["delete"])
+        self.battery.contributors.clear()
+        self.assertNotIn(self.battery.id,self.get_permissions(self.other)["edit"])
+        self.other.battery_contributors.add(self.battery)
+        self.assertIn(self.battery.id,self.get_permissions(self.other)["edit"])
+
+    def test_role_changed(self):
+        self.assertEqual(self.get_permissions(self.other)["role"],None)
+        version = get_cache_version(USER_PERMISSIONS_CACHE,self.other.id)
+        role = UserRole.objects.create(user=self.other,role="LOCAL")
+        self.assertEqual(self.get_permissions(self.other)["role"],"LOCAL")
+        role.role = "MTURK"
+        role.save()
+        self.assertEqual(self.get_permissions(self.other)["role"],"MTURK")
+        self.assertNotEqual(get_cache_version(USER_PERMISSIONS_CACHE,self.other.id),version)
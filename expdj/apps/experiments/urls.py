@@ -13,7 +13,7 @@ from expdj.apps.experiments.views import (
     battery_results_dashboard, dummy_battery ,modify_experiment, intro_battery,
     save_survey_template, add_survey_template, add_game_template,
     save_game_template, enable_cookie_view, change_experiment_order,
-    serve_battery_gmail, subject_management
+    serve_battery_gmail, subject_management, battery_assignments
 )
 
 urlpatterns = patterns('',
@@ -60,6 +60,7 @@ urlpatterns = patterns('',
     #url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/results$',battery_results_dashboard,name='battery_results_dashboard'),
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/$',view_battery, name='battery_details'),
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/delete$',delete_battery,name='delete_battery'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/assignments/(?P<status>[a-z]+)$',battery_assignments,name='battery_assignments'),
 
     # Deployment
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/preview$',preview_battery,name='preview_battery'), # intro preview without subid
@@ -1,18 +1,22 @@
 from expdj.apps.experiments.models import Experiment, ExperimentTemplate, \
   CognitiveAtlasTask, CognitiveAtlasConcept, ExperimentVariable, ExperimentNumericVariable, \
-  ExperimentBooleanVariable, ExperimentStringVariable
-from expdj.settings import STATIC_ROOT,BASE_DIR,MEDIA_ROOT
+  ExperimentBooleanVariable, ExperimentStringVariable, experiment_templates_upserted
+from expdj.settings import (STATIC_ROOT,BASE_DIR,MEDIA_ROOT,EXPERIMENT_INSTALL_THREADS,
+                            COGNITIVE_ATLAS_TTL_DAYS,COGNITIVE_ATLAS_THREADS)
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
 from cognitiveatlas.api import get_task, get_concept
-from expfactory.vm import custom_battery_download
 from expfactory.experiment import get_experiments
 from expfactory.survey import export_questions
 from expfactory.utils import copy_directory
+from expdj.apps.experiments.versions import install_version
+from expdj.apps.experiments.mirror import checkout_repository, get_experiment_index, get_tree_hashes, update_mirror
+from expdj.apps.turk.archive import with_archived_results
 from expdj.apps.turk.models import Result
-from django.db.models import Min
 from numpy.random import choice
-from datetime import datetime
-from git import Repo
-import tempfile
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import collections
 import shutil
 import random
 import pandas
@@ -25,23 +29,24 @@ media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
 # EXPERIMENT FACTORY PYTHON FUNCTIONS #####################################################
 
 def get_experiment_selection(repo_type="experiments"):
-    tmpdir = custom_battery_download(repos=[repo_type])
-    experiments = get_experiments("%s/%s" %(tmpdir,repo_type),load=True,warning=False,repo_type=repo_type)
-    experiments = [x[0] for x in experiments]
-    shutil.rmtree(tmpdir)
-    return experiments
+    '''get_experiment_selection returns the config.json of the experiments available
+    to install, read from the local mirror of the repository (see mirror.py)
+    '''
+    return get_experiment_index(repo_type)
+
 
+# Installation folder: templates (from the config.json) installed there
+EXPERIMENT_TYPE_TEMPLATES = collections.OrderedDict([("experiments",["jspsych"]),
+                                                     ("surveys",["survey"]),
+                                                     ("games",["phaser"])])
 
 def get_experiment_type(experiment):
     '''get_experiment_type returns the installation folder (eg, games, surveys, experiments) based on the template specified in the config.json
     :param experiment: the ExperimentTemplate object
     '''
-    if experiment.template in ["jspsych"]:
-        return "experiments"
-    elif experiment.template in ["survey"]:
-        return "surveys"
-    elif experiment.template in ["phaser"]:
-        return "games"
+    for experiment_type,templates in EXPERIMENT_TYPE_TEMPLATES.items():
+        if experiment.template in templates:
+            return experiment_type
 
 
 def parse_experiment_variable(variable):
@@ -72,61 +77,127 @@ def parse_experiment_variable(variable):
 
 
 def install_experiments(experiment_tags=None,repo_type="experiments"):
+    '''install_experiments installs experiments from the latest commit of their
+    repository, returning the list of experiments that did not install successfully
+    '''
+    # The git commit is saved with the experiment as the "version"
+    commit = update_mirror(repo_type)
 
-    # We will return list of experiments that did not install successfully
-    errored_experiments = []
+    with checkout_repository(repo_type,commit) as tmpdir:
+        experiments = get_experiments(tmpdir,load=True,warning=False)
+        if experiment_tags != None:
+            experiments = [e for e in experiments if e[0]["exp_id"] in experiment_tags]
+        errored_experiments = install_experiment_folders(experiments,tmpdir,commit,repo_type)
 
-    tmpdir = custom_battery_download(repos=[repo_type,"battery"])
+    return errored_experiments
 
-    # The git commit is saved with the experiment as the "version"
-    repo = Repo("%s/%s" %(tmpdir,repo_type))
-    commit = repo.commit('master').__str__()
 
-    experiments = get_experiments("%s/%s" %(tmpdir,repo_type),load=True,warning=False)
-    if experiment_tags != None:
-        experiments = [e for e in experiments if e[0]["exp_id"] in experiment_tags]
+def install_experiment_folders(experiments,repo_folder,commit,repo_type="experiments"):
+    '''install_experiment_folders adds or updates experiment templates from a checkout
+    of their repository, returning the exp_ids that did not install. Experiments
+    whose folder (by git tree hash) is unchanged since they were installed are
+    skipped, changed folders are copied (to a new version, see versions.py) on a
+    thread pool, and the templates are written with one upsert.
+    '''
+    errored_experiments = []
+    content_hashes = get_tree_hashes(repo_type,commit)
+    installed_hashes = dict(ExperimentTemplate.objects.filter(exp_id__in=[e[0]["exp_id"] for e in experiments])
+                                                      .values_list('exp_id','content_hash'))
 
+    experiments = [e for e in experiments
+                   if installed_hashes.get(e[0]["exp_id"]) != content_hashes.get(e[0]["exp_id"])
+                   or not os.path.exists("%s/%s/%s" %(media_dir,repo_type,e[0]["exp_id"]))]
+    cognitive_atlas_tasks = get_cognitiveatlas_tasks([e[0].get("cognitive_atlas_task_id") for e in experiments])
+
+    templates = []
     for experiment in experiments:
+        exp_id = experiment[0]["exp_id"]
+        try:
+            cognitive_atlas_task = cognitive_atlas_tasks.get(experiment[0]["cognitive_atlas_task_id"])
+            templates.append(make_experiment_template(experiment[0],commit,content_hashes.get(exp_id),
+                                                      cognitive_atlas_task))
+        except:
+            errored_experiments.append(exp_id)
 
+    def copy_experiment(template):
         try:
-            performance_variable = None
-            rejection_variable = None
-            if "experiment_variables" in experiment[0]:
-                if isinstance(experiment[0]["experiment_variables"],list):
-                    for var in experiment[0]["experiment_variables"]:
-                        if var["type"].lower().strip() == "bonus":
-                            performance_variable = parse_experiment_variable(var)
-                        elif var["type"].lower().strip() == "credit":
-                            rejection_variable = parse_experiment_variable(var)
-                        else:
-                            parse_experiment_variable(var) # adds to database
-            if isinstance(experiment[0]["reference"],list):
-                reference = experiment[0]["reference"][0]
-            else:
-                reference = experiment[0]["reference"]
-            cognitive_atlas_task = get_cognitiveatlas_task(experiment[0]["cognitive_atlas_task_id"])
-            new_experiment,_ = ExperimentTemplate.objects.update_or_create(exp_id=experiment[0]["exp_id"],
-                                                                         defaults={"name":experiment[0]["name"],
-                                                                                   "cognitive_atlas_task":cognitive_atlas_task,
-                                                                                   "publish":bool(experiment[0]["publish"]),
-                                                                                   "time":experiment[0]["time"],
-                                                                                   "reference":reference,
-                                                                                   "version":commit,
-                                                                                   "template":experiment[0]["template"],
-                                                                                   "performance_variable":performance_variable,
-                                                                                   "rejection_variable":rejection_variable})
-            new_experiment.save()
-            experiment_folder = "%s/%s/%s" %(tmpdir,repo_type,experiment[0]["exp_id"])
-            output_folder = "%s/%s/%s" %(media_dir,repo_type,experiment[0]["exp_id"])
-            if os.path.exists(output_folder):
-                shutil.rmtree(output_folder)
-            copy_directory(experiment_folder,output_folder)
+            experiment_folder = "%s/%s" %(repo_folder,template.exp_id)
+            install_version(repo_type,template.exp_id,template.content_hash,experiment_folder)
+            return True
         except:
-            errored_experiments.append(experiment[0]["exp_id"])
+            return False
 
-    shutil.rmtree(tmpdir)
+    pool = ThreadPool(EXPERIMENT_INSTALL_THREADS)
+    try:
+        copied = pool.map(copy_experiment,templates)
+    finally:
+        pool.close()
+    errored_experiments += [t.exp_id for t,success in zip(templates,copied) if not success]
+    templates = [t for t,success in zip(templates,copied) if success]
+    errored_experiments += upsert_experiment_templates(templates)
     return errored_experiments
 
+
+def make_experiment_template(config,commit,content_hash=None,cognitive_atlas_task=None):
+    '''make_experiment_template returns an (unsaved) ExperimentTemplate for the
+    config.json of an experiment, adding its variables
+    :param cognitive_atlas_task: the CognitiveAtlasTask of the experiment
+    '''
+    performance_variable = None
+    rejection_variable = None
+    if "experiment_variables" in config:
+        if isinstance(config["experiment_variables"],list):
+            for var in config["experiment_variables"]:
+                if var["type"].lower().strip() == "bonus":
+                    performance_variable = parse_experiment_variable(var)
+                elif var["type"].lower().strip() == "credit":
+                    rejection_variable = parse_experiment_variable(var)
+                else:
+                    parse_experiment_variable(var) # adds to database
+    if isinstance(config["reference"],list):
+        reference = config["reference"][0]
+    else:
+        reference = config["reference"]
+    return ExperimentTemplate(exp_id=config["exp_id"],
+                              name=config["name"],
+                              cognitive_atlas_task=cognitive_atlas_task,
+                              publish=bool(config["publish"]),
+                              time=config["time"],
+                              reference=reference,
+                              version=commit,
+                              content_hash=content_hash,
+                              template=config["template"],
+                              performance_variable=performance_variable,
+                              rejection_variable=rejection_variable)
+
+
+def upsert_experiment_templates(templates):
+    '''upsert_experiment_templates inserts or updates experiment templates with one
+    INSERT ... ON CONFLICT, falling back to one upsert per template if that fails (eg,
+    a duplicate name), and returns the exp_ids that could not be saved
+    '''
+    if len(templates) == 0:
+        return []
+    errored_experiments = []
+    try:
+        with transaction.atomic():
+            bulk_upsert(ExperimentTemplate,templates)
+    except DatabaseError:
+        saved = []
+        for template in templates:
+            try:
+                with transaction.atomic():
+                    bulk_upsert(ExperimentTemplate,[template])
+                saved.append(template)
+            except DatabaseError:
+                errored_experiments.append(template.exp_id)
+        templates = saved
+
+    # The upsert doesn't send post_save, so cached template data is invalidated here
+    experiment_templates_upserted([t.exp_id for t in templates])
+    return errored_experiments
+
+
 # EXPERIMENTS AND BATTERIES ###############################################################
 
 def make_experiment_lookup(tags,battery=None):
@@ -163,7 +234,7 @@ def get_battery_results(battery,exp_id=None,clean=False):
     args = {"battery":battery}
     if exp_id != None:
         args["experiment__exp_id"] = exp_id
-    results = Result.objects.filter(**args)
+    results = with_archived_results(Result.objects.filter(**args),battery.id,exp_id)
     df = make_results_df(battery,results)
     if clean == True:
         columns_to_remove = [x for x in df.columns.tolist() if re.search("worker_|^battery_",x)]
@@ -246,30 +317,154 @@ def make_results_df(battery,results):
 
 
 # COGNITIVE ATLAS FUNCTIONS ###############################################################
+# CognitiveAtlasTask and CognitiveAtlasConcept are a local snapshot of the Cognitive
+# Atlas, refreshed from the API when older than COGNITIVE_ATLAS_TTL_DAYS. It can be
+# loaded from (and dumped to) a json file with the cognitiveatlas_snapshot command,
+# so experiments install offline.
+
+def is_stale(updated,now):
+    return updated == None or updated < now - timedelta(days=COGNITIVE_ATLAS_TTL_DAYS)
+
+
+def fits_field(model,field_name,value):
+    '''fits_field returns True if a value (from the API) can be saved to a CharField'''
+    return isinstance(value,basestring) and 0 < len(value) <= model._meta.get_field(field_name).max_length
+
+
+def is_valid_task(task):
+    concepts = task.get("concepts") or []
+    return (fits_field(CognitiveAtlasTask,"cog_atlas_id",task.get("id")) and
+            fits_field(CognitiveAtlasTask,"name",task.get("name")) and
+            isinstance(concepts,list) and all([isinstance(c,dict) and "concept_id" in c for c in concepts]))
+
+
+def is_valid_concept(concept):
+    return (fits_field(CognitiveAtlasConcept,"cog_atlas_id",concept.get("id")) and
+            fits_field(CognitiveAtlasConcept,"name",concept.get("name")) and
+            fits_field(CognitiveAtlasConcept,"definition",concept.get("definition_text")))
+
+
+def fetch_cognitiveatlas(fetch,cog_atlas_ids,is_valid):
+    '''fetch_cognitiveatlas calls the Cognitive Atlas API (get_task or get_concept) for
+    each id on a thread pool, and returns a dictionary of the json of those fetched.
+    Ids that can't be fetched, or return json that can't be saved, are left out, so
+    their stored copy is kept.
+    :param is_valid: is_valid_task or is_valid_concept, to check the json
+    '''
+    def fetch_one(cog_atlas_id):
+        try:
+            data = fetch(id=cog_atlas_id).json[0]
+            if isinstance(data,dict) and is_valid(data):
+                return cog_atlas_id,data
+        except:
+            pass
+        return cog_atlas_id,None
+
+    pool = ThreadPool(COGNITIVE_ATLAS_THREADS)
+    try:
+        fetched = pool.map(fetch_one,list(cog_atlas_ids))
+    finally:
+        pool.close()
+    return dict([(cog_atlas_id,data) for cog_atlas_id,data in fetched if data != None])
+
+
+def get_task_concept_ids(task):
+    return [concept["concept_id"] for concept in task.get("concepts") or []]
+
+
+def save_cognitiveatlas_snapshot(tasks,concepts,updated=None):
+    '''save_cognitiveatlas_snapshot writes tasks and concepts (as returned by the
+    Cognitive Atlas API) with bulk upserts, and replaces the concepts of the tasks
+    '''
+    if updated == None:
+        updated = timezone.now()
+    bulk_upsert(CognitiveAtlasConcept,[CognitiveAtlasConcept(cog_atlas_id=c["id"],
+                                                             name=c["name"],
+                                                             definition=c["definition_text"],
+                                                             updated=updated) for c in concepts])
+    bulk_upsert(CognitiveAtlasTask,[CognitiveAtlasTask(cog_atlas_id=t["id"],
+                                                       name=t["name"],
+                                                       updated=updated) for t in tasks])
+
+    TaskConcept = CognitiveAtlasTask.concepts.through
+    TaskConcept.objects.filter(cognitiveatlastask_id__in=[t["id"] for t in tasks]).delete()
+    concept_ids = set([c for t in tasks for c in get_task_concept_ids(t)])
+    concept_ids = set(CognitiveAtlasConcept.objects.filter(cog_atlas_id__in=concept_ids)
+                                                   .values_list('cog_atlas_id',flat=True))
+    TaskConcept.objects.bulk_create([TaskConcept(cognitiveatlastask_id=t["id"],cognitiveatlasconcept_id=c)
+                                     for t in tasks for c in set(get_task_concept_ids(t)) if c in concept_ids])
+
+
+def refresh_cognitiveatlas_tasks(task_ids,force=False):
+    '''refresh_cognitiveatlas_tasks fetches the tasks that are missing or stale, and
+    their missing or stale concepts (each fetched once, concurrently)
+    :param task_ids: the Cognitive Atlas ids of the tasks
+    :param force: fetch all of the tasks and their concepts
+    '''
+    now = timezone.now()
+    task_ids = set([t for t in task_ids if t])
+    stored = dict(CognitiveAtlasTask.objects.filter(cog_atlas_id__in=task_ids).values_list('cog_atlas_id','updated'))
+    tasks = fetch_cognitiveatlas(get_task,[t for t in task_ids if force or is_stale(stored.get(t),now)],
+                                 is_valid_task).values()
+    if len(tasks) == 0:
+        return
+
+    concept_ids = set([c for t in tasks for c in get_task_concept_ids(t)])
+    stored = dict(CognitiveAtlasConcept.objects.filter(cog_atlas_id__in=concept_ids).values_list('cog_atlas_id','updated'))
+    concepts = fetch_cognitiveatlas(get_concept,[c for c in concept_ids if force or is_stale(stored.get(c),now)],
+                                    is_valid_concept).values()
+    try:
+        with transaction.atomic():
+            save_cognitiveatlas_snapshot(tasks,concepts,now)
+    except DatabaseError:
+        pass # the stored snapshot is kept, and used to install
+
+
+def get_cognitiveatlas_tasks(task_ids):
+    '''get_cognitiveatlas_tasks returns a dictionary of the CognitiveAtlasTask of each
+    id, refreshing those missing or stale. A task the API doesn't return (and that
+    isn't in the snapshot) is left out.
+    :param task_ids: the unique ids for the cognitive atlas tasks
+    '''
+    refresh_cognitiveatlas_tasks(task_ids)
+    return CognitiveAtlasTask.objects.in_bulk([t for t in task_ids if t])
+
 
 def get_cognitiveatlas_task(task_id):
     '''get_cognitiveatlas_task
-    return the database entry for CognitiveAtlasTask if it exists, and update concepts for that task. If not, create it.
+    return the database entry for CognitiveAtlasTask, fetching or refreshing it (and its concepts) if needed,
+    or None if it can't be found.
     :param task_id: the unique id for the cognitive atlas task
     '''
-    try:
-        task = get_task(id=task_id).json[0]
-        cogatlas_task, _ = CognitiveAtlasTask.objects.update_or_create(cog_atlas_id=task["id"], defaults={"name":task["name"]})
-        concept_list = []
-        if "concepts" in task.keys():
-            for concept in task["concepts"]:
-                cogatlas_concept = get_concept(id=concept["concept_id"]).json[0]
-                cogatlas_concept, _ = CognitiveAtlasConcept.objects.update_or_create(cog_atlas_id=cogatlas_concept["id"],
-                                                        defaults={"name":cogatlas_concept["name"]},
-                                                        definition=cogatlas_concept["definition_text"])
-                cogatlas_concept.save()
-                concept_list.append(cogatlas_concept)
-        cogatlas_task.concepts = concept_list
-        cogatlas_task.save()
-        return cogatlas_task
-    except:
-        # Any error with API, etc, return None
-        return None
+    return get_cognitiveatlas_tasks([task_id]).get(task_id)
+
+
+def load_cognitiveatlas_snapshot(snapshot_file):
+    '''load_cognitiveatlas_snapshot saves the tasks and concepts of a json file, written
+    by dump_cognitiveatlas_snapshot, as just fetched
+    '''
+    with open(snapshot_file,"r") as filey:
+        snapshot = json.load(filey)
+    with transaction.atomic():
+        save_cognitiveatlas_snapshot(snapshot["tasks"],snapshot["concepts"])
+    return len(snapshot["tasks"]),len(snapshot["concepts"])
+
+
+def dump_cognitiveatlas_snapshot(snapshot_file):
+    '''dump_cognitiveatlas_snapshot writes the stored tasks and concepts to a json file,
+    in the format of the Cognitive Atlas API
+    '''
+    tasks = [{"id":task.cog_atlas_id,
+              "name":task.name,
+              "concepts":[{"concept_id":c} for c in task.concepts.values_list('cog_atlas_id',flat=True)]}
+             for task in CognitiveAtlasTask.objects.all()]
+    concepts = [{"id":concept.cog_atlas_id,
+                 "name":concept.name,
+                 "definition_text":concept.definition}
+                for concept in CognitiveAtlasConcept.objects.all()]
+    with open(snapshot_file,"w") as filey:
+        json.dump({"tasks":tasks,"concepts":concepts},filey,indent=4)
+    return len(tasks),len(concepts)
 
 # BONUS AND REJECTION CREDIT ##############################################################
 
@@ -298,26 +493,40 @@ def select_random_n(experiments,N):
     '''
     if N>len(experiments):
         N=len(experiments)
-    return choice(experiments,N).tolist()
+    # Choose indices, experiments may be tuples (see snapshot.py)
+    experiments = list(experiments)
+    return [experiments[i] for i in choice(len(experiments),N)]
 
 
 def select_ordered(experiments,selection_number=1):
     '''select_ordered will return a list of the next "selection_number"
     of experiments. Lower numbers are returned first, and if multiple numbers
     are specified for orders, these will be selected from randomly.
-    :param experiments: the list of Experiment objects to select from
+    :param experiments: the list of Experiment objects (or SnapshotExperiments) to select from
     :param selection_number: the number of experiments to choose (default 1)
     '''
-    next_value = experiments.aggregate(Min('order'))["order__min"]
+    next_value = min([e.order for e in experiments])
     experiment_choices = [e for e in experiments if e.order == next_value]
     return select_random_n(experiment_choices,selection_number)
 
 
+def get_battery_intro(battery,show_advertisement=True):
+
+    instruction_forms = []
+
+    # !Important: title for consent instructions must be "Consent" - see instructions_modal.html if you change
+    if show_advertisement == True:
+        if battery.advertisement != None: instruction_forms.append({"title":"Advertisement","html":battery.advertisement})
+    if battery.consent != None: instruction_forms.append({"title":"Consent","html":battery.consent})
+    if battery.instructions != None: instruction_forms.append({"title":"Instructions","html":battery.instructions})
+    return instruction_forms
+
+
 def select_experiments(battery,uncompleted_experiments,selection_number=1):
     '''select_experiments selects experiments based on the presentation_order variable
     defined in the battery (random or specific)
-    :param battery: the battery object
-    :param uncompleted_experiments: a list of Experiment objects to select from
+    :param battery: the battery object, or its BatterySnapshot
+    :param uncompleted_experiments: a list of Experiment objects (or SnapshotExperiments) to select from
     :param selection_number: the number of experiments to select
     '''
     if battery.presentation_order == "random":
@@ -327,6 +536,21 @@ def select_experiments(battery,uncompleted_experiments,selection_number=1):
     return task_list
 
 
+def get_next_experiments(battery,uncompleted_experiments,task_list):
+    '''get_next_experiments returns the experiments that can be selected after those
+    being served: the next in a specified order, or any remaining in a random one
+    :param battery: the battery object, or its BatterySnapshot
+    :param uncompleted_experiments: the experiments the task_list was selected from
+    :param task_list: the experiments being served
+    '''
+    served = [e.exp_id for e in task_list]
+    remaining = [e for e in uncompleted_experiments if e.exp_id not in served]
+    if len(remaining) == 0 or battery.presentation_order != "specified":
+        return remaining
+    next_value = min([e.order for e in remaining])
+    return [e for e in remaining if e.order == next_value]
+
+
 def select_experiments_time(maximum_time_allowed,experiments):
     '''select_experiments_time
     a selection algorithm that selects experiments from list based on not exceeding some max time
@@ -376,3 +600,27 @@ def complete_survey_result(exp_id,taskdata):
            complete_question = {"response":quesval[0]}
         final_data[queskey] = complete_question
     return final_data
+
+
+def bulk_upsert(model,objects,batch_size=500):
+    '''bulk_upsert inserts objects, or updates all their fields if they exist, with
+    INSERT ... ON CONFLICT on the primary key (for batch_size objects at once). It
+    doesn't send save signals.
+    :param model: the model of the (unsaved) objects
+    '''
+    fields = model._meta.concrete_fields
+    columns = [connection.ops.quote_name(f.column) for f in fields]
+    updates = ["%s = EXCLUDED.%s" %(c,c) for f,c in zip(fields,columns) if not f.primary_key]
+    row = "(%s)" %(",".join(["%s"] * len(fields)))
+    for start in range(0,len(objects),batch_size):
+        batch = objects[start:start+batch_size]
+        params = []
+        for instance in batch:
+            params += [f.get_db_prep_save(getattr(instance,f.attname),connection) for f in fields]
+        with connection.cursor() as cursor:
+            cursor.execute('''INSERT INTO %s (%s) VALUES %s
+                              ON CONFLICT (%s) DO UPDATE SET %s'''
+                           %(connection.ops.quote_name(model._meta.db_table),",".join(columns),
+                             ",".join([row] * len(batch)),
+                             connection.ops.quote_name(model._meta.pk.column),", ".join(updates)),
+                           params)
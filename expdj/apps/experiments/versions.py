@@ -0,0 +1,168 @@
+'''versions.py: installed experiment folders, one per version
+
+Each installed version of an experiment is copied to its own folder, named by
+its content hash (the git tree hash of the experiment folder), under
+MEDIA_ROOT/<type>/.versions/<exp_id>/. MEDIA_ROOT/<type>/<exp_id> is a symlink
+to the current version, swapped atomically (rename) on install, so a
+participant is never served a half copied experiment. A version's files never
+change, so they are served from its versioned URL, fingerprinted and
+precompressed (see assets.py), with immutable cache headers (see nginx.conf).
+The previous versions (up to EXPERIMENT_VERSIONS_KEPT) are kept for pages
+still loading them, older ones are removed.
+'''
+
+from expdj.apps.experiments.assets import build_assets, collect_shared_assets, get_manifest
+from expdj.apps.experiments.cache import EXPERIMENT_TEMPLATE_CACHE, get_or_set_versioned
+from expdj.settings import BASE_DIR,MEDIA_ROOT,MEDIA_URL,EXPERIMENT_VERSIONS_KEPT
+from expfactory.battery import get_load_static
+from expfactory.utils import copy_directory
+import shutil
+import os
+import re
+
+media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
+
+VERSIONS_FOLDER = ".versions"
+
+
+def get_experiment_folder(experiment_type,exp_id):
+    return os.path.join(media_dir,experiment_type,exp_id)
+
+
+def get_versions_folder(experiment_type,exp_id):
+    return os.path.join(media_dir,experiment_type,VERSIONS_FOLDER,exp_id)
+
+
+def get_experiment_url(experiment_type,exp_id,content_hash=None):
+    '''get_experiment_url returns the url of the folder of an experiment version, or
+    of its current version if the version isn't known
+    '''
+    if content_hash == None:
+        return "%s%s/%s/" %(MEDIA_URL,experiment_type,exp_id)
+    return "%s%s/%s/%s/%s/" %(MEDIA_URL,experiment_type,VERSIONS_FOLDER,exp_id,content_hash)
+
+
+def install_version(experiment_type,exp_id,content_hash,source_folder):
+    '''install_version copies an experiment folder to the folder of its version (if
+    it isn't there already) and makes it the current version
+    :param content_hash: the git tree hash of the experiment folder
+    :param source_folder: the experiment folder in a checkout of its repository
+    '''
+    version_folder = os.path.join(get_versions_folder(experiment_type,exp_id),content_hash)
+    if not os.path.exists(version_folder):
+        tmp_folder = "%s.tmp%s" %(version_folder,os.getpid())
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        copy_directory(source_folder,tmp_folder)
+        build_assets(tmp_folder)
+        os.rename(tmp_folder,version_folder)
+    activate_version(experiment_type,exp_id,content_hash)
+    collect_versions(experiment_type,exp_id)
+
+
+def activate_version(experiment_type,exp_id,content_hash):
+    '''activate_version points the experiment folder at a version, with a new symlink
+    renamed over the old one
+    '''
+    experiment_folder = get_experiment_folder(experiment_type,exp_id)
+    if os.path.isdir(experiment_folder) and not os.path.islink(experiment_folder):
+        # A folder installed before versions, moved aside to be collected
+        os.rename(experiment_folder,os.path.join(get_versions_folder(experiment_type,exp_id),"unversioned"))
+    link = "%s.tmp%s" %(experiment_folder,os.getpid())
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.join(VERSIONS_FOLDER,exp_id,content_hash),link)
+    os.rename(link,experiment_folder)
+
+
+def get_current_version(experiment_type,exp_id):
+    experiment_folder = get_experiment_folder(experiment_type,exp_id)
+    if os.path.islink(experiment_folder):
+        return os.path.basename(os.readlink(experiment_folder))
+
+
+def collect_versions(experiment_type,exp_id,keep=EXPERIMENT_VERSIONS_KEPT):
+    '''collect_versions removes the folders of all but the current and latest
+    previous versions of an experiment, and the shared files only they used
+    :param keep: the number of versions to keep, including the current one
+    '''
+    versions_folder = get_versions_folder(experiment_type,exp_id)
+    current = get_current_version(experiment_type,exp_id)
+    versions = [v for v in os.listdir(versions_folder) if v != current and ".tmp" not in v]
+    versions.sort(key=lambda v: os.path.getmtime(os.path.join(versions_folder,v)),reverse=True)
+    for version in versions[max(keep-1,0):]:
+        shutil.rmtree(os.path.join(versions_folder,version))
+    collect_shared_assets()
+
+
+def remove_experiment(experiment_type,exp_id):
+    '''remove_experiment removes the experiment folder and all its versions'''
+    experiment_folder = get_experiment_folder(experiment_type,exp_id)
+    if os.path.islink(experiment_folder):
+        os.remove(experiment_folder)
+    elif os.path.exists(experiment_folder):
+        shutil.rmtree(experiment_folder)
+    versions_folder = get_versions_folder(experiment_type,exp_id)
+    if os.path.exists(versions_folder):
+        shutil.rmtree(versions_folder)
+    collect_shared_assets()
+
+
+def use_asset_urls(html,experiment_type,experiments):
+    '''use_asset_urls replaces the urls of experiment files in html with the urls of
+    their shared or fingerprinted copies (see assets.py), which never change
+    :param experiments: objects with the exp_id and content_hash of the experiments
+    '''
+    for experiment in experiments:
+        if experiment.content_hash == None:
+            continue
+        url = get_experiment_url(experiment_type,experiment.exp_id)
+        version_url = get_experiment_url(experiment_type,experiment.exp_id,experiment.content_hash)
+        manifest = get_manifest(os.path.join(get_versions_folder(experiment_type,experiment.exp_id),
+                                             experiment.content_hash))
+        def use_asset_url(match,manifest=manifest,version_url=version_url):
+            asset_url = manifest.get(match.group(2),match.group(2))
+            if not asset_url.startswith(MEDIA_URL):
+                # a path in the version folder, rather than the url of a shared file
+                asset_url = "%s%s" %(version_url,asset_url)
+            return "%s%s%s" %(match.group(1),asset_url,match.group(1))
+        html = re.sub("""(["'])%s([^"']+)\\1""" %(re.escape(url)),use_asset_url,html)
+    return html
+
+
+def get_experiment_load(experiment_type,experiments):
+    '''get_experiment_load returns the script and style tags that load experiments,
+    from the fingerprinted files of their versions
+    :param experiments: objects with the exp_id and content_hash of the experiments
+    '''
+    experiment_folders = [get_experiment_folder(experiment_type,e.exp_id) for e in experiments]
+    return use_asset_urls(get_load_static(experiment_folders,url_prefix="/"),experiment_type,experiments)
+
+
+def get_asset_urls(experiment_type,experiment):
+    '''get_asset_urls returns the urls of the scripts and styles loaded by an experiment
+    :param experiment: an object with the exp_id and content_hash of the experiment
+    '''
+    def find_asset_urls():
+        return re.findall("""(?:src|href)=["']([^"']+)["']""",get_experiment_load(experiment_type,[experiment]))
+    return get_or_set_versioned(EXPERIMENT_TEMPLATE_CACHE,experiment.exp_id,"asset_urls",find_asset_urls)
+
+
+def get_next_asset_urls(next_experiments):
+    '''get_next_asset_urls returns the urls loaded by every one of the experiments that
+    can be served next (all of them, if there is only one)
+    :param next_experiments: SnapshotExperiments, see utils.get_next_experiments
+    '''
+    if len(next_experiments) == 0:
+        return []
+    asset_urls = [get_asset_urls(e.experiment_type,e) for e in next_experiments]
+    return [url for url in asset_urls[0] if all([url in urls for urls in asset_urls[1:]])]
+
+
+def get_link_header(preload_urls,prefetch_urls):
+    '''get_link_header returns a Link header preloading the assets of the page, and
+    prefetching those of the next page
+    '''
+    links = ["<%s>; rel=preload; as=%s" %(url,"style" if url.endswith(".css") else "script") for url in preload_urls]
+    links += ["<%s>; rel=prefetch" %(url) for url in prefetch_urls if url not in preload_urls]
+    return ", ".join(links)
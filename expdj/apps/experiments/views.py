@@ -15,7 +15,10 @@ from expfactory.experiment import load_experiment
 from expfactory.views import embed_experiment
 
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import transaction
 from django.forms.models import model_to_dict
 from django.http import HttpResponse, JsonResponse
 from django.http.response import (
@@ -38,25 +41,63 @@ from expdj.apps.experiments.models import (
 from expdj.apps.experiments.utils import (
     get_experiment_selection, install_experiments, update_credits, 
     make_results_df, get_battery_results, get_experiment_type, remove_keys, 
-    complete_survey_result, select_experiments
+    complete_survey_result, select_experiments, get_battery_intro, get_next_experiments
 )
-from expdj.settings import BASE_DIR,STATIC_ROOT,MEDIA_ROOT,DOMAIN_NAME
+from expdj.apps.experiments.cache import (BATTERY_CACHE, USER_PERMISSIONS_CACHE, bump_cache_version,
+    get_or_set_versioned)
+from expdj.apps.experiments.snapshot import get_battery_snapshot
+from expdj.apps.experiments.versions import (get_asset_urls, get_experiment_load, get_link_header,
+    get_next_asset_urls)
+from expdj.settings import BASE_DIR,STATIC_ROOT,MEDIA_ROOT,DOMAIN_NAME,EXPERIMENT_PREFETCH_HINTS
 import expdj.settings as settings
 from expdj.apps.turk.models import (
-    HIT, Result, Assignment, get_worker, Blacklist, Bonus
+    HIT, Result, Assignment, get_worker, Blacklist, Bonus, is_blacklisted,
+    get_assignment_summary, assignment_summary_lookup, upsert_result, ArchivedResult
 )
 from expdj.apps.turk.tasks import (
-    assign_experiment_credit, update_assignments, check_blacklist, 
-    experiment_reward, check_battery_dependencies
+    assign_experiment_credit, update_assignments, evaluate_credit,
+    check_battery_dependencies, rescore_battery, purge_battery,
+    purge_experiment_template
 )
-from expdj.apps.turk.utils import get_worker_experiments
+from expdj.apps.turk.archive import with_archived_results
+from expdj.apps.turk.utils import get_snapshot_experiments
 from expdj.apps.users.models import User
+from expdj.db_router import read_from_replica
 
 
 media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
 
+# Battery details: assignments per page, and seconds between assignment updates
+ASSIGNMENTS_PER_PAGE = 50
+ASSIGNMENT_UPDATE_SECONDS = 300
+
 ### AUTHENTICATION ####################################################
 
+def build_user_permissions(user):
+    '''build_user_permissions returns the role of a user, and the ids of the
+    batteries they can edit (owner or contributor) and delete (owner)
+    '''
+    owned = set(Battery.objects.filter(owner=user).values_list('id',flat=True))
+    contributed = set(Battery.objects.filter(contributors=user).values_list('id',flat=True))
+    roles = list(User.objects.filter(user=user).values_list('role',flat=True)[:1])
+    return {"role":roles[0] if len(roles) > 0 else None,
+            "edit":frozenset(owned | contributed),
+            "delete":frozenset(owned)}
+
+def get_user_permissions(request):
+    '''get_user_permissions returns the permission set of the request user,
+    memoized on the request and cached across requests under the user's version,
+    which is bumped when their batteries, contributions or role change
+    '''
+    if not hasattr(request,"_user_permissions"):
+        user = request.user
+        if user.is_anonymous():
+            request._user_permissions = {"role":None,"edit":frozenset(),"delete":frozenset()}
+        else:
+            request._user_permissions = get_or_set_versioned(USER_PERMISSIONS_CACHE,user.pk,"permissions",
+                                                             lambda: build_user_permissions(user))
+    return request._user_permissions
+
 def check_experiment_edit_permission(request):
     if request.user.is_superuser:
         return True
@@ -65,29 +106,16 @@ def check_experiment_edit_permission(request):
 def check_mturk_access(request):
     if request.user.is_superuser:
         return True
-
-    user_roles = User.objects.filter(user=request.user)
-    if len(user_roles) == 0:
-        return False
-    elif user_roles[0].role == "MTURK":
-        return True
-    return False
+    return get_user_permissions(request)["role"] == "MTURK"
 
 def check_battery_create_permission(request):
-    if not request.user.is_anonymous():
-        if request.user.is_superuser:
-            return True
-
-    user_roles = User.objects.filter(user=request.user)
-    if len(user_roles) == 0:
-        return False
-    elif user_roles[0].role in ["MTURK","LOCAL"]:
+    if request.user.is_superuser:
         return True
-    return False
+    return get_user_permissions(request)["role"] in ["MTURK","LOCAL"]
 
 def check_battery_delete_permission(request,battery):
     if not request.user.is_anonymous():
-        if request.user == battery.owner:
+        if battery.id in get_user_permissions(request)["delete"]:
             return True
         if request.user.is_superuser:
             return True
@@ -95,7 +123,7 @@ def check_battery_delete_permission(request,battery):
 
 def check_battery_edit_permission(request,battery):
     if not request.user.is_anonymous():
-        if request.user == battery.owner or request.user in battery.contributors.all():
+        if battery.id in get_user_permissions(request)["edit"]:
             return True
         if request.user.is_superuser:
             return True
@@ -132,8 +160,17 @@ def get_battery(bid,request):
     except Battery.DoesNotExist:
         raise Http404
     else:
+        if battery.pending_deletion == True:
+            raise Http404
         return battery
 
+# get the cached battery snapshot, for the serve path
+def get_battery_snapshot_or_404(bid):
+    snapshot = get_battery_snapshot(bid)
+    if snapshot == None:
+        raise Http404
+    return snapshot
+
 
 #### VIEWS #############################################################
 
@@ -189,12 +226,13 @@ def view_experiment(request, eid, bid=None):
 def view_battery(request, bid):
     battery = get_battery(bid,request)
 
-    # Get associated HITS, update all
+    # Get associated HITS
     hits = HIT.objects.filter(battery=battery)
 
-    # Use task to update assignments
-    for hit in hits:
-        update_assignments.apply_async([hit.id])
+    # Use task to update assignments, at most every few minutes per battery
+    if cache.add("expdj:update_assignments:%s" %(battery.id),True,ASSIGNMENT_UPDATE_SECONDS):
+        for hit_id in hits.values_list('id',flat=True):
+            update_assignments.apply_async([hit_id])
 
     # Generate anonymous link
     anon_link = "%s/batteries/%s/%s/anon" %(DOMAIN_NAME,bid,hashlib.md5(battery.name).hexdigest())
@@ -207,12 +245,8 @@ def view_battery(request, bid):
     delete_permission = check_battery_edit_permission(request,battery)
     mturk_permission = check_mturk_access(request)
 
-    # Render assignment details
-    assignments = dict()
-    assignments["accepted"] = [a for a in Assignment.objects.filter(hit__battery=battery) if a.status == "A"]
-    assignments["none"] = [a for a in Assignment.objects.filter(hit__battery=battery) if a.status == None]
-    assignments["submit"] = [a for a in Assignment.objects.filter(hit__battery=battery) if a.status == "S"]
-    assignments["rejected"] = [a for a in Assignment.objects.filter(hit__battery=battery) if a.status == "R"]
+    # Assignment counts by status, the lists are loaded by battery_assignments
+    assignment_counts = get_assignment_summary(battery.id)
 
     context = {'battery': battery,
                'edit_permission':edit_permission,
@@ -221,11 +255,43 @@ def view_battery(request, bid):
                'hits':hits,
                'anon_link':anon_link,
                'gmail_link':gmail_link,
-               'assignments':assignments}
+               'assignment_counts':assignment_counts}
 
     return render(request,'experiments/battery_details.html', context)
 
 
+@login_required
+def battery_assignments(request, bid, status):
+    '''battery_assignments renders one page of the battery assignments with a
+    status (accepted, submit, rejected, none), loaded into the battery details
+    :param bid: the battery id
+    :param status: the assignment status name
+    '''
+    battery = get_battery(bid,request)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+
+    status_lookup = dict((v,k) for k,v in assignment_summary_lookup.items())
+    if status not in status_lookup:
+        raise Http404
+
+    assignments = Assignment.objects.filter(hit__battery=battery,status=status_lookup[status])
+    assignments = assignments.select_related('hit').only('id','mturk_id','worker','hit','status','accept_time',
+                                                          'submit_time','completed','hit__id','hit__title')
+    paginator = Paginator(assignments.order_by('-id'),ASSIGNMENTS_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('page',1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+
+    context = {'battery':battery,
+               'status':status,
+               'assignments':page}
+    return render(request,'experiments/battery_assignments.html', context)
+
+
 # All experiments
 def experiments_view(request):
     experiments = ExperimentTemplate.objects.all()
@@ -238,10 +304,9 @@ def experiments_view(request):
 # All batteries
 @login_required
 def batteries_view(request,uid=None):
-    if not uid:
-        batteries = Battery.objects.all()
-    else:
-        batteries = Battery.objects.filter(owner_id=uid)
+    batteries = Battery.objects.filter(pending_deletion=False)
+    if uid:
+        batteries = batteries.filter(owner_id=uid)
     generate_battery_permission = False
     context = {'batteries': batteries}
     return render(request, 'experiments/all_batteries.html', context)
@@ -285,18 +350,6 @@ def generate_battery_user(request,bid):
     else:
             return HttpResponseRedirect(battery.get_absolute_url())
 
-def get_battery_intro(battery,show_advertisement=True):
-
-    instruction_forms = []
-
-    # !Important: title for consent instructions must be "Consent" - see instructions_modal.html if you change
-    if show_advertisement == True:
-        if battery.advertisement != None: instruction_forms.append({"title":"Advertisement","html":battery.advertisement})
-    if battery.consent != None: instruction_forms.append({"title":"Consent","html":battery.consent})
-    if battery.instructions != None: instruction_forms.append({"title":"Instructions","html":battery.instructions})
-    return instruction_forms
-
-
 def serve_battery_anon(request,bid,keyid):
     '''serve an anonymous local battery, userid is generated upon going to link'''
     # Check if the keyid is correct
@@ -336,8 +389,8 @@ def preview_battery(request,bid):
 
     if request.user_agent.is_pc:
 
-        battery = get_battery(bid,request)
-        context = {"instruction_forms":get_battery_intro(battery),
+        battery = get_battery_snapshot_or_404(bid)
+        context = {"instruction_forms":battery.intro,
                    "start_url":"/batteries/%s/dummy" %(bid),
                    "assignment_id":"assenav tahcos"}
 
@@ -352,8 +405,8 @@ def intro_battery(request,bid,userid=None):
 
     if request.user_agent.is_pc:
 
-        battery = get_battery(bid,request)
-        context = {"instruction_forms":get_battery_intro(battery),
+        battery = get_battery_snapshot_or_404(bid)
+        context = {"instruction_forms":battery.intro,
                    "start_url":"/batteries/%s/%s/accept" %(bid,userid),
                    "assignment_id":"assenav tahcos"}
 
@@ -363,14 +416,13 @@ def intro_battery(request,bid,userid=None):
 def dummy_battery(request,bid):
     '''dummy_battery lets the user run a faux battery (preview)'''
 
-    battery = get_battery(bid,request)
+    battery = get_battery_snapshot_or_404(bid)
     deployment = "docker-local"
 
     # Does the worker have experiments remaining?
-    task_list = select_experiments(battery,uncompleted_experiments=battery.experiments.all())
-    experimentTemplate = ExperimentTemplate.objects.filter(exp_id=task_list[0].template.exp_id)[0]
-    experiment_type = get_experiment_type(experimentTemplate)
-    task_list = battery.experiments.filter(template=experimentTemplate)
+    task_list = select_experiments(battery,uncompleted_experiments=battery.experiments)
+    experiment_type = task_list[0].experiment_type
+    task_list = battery.get_experiments(exp_ids=[task_list[0].exp_id])
     result = None
     context = {"worker_id": "Dummy Worker"}
     if experiment_type in ["games","surveys"]:
@@ -392,7 +444,7 @@ def serve_battery(request,bid,userid=None):
     '''prepare for local serve of battery'''
 
     next_page = None
-    battery = get_battery(bid,request)
+    battery = get_battery_snapshot_or_404(bid)
 
     # No robots allowed!
     if request.user_agent.is_bot:
@@ -406,13 +458,14 @@ def serve_battery(request,bid,userid=None):
     if isinstance(worker,list): # no id means returning []
         return render_to_response("turk/invalid_id_sorry.html")
 
-    missing_batteries, blocking_batteries = check_battery_dependencies(battery, userid)
-    if missing_batteries or blocking_batteries:
-        return render_to_response(
-            "turk/battery_requirements_not_met.html",
-            context={'missing_batteries': missing_batteries,
-                     'blocking_batteries': blocking_batteries}
-        )
+    if battery.has_dependencies():
+        missing_batteries, blocking_batteries = check_battery_dependencies(Battery.objects.get(id=battery.id), userid)
+        if missing_batteries or blocking_batteries:
+            return render_to_response(
+                "turk/battery_requirements_not_met.html",
+                context={'missing_batteries': missing_batteries,
+                         'blocking_batteries': blocking_batteries}
+            )
 
 
     # Try to get some info about browser, language, etc.
@@ -421,23 +474,21 @@ def serve_battery(request,bid,userid=None):
     deployment = "docker-local"
 
     # Does the worker have experiments remaining?
-    uncompleted_experiments = get_worker_experiments(worker,battery)
+    uncompleted_experiments = get_snapshot_experiments(worker,battery)
     experiments_left = len(uncompleted_experiments)
     if  experiments_left == 0:
         # Thank you for your participation - no more experiments!
         return render_to_response("turk/worker_sorry.html")
 
     task_list = select_experiments(battery,uncompleted_experiments)
-    experimentTemplate = ExperimentTemplate.objects.filter(exp_id=task_list[0].template.exp_id)[0]
-    experiment_type = get_experiment_type(experimentTemplate)
-    task_list = battery.experiments.filter(template=experimentTemplate)
+    experiment_type = task_list[0].experiment_type
+    task_list = battery.get_experiments(exp_ids=[task_list[0].exp_id])
 
     # Generate a new results object for the worker, assignment, experiment
-    result,_ = Result.objects.update_or_create(worker=worker,
-                                               experiment=experimentTemplate,
-                                               battery=battery,
-                                               defaults={"browser":browser,"platform":platform})
-    result.save()
+    result = upsert_result(worker=worker,
+                           experiment_id=task_list[0].exp_id,
+                           battery_id=battery.id,
+                           defaults={"browser":browser,"platform":platform})
 
     context = {"worker_id": worker.id,
                "uniqueId":result.id}
@@ -458,51 +509,53 @@ def serve_battery(request,bid,userid=None):
         template=template,
         next_page=next_page,
         result=result,
-        experiments_left=experiments_left-1
+        experiments_left=experiments_left-1,
+        next_experiments=get_next_experiments(battery,uncompleted_experiments,task_list)
     )
 
 def deploy_battery(deployment, battery, experiment_type, context, task_list, 
                    template, result, next_page=None, last_experiment=False, 
-                   experiments_left=None):
+                   experiments_left=None, next_experiments=None):
     '''deploy_battery is a general function for returning the final view to deploy a battery, either local or MTurk
     :param deployment: either "docker-mturk" or "docker-local"
-    :param battery: models.Battery object
+    :param battery: the snapshot.BatterySnapshot of the battery
     :param experiment_type: experiments,games,or surveys
     :param context: context, which should already include next_page,
     :param next_page: the next page to navigate to [optional] default is to reload the page to go to the next experiment
-    :param task_list: list of models.Experiment instances
+    :param task_list: list of snapshot.SnapshotExperiment
     :param template: html template to render
     :param result: the result object, turk.models.Result
     :param last_experiment: boolean if true will redirect the user to a page to submit the result (for surveys)
     :param experiments_left: integer indicating how many experiments are left in battery.
+    :param next_experiments: list of snapshot.SnapshotExperiment that can be served next, to prefetch their assets
     '''
     if next_page == None:
         next_page = "javascript:window.location.reload();"
     context["next_page"] = next_page
 
     # Check the user blacklist status
-    try:
-        blacklist = Blacklist.objects.get(worker=result.worker,battery=battery)
-        if blacklist.active == True:
-            return render_to_response("experiments/blacklist.html")
-    except:
-        pass
+    if result != None and is_blacklisted(result.worker_id,battery.id):
+        return render_to_response("experiments/blacklist.html")
 
     # Get experiment folders
-    experiment_folders = [os.path.join(media_dir,experiment_type,x.template.exp_id) for x in task_list]
-    context["experiment_load"] = get_load_static(experiment_folders,url_prefix="/")
+    experiment_folders = [os.path.join(media_dir,experiment_type,x.exp_id) for x in task_list]
+    context["experiment_load"] = get_experiment_load(experiment_type,task_list)
+    preload_urls = get_asset_urls(experiment_type,task_list[0])
+    prefetch_urls = get_next_asset_urls(next_experiments or [])
+    if EXPERIMENT_PREFETCH_HINTS:
+        context["experiment_prefetch"] = "\n".join(["<link rel='prefetch' href='%s'>" %(url) for url in prefetch_urls])
 
     # Get code to run the experiment (not in external file)
     runcode = ""
 
     # Experiments templates
     if experiment_type in ["experiments"]:
-        runcode = get_experiment_run(experiment_folders,deployment=deployment)[task_list[0].template.exp_id]
+        runcode = get_experiment_run(experiment_folders,deployment=deployment)[task_list[0].exp_id]
         if result != None:
             runcode = runcode.replace("{{result.id}}",str(result.id))
         runcode = runcode.replace("{{next_page}}",next_page)
         if experiments_left is not None:
-            total_experiments = battery.experiments.count()
+            total_experiments = battery.experiment_count
             expleft_msg = "</p><p>Experiments left in battery {0:d} out of {1:d}</p>"
             expleft_msg = expleft_msg.format(experiments_left, total_experiments)
             runcode = runcode.replace("</p>", expleft_msg)
@@ -539,6 +592,10 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
 
     # without this header, the iFrame will not render in Amazon
     response['x-frame-options'] = 'this_can_be_anything'
+
+    # start loading the experiment, and the next one, before the page is parsed
+    if len(preload_urls) > 0 or len(prefetch_urls) > 0:
+        response['Link'] = get_link_header(preload_urls,prefetch_urls)
     return response
 
 # These views are to work with backbone.js
@@ -553,49 +610,52 @@ def sync(request,rid=None):
 
         if rid != None:
         # Update the result, already has worker and assignment ID stored
-            result,_ = Result.objects.get_or_create(id=rid)
-            battery = result.battery
-            experiment_template = get_experiment_type(result.experiment)
-            if experiment_template == "experiments":
-                data = json.loads(request.body)
-                result.taskdata = data["taskdata"]["data"]
-                result.current_trial = data["taskdata"]["currenttrial"]
-                djstatus = data["djstatus"]
-            elif experiment_template == "games":
-                data = json.loads(request.body)
-                redirect_url = data["redirect_url"]
-                result.taskdata = data["taskdata"]
-                djstatus = data["djstatus"]
-            elif experiment_template == "surveys":
-                data = request.POST
-                redirect_url = data["url"]
-                djstatus = data["djstatus"]
-                # Remove keys we don't want
-                data = remove_keys(data,["process","csrfmiddlewaretoken","url","djstatus"])
-                result.taskdata = complete_survey_result(result.experiment.exp_id,data)
-
-            result.save()
-
-            # if the worker finished the current experiment
-            if djstatus == "FINISHED":
-
-                # Mark experiment as completed
-                result.completed = True
-                result.finishtime = timezone.now()
-                result.version = result.experiment.version
+        # The result is locked so parallel syncs (eg, two tabs) apply in turn
+            with transaction.atomic():
+                try:
+                    result = Result.objects.select_for_update().select_related('experiment','battery').get(id=rid)
+                except Result.DoesNotExist:
+                    raise Http404
+                battery = result.battery
+                experiment_template = get_experiment_type(result.experiment)
+                if experiment_template == "experiments":
+                    data = json.loads(request.body)
+                    result.taskdata = data["taskdata"]["data"]
+                    result.current_trial = data["taskdata"]["currenttrial"]
+                    djstatus = data["djstatus"]
+                elif experiment_template == "games":
+                    data = json.loads(request.body)
+                    redirect_url = data["redirect_url"]
+                    result.taskdata = data["taskdata"]
+                    djstatus = data["djstatus"]
+                elif experiment_template == "surveys":
+                    data = request.POST
+                    redirect_url = data["url"]
+                    djstatus = data["djstatus"]
+                    # Remove keys we don't want
+                    data = remove_keys(data,["process","csrfmiddlewaretoken","url","djstatus"])
+                    result.taskdata = complete_survey_result(result.experiment.exp_id,data)
+
+                # if the worker finished the current experiment, mark it completed
+                if djstatus == "FINISHED":
+                    result.completed = True
+                    result.finishtime = timezone.now()
+                    result.version = result.experiment.version
                 result.save()
 
-                # Fire a task to check blacklist status, add bonus
-                check_blacklist.apply_async([result.id])
-                experiment_reward.apply_async([result.id])
+            if djstatus == "FINISHED":
+
+                # Fire a task to check blacklist status and add bonus
+                evaluate_credit.apply_async([result.id])
 
                 data = dict()
                 data["finished_battery"] = "NOTFINISHED"
                 data["djstatus"] = djstatus
-                completed_experiments = get_worker_experiments(result.worker,battery,completed=True)
-                completed_experiments = numpy.unique([x.template.exp_id for x in completed_experiments]).tolist()
-                if len(completed_experiments) == battery.experiments.count():
-                    assign_experiment_credit.apply_async([result.worker.id],countdown=60)
+                snapshot = get_battery_snapshot_or_404(battery.id)
+                completed_experiments = get_snapshot_experiments(result.worker_id,snapshot,completed=True)
+                completed_experiments = numpy.unique([x.exp_id for x in completed_experiments]).tolist()
+                if len(completed_experiments) == snapshot.experiment_count:
+                    assign_experiment_credit.apply_async([result.worker_id],countdown=60)
                     data["finished_battery"] = "FINISHED"
 
                 # Refresh the page if we've completed a survey or game
@@ -704,26 +764,9 @@ def edit_experiment_template(request,eid=None):
 @login_required
 def delete_experiment_template(request, eid, do_redirect=True):
     experiment = get_experiment_template(eid,request)
-    experiment_instances = Experiment.objects.filter(template=experiment)
-    experiment_type = get_experiment_type(experiment)
     if check_experiment_edit_permission(request):
-        # Static Files
-        [e.delete() for e in experiment_instances]
-        static_files_dir = os.path.join(media_dir,experiment_type,experiment.exp_id)
-        if os.path.exists(static_files_dir):
-            shutil.rmtree(static_files_dir)
-        # delete associated results
-        results = Result.objects.filter(experiment=experiment)
-        [r.delete() for r in results]
-        # Cognitive Atlas Task
-        task = experiment.cognitive_atlas_task
-        try:
-            if experiment.cognitive_atlas_task.experiment_set.count() == 1:
-                # We might want to delete concepts too? Ok for now.
-                task.delete()
-        except:
-            pass
-        experiment.delete()
+        # Results, static files and the template are deleted in the background
+        purge_experiment_template.apply_async([experiment.exp_id])
 
     if do_redirect == True:
         return redirect('experiments')
@@ -747,6 +790,9 @@ def edit_experiment(request,bid,eid):
             experiment.save()
             for cc in experiment.credit_conditions.all():
                 update_credits(experiment,cc.id)
+
+            # Existing results are re-scored against the changed conditions
+            rescore_battery.apply_async([battery.id])
             return HttpResponseRedirect(battery.get_absolute_url())
     else:
         form = ExperimentForm(instance=experiment)
@@ -920,6 +966,9 @@ def remove_condition(request,bid,eid,cid):
     # Deletes condition from experiments, if not used from database, turns bonus/rejection on/off
     update_credits(experiment,cid)
 
+    # Existing results are re-scored against the remaining conditions
+    rescore_battery.apply_async([battery.id])
+
     form = ExperimentForm(instance=experiment)
 
     context = {"form": form,
@@ -995,11 +1044,10 @@ def delete_battery(request, bid):
     battery = get_battery(bid,request)
     delete_permission = check_battery_delete_permission(request,battery)
     if delete_permission==True:
-        hits = HIT.objects.filter(battery=battery)
-        [h.delete() for h in hits]
-        results = Result.objects.filter(battery=battery)
-        [r.delete() for r in results]
-        battery.delete()
+        # Hide the battery now, and delete it with its results and HITs in the background
+        Battery.objects.filter(id=battery.id).update(pending_deletion=True,active=False)
+        bump_cache_version(BATTERY_CACHE,battery.id)
+        purge_battery.apply_async([battery.id])
     return redirect('batteries')
 
 
@@ -1032,6 +1080,7 @@ def subject_management(request,bid):
 
 # Export specific experiment data
 @login_required
+@read_from_replica
 def export_battery(request,bid):
     battery = get_battery(bid,request)
     output_name = "expfactory_battery_%s.tsv" %(battery.id)
@@ -1039,6 +1088,7 @@ def export_battery(request,bid):
 
 # Export specific experiment data
 @login_required
+@read_from_replica
 def export_experiment(request,eid):
     battery = Battery.objects.filter(experiments__id=eid)[0]
     experiment = get_experiment(eid,request)
@@ -1048,8 +1098,8 @@ def export_experiment(request,eid):
 # General function to export some number of experiments
 def export_experiments(battery,output_name,experiment_tags=None):
 
-    # Get all results associated with Battery
-    results = Result.objects.filter(battery=battery)
+    # Get all results associated with Battery, including archived results
+    results = with_archived_results(Result.objects.filter(battery=battery),battery.id)
     response = HttpResponse(content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="%s"' %(output_name)
     writer = csv.writer(response,delimiter='\t')
@@ -1080,6 +1130,7 @@ def export_experiments(battery,output_name,experiment_tags=None):
 
 #### RESULTS VISUALIZATION #####################################################
 @login_required
+@read_from_replica
 def battery_results_dashboard(request,bid):
     '''battery_results_dashboard will show the user a dashboard to select an experiment
     to view results for
@@ -1088,6 +1139,7 @@ def battery_results_dashboard(request,bid):
     return render(request, "experiments/results_dashboard_battery.html", context)
 
 @login_required
+@read_from_replica
 def battery_results_context(request,bid):
     '''battery_result_context is a general function used by experiment and battery
     results dashboard to return context with experiments completed for a battery
@@ -1096,14 +1148,16 @@ def battery_results_context(request,bid):
 
     # Check if battery has results
     results = Result.objects.filter(battery=battery,completed=True)
-    completed_experiments = numpy.unique([r.experiment.exp_id for r in results]).tolist()
-    experiments = ExperimentTemplate.objects.filter(exp_id__in=completed_experiments)
+    completed_experiments = list(results.values_list('experiment_id',flat=True).distinct())
+    archived_experiments = ArchivedResult.objects.filter(battery=battery,completed=True).values_list('experiment_id',flat=True).distinct()
+    experiments = ExperimentTemplate.objects.filter(exp_id__in=completed_experiments + list(archived_experiments))
     context = {'battery': battery,
                'experiments':experiments,
                'bid':battery.id}
     return context
 
 @login_required
+@read_from_replica
 def experiment_results_dashboard(request,bid):
     '''experiment_results_dashboard will show the user a result for a particular experiment
     '''
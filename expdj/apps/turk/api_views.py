@@ -2,11 +2,36 @@ from rest_framework import generics
 from rest_framework import permissions
 from rest_framework import viewsets
 
+from expdj.apps.turk.archive import ResultsWithArchived, get_archived_results
 from expdj.apps.turk.models import Result, Worker
 from expdj.apps.turk.serializers import ResultSerializer
+from expdj.apps.turk.utils import filter_taskdata, parse_json_value, taskdata_has_value
+from expdj.db_router import ReplicaReadMixin
 
-class BatteryResultAPIList(generics.ListAPIView):
+class BatteryResultAPIList(ReplicaReadMixin, generics.ListAPIView):
+    '''Results for a battery, optionally filtered with ?experiment=<exp_id>,
+    ?completed=true|false, and ?variable=<name>&value=<value> for results with
+    a trial where the trialdata variable has the value
+    '''
     serializer_class = ResultSerializer
     def get_queryset(self):
         battery_id = self.kwargs.get('bid')
-        return Result.objects.filter(battery__id=battery_id)
+        results = Result.objects.filter(battery__id=battery_id)
+        params = self.request.query_params
+        completed = None
+        if "experiment" in params:
+            results = results.filter(experiment_id=params["experiment"])
+        if "completed" in params:
+            completed = params["completed"].lower() in ["true","1"]
+            results = results.filter(completed=completed)
+        if "variable" in params and "value" in params:
+            # Archived results (of inactive batteries) are read back from their archive files
+            value = parse_json_value(params["value"])
+            results = filter_taskdata(results,params["variable"],value)
+            archived = get_archived_results(battery_id,params.get("experiment"),completed)
+            archived = [r for r in archived if taskdata_has_value(r.taskdata,params["variable"],value)]
+            if len(archived) > 0:
+                return list(results) + archived
+            return results
+        # Counted by their stubs, and only read for a page past the results table
+        return ResultsWithArchived(results,battery_id,params.get("experiment"),completed)
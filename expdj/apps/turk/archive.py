@@ -0,0 +1,318 @@
+'''archive.py: cold storage of the results of inactive batteries
+
+Completed results of batteries that are no longer active (and abandoned
+incomplete results, see collect_abandoned_results) are written to
+gzipped json lines files (one per archive run) on local disk, or in an S3
+compatible store when RESULT_ARCHIVE_S3 is set, and deleted from the
+results table. A ResultArchive row indexes each file, and an ArchivedResult
+stub is left for each result. Exports, dashboards and the battery results
+API read archives back with with_archived_results, as unsaved Result objects.
+The rows of an archive file are cached under the battery's cache version
+(bumped when its archives change), so the file is only read once.
+'''
+
+import collections
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils.dateparse import parse_datetime
+
+from expdj.apps.experiments.cache import BATTERY_CACHE, bump_cache_version, get_or_set_versioned
+from expdj.apps.turk.models import ArchivedResult, Result, ResultArchive
+
+
+# Result fields (attnames, eg battery_id) written to an archive
+ARCHIVE_FIELDS = [field.attname for field in Result._meta.concrete_fields]
+
+# Result fields written as iso text (see encode_value), parsed back when read
+ARCHIVE_DATETIME_FIELDS = [field.attname for field in Result._meta.concrete_fields
+                           if isinstance(field,models.DateTimeField)]
+
+
+# STORAGE ######################################################################
+
+class LocalArchiveStorage(object):
+    '''archive files in a directory on local disk'''
+    name = "local"
+
+    def __init__(self,root):
+        self.root = root
+
+    def save(self,location,path):
+        output_file = os.path.join(self.root,location)
+        if not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+        shutil.copyfile(path,output_file)
+
+    def open(self,location):
+        return open(os.path.join(self.root,location),'rb')
+
+    def delete(self,location):
+        archive_file = os.path.join(self.root,location)
+        if os.path.exists(archive_file):
+            os.remove(archive_file)
+
+
+class S3ArchiveStorage(object):
+    '''archive files in a bucket of an S3 compatible store (eg, a local minio)'''
+    name = "s3"
+
+    def __init__(self,config):
+        connection = S3Connection(config.get("access_key"),config.get("secret_key"),
+                                  host=config["host"],port=config.get("port"),
+                                  is_secure=config.get("is_secure",True),
+                                  calling_format=OrdinaryCallingFormat())
+        self.bucket = connection.lookup(config["bucket"])
+        if self.bucket == None:
+            self.bucket = connection.create_bucket(config["bucket"])
+
+    def save(self,location,path):
+        self.bucket.new_key(location).set_contents_from_filename(path)
+
+    def open(self,location):
+        archive_file = tempfile.TemporaryFile()
+        self.bucket.get_key(location).get_contents_to_file(archive_file)
+        archive_file.seek(0)
+        return archive_file
+
+    def delete(self,location):
+        self.bucket.delete_key(location)
+
+
+def get_archive_storage(name=None):
+    '''get_archive_storage returns the configured storage, or the one named
+    :param name: local or s3, for reading an existing archive
+    '''
+    s3_config = getattr(settings,"RESULT_ARCHIVE_S3",None)
+    if name == None:
+        name = "s3" if s3_config else "local"
+    if name == "s3":
+        return S3ArchiveStorage(s3_config)
+    return LocalArchiveStorage(settings.RESULT_ARCHIVE_ROOT)
+
+
+# WRITING ######################################################################
+
+def encode_value(value):
+    if isinstance(value,datetime.datetime):
+        return value.isoformat()
+    raise TypeError("%s is not JSON serializable" %(value))
+
+
+def archive_battery_results(battery,batch_size=1000):
+    '''archive_battery_results moves the completed results of a battery to a new
+    archive, and returns it (None if there was nothing to archive)
+    :param battery: the experiments.models.Battery to archive
+    :param batch_size: the number of results to read (and delete) at once
+    '''
+    return archive_results(battery,Result.objects.filter(battery=battery,completed=True),batch_size)
+
+
+def archive_results(battery,results,batch_size=1000):
+    '''archive_results moves results of a battery to a new archive, and returns
+    it (None if there was nothing to archive). Results are read in batches of
+    ids, and are only deleted once the archive is stored.
+    :param battery: the experiments.models.Battery of the results
+    :param results: a turk.models.Result queryset, filtered to the battery
+    :param batch_size: the number of results to read (and delete) at once
+    '''
+    results = results.order_by('id')
+    stubs = []
+    temp_file = tempfile.NamedTemporaryFile(suffix=".jsonl.gz",delete=False)
+    try:
+        archive_file = gzip.GzipFile(fileobj=temp_file,mode='wb')
+        last_id = 0
+        while True:
+            batch = list(results.filter(id__gt=last_id).values(*ARCHIVE_FIELDS)[:batch_size])
+            if len(batch) == 0:
+                break
+            for row in batch:
+                archive_file.write("%s\n" %(json.dumps(row,default=encode_value)))
+                stubs.append(ArchivedResult(result_id=row["id"],worker_id=row["worker_id"],
+                                            experiment_id=row["experiment_id"],battery_id=row["battery_id"],
+                                            finishtime=row["finishtime"],completed=row["completed"]))
+            last_id = batch[-1]["id"]
+        archive_file.close()
+        temp_file.close()
+        if len(stubs) == 0:
+            return None
+
+        storage = get_archive_storage()
+        location = "battery_%s/results_%s.jsonl.gz" %(battery.id,datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S%f"))
+        storage.save(location,temp_file.name)
+    finally:
+        os.remove(temp_file.name)
+
+    with transaction.atomic():
+        archive = ResultArchive.objects.create(battery=battery,storage=storage.name,
+                                               location=location,result_count=len(stubs))
+        for stub in stubs:
+            stub.archive = archive
+        ArchivedResult.objects.bulk_create(stubs,batch_size=batch_size)
+    # Results that stopped matching the queryset while archiving (eg, an abandoned
+    # result completed) are kept in the table, and left out of the archive
+    result_ids = [stub.result_id for stub in stubs]
+    kept_ids = []
+    for start in range(0,len(result_ids),batch_size):
+        batch_ids = result_ids[start:start + batch_size]
+        with transaction.atomic():
+            list(Result.objects.select_for_update().filter(id__in=batch_ids).values_list('id',flat=True))
+            deleted_ids = set(results.filter(id__in=batch_ids).values_list('id',flat=True))
+            Result.objects.filter(id__in=deleted_ids).delete()
+        kept_ids += [result_id for result_id in batch_ids if result_id not in deleted_ids]
+
+    if len(kept_ids) > 0:
+        for start in range(0,len(kept_ids),batch_size):
+            ArchivedResult.objects.filter(archive=archive,result_id__in=kept_ids[start:start + batch_size]).delete()
+        archive.result_count -= len(kept_ids)
+        if archive.result_count == 0:
+            storage.delete(location)
+            archive.delete()
+            archive = None
+        else:
+            archive.save(update_fields=['result_count'])
+    # Archive rows cached before the stubs were final are read again
+    bump_cache_version(BATTERY_CACHE,battery.id)
+    return archive
+
+
+def delete_battery_archives(battery):
+    '''delete_battery_archives removes the archive files of a battery (the
+    ResultArchive rows go with the battery)
+    '''
+    for archive in ResultArchive.objects.filter(battery=battery):
+        get_archive_storage(archive.storage).delete(archive.location)
+
+
+# READING ######################################################################
+
+def read_archive_rows(archive):
+    '''read_archive_rows returns the rows of an archive file, as dictionaries of
+    Result field values. Only results with a stub are read, the file can also
+    hold results that were kept in the table (see archive_results).
+    :param archive: a turk.models.ResultArchive
+    '''
+    result_ids = set(archive.stubs.values_list('result_id',flat=True))
+    rows = []
+    archive_file = get_archive_storage(archive.storage).open(archive.location)
+    try:
+        for line in gzip.GzipFile(fileobj=archive_file,mode='rb'):
+            row = json.loads(line,object_pairs_hook=collections.OrderedDict)
+            if row["id"] not in result_ids:
+                continue
+            for field_name in ARCHIVE_DATETIME_FIELDS:
+                if row.get(field_name) != None:
+                    row[field_name] = parse_datetime(row[field_name])
+            rows.append(row)
+    finally:
+        archive_file.close()
+    return rows
+
+
+def read_archive(archive):
+    '''read_archive yields the results of an archive, as unsaved Result objects,
+    from the cached rows of its file
+    :param archive: a turk.models.ResultArchive
+    '''
+    rows = get_or_set_versioned(BATTERY_CACHE,archive.battery_id,"archive_rows_%s" %(archive.id),
+                                lambda: read_archive_rows(archive))
+    for row in rows:
+        yield Result(**row)
+
+
+def get_archived_results(battery_id,experiment_id=None,completed=None):
+    '''get_archived_results returns the archived results of a battery, optionally
+    for one experiment (ExperimentTemplate exp_id), and completed or not
+    '''
+    archives = ResultArchive.objects.filter(battery_id=battery_id).order_by('id')
+    if experiment_id != None:
+        archives = archives.filter(stubs__experiment_id=experiment_id).distinct()
+    results = []
+    for archive in archives:
+        for result in read_archive(archive):
+            if experiment_id != None and result.experiment_id != experiment_id:
+                continue
+            if completed != None and result.completed != completed:
+                continue
+            results.append(result)
+    return results
+
+
+def count_archived_results(battery_id,experiment_id=None,completed=None):
+    '''count_archived_results returns the number of archived results of a battery
+    (as get_archived_results), from their stubs
+    '''
+    stubs = ArchivedResult.objects.filter(battery_id=battery_id)
+    if experiment_id != None:
+        stubs = stubs.filter(experiment_id=experiment_id)
+    if completed != None:
+        stubs = stubs.filter(completed=completed)
+    return stubs.count()
+
+
+def with_archived_results(results,battery_id,experiment_id=None):
+    '''with_archived_results returns a list of the results of a queryset,
+    followed by the archived results of the battery
+    :param results: a turk.models.Result queryset
+    :param battery_id: the id of the battery the queryset is filtered to
+    :param experiment_id: the exp_id of the experiment the queryset is filtered to
+    '''
+    return list(results) + get_archived_results(battery_id,experiment_id)
+
+
+class ResultsWithArchived(object):
+    '''ResultsWithArchived is the results of a queryset followed by the archived
+    results of the battery, as a sequence for a paginator: the archives are only
+    read for a page past the results of the queryset
+    :param results: a turk.models.Result queryset
+    :param battery_id: the id of the battery the queryset is filtered to
+    :param experiment_id: the exp_id of the experiment the queryset is filtered to
+    :param completed: the completed value the queryset is filtered to
+    '''
+
+    def __init__(self,results,battery_id,experiment_id=None,completed=None):
+        self.results = results
+        self.battery_id = battery_id
+        self.experiment_id = experiment_id
+        self.completed = completed
+        self.result_count = None
+        self.archived = None
+
+    def get_result_count(self):
+        if self.result_count == None:
+            self.result_count = self.results.count()
+        return self.result_count
+
+    def get_archived(self):
+        if self.archived == None:
+            self.archived = get_archived_results(self.battery_id,self.experiment_id,self.completed)
+        return self.archived
+
+    def __len__(self):
+        return self.get_result_count() + count_archived_results(self.battery_id,self.experiment_id,self.completed)
+
+    def __iter__(self):
+        return iter(list(self.results) + self.get_archived())
+
+    def __getitem__(self,index):
+        if not isinstance(index,slice):
+            if index < 0:
+                index += len(self)
+            page = self[index:index + 1]
+            if len(page) == 0:
+                raise IndexError("result index out of range")
+            return page[0]
+        start,stop,step = index.indices(len(self))
+        result_count = self.get_result_count()
+        page = list(self.results[start:min(stop,result_count)]) if start < result_count else []
+        if stop > result_count:
+            page += self.get_archived()[max(start - result_count,0):stop - result_count]
+        return page[::step]
@@ -0,0 +1,324 @@
+'''credit.py: compiled credit conditions, evaluated over trial data with numpy
+
+A CreditCondition is compiled once into a CompiledCondition, which pulls its
+variable out of the trialdata of many results into a single numpy column and
+applies the summary function (eg, avg_rt) and operator in one pass. When the
+taskdata is stored as jsonb, the column is extracted by PostgreSQL instead,
+without loading the taskdata.
+'''
+
+import numpy
+
+from django.db import connection
+
+from expdj.apps.experiments.utils import get_experiment_type
+from expdj.apps.turk.models import Result
+
+
+SUMMARY_FUNCTIONS = {"avg":numpy.mean,
+                     "mean":numpy.mean,
+                     "average":numpy.mean,
+                     "med":numpy.median,
+                     "median":numpy.median,
+                     "sum":numpy.sum,
+                     "total":numpy.sum,
+                     "max":numpy.max,
+                     "min":numpy.min}
+
+
+def parse_variable_name(variable_name):
+    '''parse_variable_name splits a summary prefix from a variable name, eg
+    avg_rt returns (numpy.mean,"rt"). If there is no summary prefix, the
+    summary function is None.
+    :param variable_name: the name of the credit condition variable
+    '''
+    parts = variable_name.split("_")
+    summary_func = SUMMARY_FUNCTIONS.get(parts[0].lower())
+    if summary_func == None or len(parts) == 1:
+        return None,variable_name
+    return summary_func,"_".join(parts[1:])
+
+
+def iter_trials(taskdata):
+    '''iter_trials yields the trialdata dictionaries in an experiment result,
+    where taskdata is a list of trials that each have a trialdata dictionary
+    (or list of dictionaries)
+    :param taskdata: the taskdata of a turk.models.Result
+    '''
+    if not isinstance(taskdata,list):
+        return
+    for trial in taskdata:
+        if not isinstance(trial,dict):
+            continue
+        trialdata = trial.get("trialdata")
+        if isinstance(trialdata,dict):
+            yield trialdata
+        elif isinstance(trialdata,list):
+            for entry in trialdata:
+                if isinstance(entry,dict):
+                    yield entry
+
+
+def to_array(values):
+    '''to_array returns a boolean, float or (for anything else) object numpy
+    array for a list of trial values
+    :param values: list of values pulled from trialdata
+    '''
+    if len(values) > 0 and all(isinstance(x,bool) for x in values):
+        return numpy.array(values,dtype=bool)
+    if all(isinstance(x,(int,long,float)) and not isinstance(x,bool) for x in values):
+        return numpy.array(values,dtype=float)
+    array = numpy.empty(len(values),dtype=object)
+    array[:] = values
+    return array
+
+
+def get_variable_column(taskdatas,variable_name):
+    '''get_variable_column pulls a variable out of the trialdata of many
+    results, and returns the values as one numpy array, along with an array
+    of the same length with the index of the result each value came from
+    :param taskdatas: list of result taskdata
+    :param variable_name: the trialdata variable to extract
+    '''
+    values = []
+    owners = []
+    for index,taskdata in enumerate(taskdatas):
+        for trialdata in iter_trials(taskdata):
+            if variable_name in trialdata:
+                values.append(trialdata[variable_name])
+                owners.append(index)
+    return to_array(values),numpy.array(owners,dtype=int)
+
+
+# The value of a variable in every trialdata entry of some results, in trial
+# order, with the (1-based) position of the result in the id list
+VARIABLE_COLUMN_SQL = '''
+SELECT owner.position, entry.value -> %(name)s
+FROM unnest(%(ids)s::integer[]) WITH ORDINALITY AS owner(id, position)
+JOIN turk_result result ON result.id = owner.id
+CROSS JOIN LATERAL jsonb_array_elements(
+    CASE jsonb_typeof(result.taskdata) WHEN 'array' THEN result.taskdata ELSE '[]'::jsonb END
+) WITH ORDINALITY AS trial(value, trial_position)
+CROSS JOIN LATERAL jsonb_array_elements(
+    CASE jsonb_typeof(trial.value -> 'trialdata')
+        WHEN 'array' THEN trial.value -> 'trialdata'
+        WHEN 'object' THEN jsonb_build_array(trial.value -> 'trialdata')
+        ELSE '[]'::jsonb END
+) WITH ORDINALITY AS entry(value, entry_position)
+WHERE jsonb_typeof(entry.value) = 'object' AND entry.value ? %(name)s
+ORDER BY owner.position, trial.trial_position, entry.entry_position
+'''
+
+
+class TaskdataColumns(object):
+    '''Variable columns read from result taskdata loaded in python'''
+
+    def __init__(self,taskdatas):
+        self.taskdatas = taskdatas
+
+    def __len__(self):
+        return len(self.taskdatas)
+
+    def get_column(self,variable_name):
+        return get_variable_column(self.taskdatas,variable_name)
+
+
+class SQLTaskdataColumns(object):
+    '''Variable columns extracted from jsonb result taskdata by PostgreSQL,
+    with the same values and order as get_variable_column
+    '''
+
+    def __init__(self,result_ids):
+        self.result_ids = list(result_ids)
+
+    def __len__(self):
+        return len(self.result_ids)
+
+    def get_column(self,variable_name):
+        cursor = connection.cursor()
+        cursor.execute(VARIABLE_COLUMN_SQL,{"ids":self.result_ids,"name":variable_name})
+        rows = cursor.fetchall()
+        values = [row[1] for row in rows]
+        owners = [row[0] - 1 for row in rows]
+        return to_array(values),numpy.array(owners,dtype=int)
+
+
+def taskdata_in_sql():
+    '''taskdata_in_sql returns True if result taskdata is stored as jsonb, and
+    variables can be extracted by the database
+    '''
+    return Result._meta.get_field('taskdata').db_type(connection) == 'jsonb'
+
+
+def get_taskdata_columns(results):
+    '''get_taskdata_columns returns the variable column source for results:
+    PostgreSQL when their taskdata was deferred (not loaded), python otherwise
+    :param results: list of turk.models.Result
+    '''
+    if len(results) > 0 and 'taskdata' in results[0].get_deferred_fields() and taskdata_in_sql():
+        return SQLTaskdataColumns([r.id for r in results])
+    return TaskdataColumns([r.taskdata for r in results])
+
+
+def summarize_column(values,owners,summary_func,include):
+    '''summarize_column applies a summary function to the values of each
+    result in a column, for results flagged in include that have values
+    :param values: numpy array of values
+    :param owners: numpy array with the result index for each value
+    :param summary_func: the numpy summary function, eg numpy.mean
+    :param include: boolean numpy array, True for results to summarize
+    '''
+    keep = include[owners]
+    values = values[keep]
+    owners = owners[keep]
+    if len(values) == 0:
+        return values,owners
+    values = values.astype(float)
+    indices,starts = numpy.unique(owners,return_index=True)
+    if summary_func is numpy.sum:
+        summaries = numpy.add.reduceat(values,starts)
+    elif summary_func is numpy.max:
+        summaries = numpy.maximum.reduceat(values,starts)
+    elif summary_func is numpy.min:
+        summaries = numpy.minimum.reduceat(values,starts)
+    elif summary_func is numpy.mean:
+        summaries = numpy.add.reduceat(values,starts) / numpy.diff(numpy.append(starts,len(values)))
+    else:
+        summaries = numpy.array([summary_func(x) for x in numpy.split(values,starts[1:])])
+    return summaries,indices
+
+
+class CompiledCondition(object):
+    '''A CreditCondition compiled for vectorized evaluation over the trial
+    data of one or more results.
+    '''
+
+    def __init__(self,credit_condition):
+        self.id = credit_condition.id
+        self.variable_id = credit_condition.variable_id
+        self.variable_name = credit_condition.variable.name
+        self.operator = credit_condition.operator
+        self.func = credit_condition.operator_lookup.get(credit_condition.operator)
+        self.value = credit_condition.value
+        self.amount = credit_condition.amount
+        self.summary_func,self.summary_variable = parse_variable_name(self.variable_name)
+
+    def get_comparator(self,values):
+        '''get_comparator converts the user selected value to the type of the
+        variable column, or returns None if the value can't be compared
+        '''
+        if values.dtype == bool:
+            return str(self.value).strip().lower() not in ["false","0",""]
+        if values.dtype == float:
+            try:
+                return float(self.value)
+            except (TypeError,ValueError):
+                return None
+        return self.value
+
+    def get_values(self,columns):
+        '''get_values returns the column of variable values for many results.
+        The variable is first looked up as it is, and for results without it,
+        a summary statistic (eg, avg_rt) is computed if one was specified.
+        :param columns: TaskdataColumns or SQLTaskdataColumns for the results
+        '''
+        values,owners = columns.get_column(self.variable_name)
+        if self.summary_func == None:
+            return values,owners
+        missing = numpy.bincount(owners,minlength=len(columns)) == 0
+        if not missing.any():
+            return values,owners
+        summary_values,summary_owners = columns.get_column(self.summary_variable)
+        if summary_values.dtype == object and len(summary_values) > 0:
+            return values,owners
+        summary_values,summary_owners = summarize_column(summary_values,summary_owners,self.summary_func,missing)
+        if len(values) == 0:
+            return summary_values,summary_owners
+        if values.dtype == object:
+            return values,owners
+        return numpy.append(values.astype(float),summary_values),numpy.append(owners,summary_owners)
+
+    def evaluate(self,columns):
+        '''evaluate returns, for each result, a description of the first value
+        that satisfies the condition, eg 'performance_var 556.333333333 GREATERTHAN 400.0',
+        or None
+        :param columns: TaskdataColumns or SQLTaskdataColumns for the results
+        '''
+        descriptions = [None] * len(columns)
+        if self.func == None:
+            return descriptions
+        values,owners = self.get_values(columns)
+        if len(values) == 0:
+            return descriptions
+        comparator = self.get_comparator(values)
+        if comparator == None:
+            return descriptions
+        passed = numpy.asarray(self.func(values,comparator),dtype=bool)
+        passed_owners = owners[passed]
+        passed_values = values[passed]
+        indices,first = numpy.unique(passed_owners,return_index=True)
+        for index,position in zip(indices,first):
+            variable = passed_values[position]
+            if isinstance(variable,numpy.generic):
+                variable = variable.item()
+            descriptions[index] = "%s %s %s %s" %(self.variable_name,variable,self.operator,comparator)
+        return descriptions
+
+
+def compile_conditions(experiment,bonus=True,rejection=True):
+    '''compile_conditions compiles the credit conditions of a battery experiment,
+    and returns a tuple of (bonus conditions, rejection conditions). Conditions
+    only apply when the template has the variable and the experiment includes
+    bonus (or catch).
+    :param experiment: experiments.models.Experiment, ideally with credit_conditions prefetched
+    '''
+    template = experiment.template
+    do_bonus = bonus and experiment.include_bonus and template.performance_variable_id != None
+    do_catch = rejection and experiment.include_catch and template.rejection_variable_id != None
+    bonus_conditions = []
+    rejection_conditions = []
+    if not do_bonus and not do_catch:
+        return bonus_conditions,rejection_conditions
+    for credit_condition in experiment.credit_conditions.all():
+        if do_bonus and credit_condition.variable_id == template.performance_variable_id:
+            bonus_conditions.append(CompiledCondition(credit_condition))
+        if do_catch and credit_condition.variable_id == template.rejection_variable_id:
+            rejection_conditions.append(CompiledCondition(credit_condition))
+    return bonus_conditions,rejection_conditions
+
+
+def score_results(experiment,results,bonus=True,rejection=True):
+    '''score_results evaluates the credit conditions of a battery experiment over
+    many results at once, and returns a dictionary keyed by result id with the
+    bonus (description, amount) and violation description for each result that
+    earned a bonus or violated a rejection condition.
+    :param experiment: experiments.models.Experiment
+    :param results: list of turk.models.Result for the experiment, with taskdata
+    deferred to extract variables in the database
+    '''
+    scores = dict()
+    if get_experiment_type(experiment.template) != "experiments":
+        return scores
+    bonus_conditions,rejection_conditions = compile_conditions(experiment,bonus=bonus,rejection=rejection)
+    if len(bonus_conditions) + len(rejection_conditions) == 0:
+        return scores
+
+    results = [r for r in results if r.completed == True]
+    columns = get_taskdata_columns(results)
+
+    # The last bonus condition satisfied is kept, and the first violation
+    for credit_condition in bonus_conditions:
+        if credit_condition.amount == None:
+            continue
+        for result,description in zip(results,credit_condition.evaluate(columns)):
+            if description != None:
+                score = scores.setdefault(result.id,{"bonus":None,"violation":None})
+                score["bonus"] = (description,credit_condition.amount)
+
+    for credit_condition in rejection_conditions:
+        for result,description in zip(results,credit_condition.evaluate(columns)):
+            if description != None:
+                score = scores.setdefault(result.id,{"bonus":None,"violation":None})
+                if score["violation"] == None:
+                    score["violation"] = description
+    return scores
@@ -0,0 +1,22 @@
+import json
+
+from jsonfield import JSONField
+
+
+class JSONBField(JSONField):
+    '''A JSONField stored as native jsonb on PostgreSQL (text elsewhere), so
+    the database can index and query inside the document. Existing text
+    columns are converted in batches by the convert_jsonb command.
+    '''
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+        return super(JSONBField, self).db_type(connection)
+
+    def from_db_value(self, value, expression, connection, context):
+        # psycopg2 decodes jsonb itself
+        if value is None or not isinstance(value, basestring):
+            return value
+        return json.loads(value, **self.load_kwargs)
+
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk.archive import archive_battery_results
+
+
+class Command(BaseCommand):
+    help = '''move the completed results of inactive batteries to compressed archive files (local
+    disk, or the S3 compatible store in RESULT_ARCHIVE_S3), leaving a stub index in the database'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_ids', nargs='*', type=int,
+                            help='ids of inactive batteries to archive (default all inactive batteries)')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='number of results to read and delete at once (default 1000)')
+
+    def handle(self, *args, **options):
+        batteries = Battery.objects.filter(active=False,pending_deletion=False)
+        if len(options['battery_ids']) > 0:
+            if batteries.filter(id__in=options['battery_ids']).count() != len(set(options['battery_ids'])):
+                raise CommandError('Only existing, inactive batteries can be archived')
+            batteries = batteries.filter(id__in=options['battery_ids'])
+
+        for battery in batteries:
+            archive = archive_battery_results(battery,batch_size=options['batch_size'])
+            if archive == None:
+                self.stdout.write('battery %s: nothing to archive' %(battery.id))
+            else:
+                self.stdout.write('battery %s: archived %s results to %s (%s)'
+                                  %(battery.id,archive.result_count,archive.location,archive.storage))
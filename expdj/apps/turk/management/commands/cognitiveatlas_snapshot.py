@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expdj.apps.experiments.models import CognitiveAtlasTask, ExperimentTemplate
+from expdj.apps.experiments.utils import (dump_cognitiveatlas_snapshot, load_cognitiveatlas_snapshot,
+                                          refresh_cognitiveatlas_tasks)
+
+
+class Command(BaseCommand):
+    help = '''load the local snapshot of Cognitive Atlas tasks and concepts from a json file (to install
+    experiments offline), dump it to one, or refresh it from the Cognitive Atlas API'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--load', dest='load', default=None,
+                            help='json file (written by --dump) to load the snapshot from')
+        parser.add_argument('--dump', dest='dump', default=None,
+                            help='json file to write the snapshot to')
+        parser.add_argument('--refresh', dest='refresh', action='store_true', default=False,
+                            help='fetch all stored tasks (and those of installed experiments) from the API')
+
+    def handle(self, *args, **options):
+        if options['load'] == None and options['dump'] == None and not options['refresh']:
+            raise CommandError('Specify --load, --dump or --refresh')
+
+        if options['load'] != None:
+            tasks,concepts = load_cognitiveatlas_snapshot(options['load'])
+            self.stdout.write('loaded %s tasks and %s concepts from %s' %(tasks,concepts,options['load']))
+
+        if options['refresh']:
+            task_ids = set(CognitiveAtlasTask.objects.values_list('cog_atlas_id',flat=True))
+            task_ids.update(ExperimentTemplate.objects.exclude(cognitive_atlas_task=None)
+                                                      .values_list('cognitive_atlas_task_id',flat=True))
+            refresh_cognitiveatlas_tasks(task_ids,force=True)
+            self.stdout.write('refreshed %s tasks' %(len(task_ids)))
+
+        if options['dump'] != None:
+            tasks,concepts = dump_cognitiveatlas_snapshot(options['dump'])
+            self.stdout.write('dumped %s tasks and %s concepts to %s' %(tasks,concepts,options['dump']))
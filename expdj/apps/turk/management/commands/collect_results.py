@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from expdj.apps.turk.tasks import collect_abandoned_results
+
+
+class Command(BaseCommand):
+    help = '''delete (or archive) abandoned incomplete results, as the daily celery beat task does'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='number of results to delete at once (default 1000)')
+        parser.add_argument('--archive', action='store_true', dest='archive', default=None,
+                            help='archive the results instead of deleting them')
+
+    def handle(self, *args, **options):
+        stats = collect_abandoned_results(batch_size=options['batch_size'],archive=options['archive'])
+        self.stdout.write('Abandoned results: %(stamped)s given a serve time, %(deleted)s deleted, '
+                          '%(archived)s archived' %(stats))
@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from expdj.apps.turk.models import Blacklist, Bonus, Result
+from expdj.apps.turk.partitions import results_partitioned
+
+
+# (model, field) pairs stored as jsonb
+JSONB_FIELDS = [(Result,"taskdata"),
+                (Bonus,"amounts"),
+                (Blacklist,"flags")]
+
+# GIN index for containment queries (@>) on the result taskdata
+TASKDATA_INDEX = "turk_result_taskdata_gin"
+
+
+class Command(BaseCommand):
+    help = '''convert the json text columns of results, bonuses and blacklists to jsonb in
+    batches, and create the GIN index on result taskdata. Run before migrate, so the
+    migration that changes the column type has nothing left to rewrite, and again after
+    to create the index on a new database.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='number of rows to convert per transaction (default 1000)')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('jsonb columns need PostgreSQL')
+
+        for model,field_name in JSONB_FIELDS:
+            table = model._meta.db_table
+            column = model._meta.get_field(field_name).column
+            column_type = get_column_type(table,column)
+            if column_type == None:
+                self.stdout.write('%s.%s does not exist yet, skipping' %(table,column))
+            elif column_type == 'jsonb':
+                self.stdout.write('%s.%s is already jsonb' %(table,column))
+            else:
+                convert_column(table,column,options['batch_size'],self.stdout)
+
+        if get_column_type(Result._meta.db_table,"taskdata") == 'jsonb':
+            # Partitioned tables (see partition_results) can't index concurrently
+            concurrently = "" if results_partitioned() else "CONCURRENTLY"
+            cursor = connection.cursor()
+            cursor.execute('CREATE INDEX %s IF NOT EXISTS %s ON %s USING gin (taskdata jsonb_path_ops)'
+                           %(concurrently,TASKDATA_INDEX,Result._meta.db_table))
+            self.stdout.write('GIN index %s is in place' %(TASKDATA_INDEX))
+
+
+def get_column_type(table,column):
+    cursor = connection.cursor()
+    cursor.execute('SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s',
+                   [table,column])
+    row = cursor.fetchone()
+    if row == None:
+        return None
+    return row[0]
+
+
+def convert_column(table,column,batch_size,stdout):
+    '''convert_column fills a new jsonb column from a text column in batches of
+    ids, each in its own transaction. A trigger converts rows written meanwhile,
+    and the columns are swapped under a short lock at the end.
+    '''
+    new_column = "%s_jsonb" %(column)
+    function = "%s_%s_to_jsonb" %(table,column)
+    cast = "CASE WHEN %(c)s IS NULL OR %(c)s = '' THEN NULL ELSE %(c)s::jsonb END"
+    cursor = connection.cursor()
+    cursor.execute('ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s jsonb' %(table,new_column))
+    cursor.execute('''CREATE OR REPLACE FUNCTION %s() RETURNS trigger AS $$
+                      BEGIN NEW.%s := %s; RETURN NEW; END $$ LANGUAGE plpgsql'''
+                   %(function,new_column,cast %{"c":"NEW.%s" %(column)}))
+    cursor.execute('DROP TRIGGER IF EXISTS %s ON %s' %(function,table))
+    cursor.execute('CREATE TRIGGER %s BEFORE INSERT OR UPDATE OF %s ON %s FOR EACH ROW EXECUTE PROCEDURE %s()'
+                   %(function,column,table,function))
+
+    cursor.execute('SELECT COALESCE(MIN(id),0), COALESCE(MAX(id),0) FROM %s' %(table))
+    first_id,last_id = cursor.fetchone()
+    converted = 0
+    for start in range(first_id,last_id + 1,batch_size):
+        with transaction.atomic():
+            cursor.execute('UPDATE %s SET %s = %s WHERE id >= %%s AND id < %%s AND %s IS NULL'
+                           %(table,new_column,cast %{"c":column},new_column),
+                           [start,start + batch_size])
+            converted += cursor.rowcount
+        stdout.write('%s.%s: converted %s rows (up to id %s)' %(table,column,converted,start + batch_size - 1))
+
+    # Rows written since the trigger was created are already converted
+    with transaction.atomic():
+        cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' %(table))
+        cursor.execute('DROP TRIGGER %s ON %s' %(function,table))
+        cursor.execute('DROP FUNCTION %s()' %(function))
+        cursor.execute('ALTER TABLE %s DROP COLUMN %s' %(table,column))
+        cursor.execute('ALTER TABLE %s RENAME COLUMN %s TO %s' %(table,new_column,column))
+    stdout.write('%s.%s is now jsonb' %(table,column))
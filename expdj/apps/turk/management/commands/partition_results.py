@@ -0,0 +1,128 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk.partitions import (RESULT_TABLE, DEFAULT_PARTITION, check_partitioning_supported,
+    create_result_partition, detach_result_partition, get_partition_name, results_partitioned)
+
+
+NEW_TABLE = "%s_partitioned" %(RESULT_TABLE)
+SYNC_FUNCTION = "%s_sync_partitioned" %(RESULT_TABLE)
+
+
+class Command(BaseCommand):
+    help = '''partition the turk_result table by battery (PostgreSQL list partitioning), copying
+    existing results in batches, and make sure every battery has its own partition. Run after
+    migrate. With --detach, detach a battery's partition into a standalone table instead.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='number of rows to copy per transaction (default 1000)')
+        parser.add_argument('--detach', dest='detach', type=int, default=None,
+                            help='id of a battery whose partition to detach (eg, for archiving)')
+
+    def handle(self, *args, **options):
+        try:
+            check_partitioning_supported()
+        except DatabaseError as error:
+            raise CommandError(str(error))
+
+        if options['detach'] != None:
+            partition = detach_result_partition(options['detach'])
+            if partition == None:
+                raise CommandError('battery %s has no result partition' %(options['detach']))
+            self.stdout.write('detached %s' %(partition))
+            return
+
+        if not results_partitioned():
+            partition_table(options['batch_size'],self.stdout)
+
+        # Batteries created before partitioning, or whose partition couldn't be created
+        created = 0
+        for battery_id in Battery.objects.values_list('id',flat=True):
+            if create_result_partition(battery_id):
+                created += 1
+        self.stdout.write('%s is partitioned, created %s battery partitions' %(RESULT_TABLE,created))
+
+
+def get_indexes(table):
+    '''get_indexes returns (name, definition) of the indexes of a table, except its primary key'''
+    cursor = connection.cursor()
+    cursor.execute('''SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i
+                      JOIN pg_class c ON c.oid = i.indexrelid
+                      WHERE i.indrelid = %s::regclass AND NOT i.indisprimary''',[table])
+    return cursor.fetchall()
+
+
+def get_foreign_keys(table):
+    cursor = connection.cursor()
+    cursor.execute('''SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                      WHERE conrelid = %s::regclass AND contype = 'f' ''',[table])
+    return cursor.fetchall()
+
+
+def partition_table(batch_size,stdout):
+    '''partition_table builds a partitioned copy of turk_result while it stays in
+    use: a trigger mirrors writes to the copy, existing rows are copied in batches
+    of ids, and the tables are swapped under a short lock at the end. The primary
+    key becomes (id, battery_id), as PostgreSQL requires the partition key in
+    unique constraints.
+    '''
+    check_partitioning_supported()
+    cursor = connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS %s' %(NEW_TABLE))
+    cursor.execute('''CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                      PARTITION BY LIST (battery_id)''' %(NEW_TABLE,RESULT_TABLE))
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id, battery_id)' %(NEW_TABLE))
+    cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' %(DEFAULT_PARTITION,NEW_TABLE))
+    for battery_id in Battery.objects.values_list('id',flat=True):
+        cursor.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES IN (%s)'
+                       %(get_partition_name(battery_id),NEW_TABLE,int(battery_id)))
+
+    # Indexes get temporary names until the old table is gone
+    indexes = get_indexes(RESULT_TABLE)
+    for name,definition in indexes:
+        definition = definition.replace(' INDEX %s ON ' %(name),' INDEX %s_p ON ' %(name))
+        definition = definition.replace(' ON public.%s ' %(RESULT_TABLE),' ON %s ' %(NEW_TABLE))
+        definition = definition.replace(' ON %s ' %(RESULT_TABLE),' ON %s ' %(NEW_TABLE))
+        cursor.execute(definition)
+    for name,definition in get_foreign_keys(RESULT_TABLE):
+        cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' %(NEW_TABLE,name,definition))
+
+    # Mirror writes made while copying
+    cursor.execute('''CREATE OR REPLACE FUNCTION %(function)s() RETURNS trigger AS $$
+                      BEGIN
+                          IF TG_OP <> 'INSERT' THEN DELETE FROM %(table)s WHERE id = OLD.id; END IF;
+                          IF TG_OP <> 'DELETE' THEN INSERT INTO %(table)s SELECT NEW.*; END IF;
+                          RETURN NULL;
+                      END $$ LANGUAGE plpgsql''' %{"function":SYNC_FUNCTION,"table":NEW_TABLE})
+    cursor.execute('DROP TRIGGER IF EXISTS %s ON %s' %(SYNC_FUNCTION,RESULT_TABLE))
+    cursor.execute('CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s FOR EACH ROW EXECUTE PROCEDURE %s()'
+                   %(SYNC_FUNCTION,RESULT_TABLE,SYNC_FUNCTION))
+
+    cursor.execute('SELECT COALESCE(MIN(id),0), COALESCE(MAX(id),0) FROM %s' %(RESULT_TABLE))
+    first_id,last_id = cursor.fetchone()
+    copied = 0
+    for start in range(first_id,last_id + 1,batch_size):
+        with transaction.atomic():
+            # Locking the rows makes concurrent writes wait for the batch, and rows
+            # already mirrored by the trigger are newer, so they are kept
+            cursor.execute('''INSERT INTO %s SELECT * FROM %s WHERE id >= %%s AND id < %%s
+                              FOR SHARE ON CONFLICT DO NOTHING''' %(NEW_TABLE,RESULT_TABLE),
+                           [start,start + batch_size])
+            copied += cursor.rowcount
+        stdout.write('%s: copied %s rows (up to id %s)' %(RESULT_TABLE,copied,start + batch_size - 1))
+
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')",[RESULT_TABLE])
+    sequence = cursor.fetchone()[0]
+    with transaction.atomic():
+        cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' %(RESULT_TABLE))
+        cursor.execute('DROP TRIGGER %s ON %s' %(SYNC_FUNCTION,RESULT_TABLE))
+        cursor.execute('DROP FUNCTION %s()' %(SYNC_FUNCTION))
+        cursor.execute('ALTER SEQUENCE %s OWNED BY %s.id' %(sequence,NEW_TABLE))
+        cursor.execute('DROP TABLE %s' %(RESULT_TABLE))
+        cursor.execute('ALTER TABLE %s RENAME TO %s' %(NEW_TABLE,RESULT_TABLE))
+        cursor.execute('ALTER TABLE %s RENAME CONSTRAINT %s_pkey TO %s_pkey' %(RESULT_TABLE,NEW_TABLE,RESULT_TABLE))
+        for name,definition in indexes:
+            cursor.execute('ALTER INDEX %s_p RENAME TO %s' %(name,name))
+    stdout.write('%s is now partitioned by battery' %(RESULT_TABLE))
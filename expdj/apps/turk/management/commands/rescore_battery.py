@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk.tasks import rescore_battery, rescore_battery_results
+
+
+class Command(BaseCommand):
+    help = '''re-score the credit conditions (bonus and rejection) for every completed result in a battery'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_ids', nargs='+', type=int,
+                            help='ids of the batteries to re-score')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=500,
+                            help='number of results to load and write at once (default 500)')
+        parser.add_argument('--queue', action='store_true', dest='queue', default=False,
+                            help='fire a celery task for each battery instead of running here')
+
+    def handle(self, *args, **options):
+        for battery_id in options['battery_ids']:
+            if not Battery.objects.filter(id=battery_id).exists():
+                raise CommandError('Battery %s does not exist' %(battery_id))
+
+            if options['queue']:
+                rescore_battery.apply_async([battery_id], {"chunk_size": options['chunk_size']})
+                self.stdout.write('Queued re-scoring of battery %s' %(battery_id))
+                continue
+
+            def report(stats):
+                self.stdout.write('battery %(battery)s: %(results)s results, %(bonuses)s bonuses, '
+                                  '%(violations)s violations (%(results_per_second).1f results/s)' %(stats))
+
+            stats = rescore_battery_results(battery_id, chunk_size=options['chunk_size'], report=report)
+            self.stdout.write('Re-scored %(results)s results for battery %(battery)s in %(seconds).1f seconds' %(stats))
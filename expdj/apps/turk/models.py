@@ -3,7 +3,7 @@
 import boto
 import collections
 import datetime
-from jsonfield import JSONField
+import redis
 
 from boto.mturk.price import Price
 from boto.mturk.qualification import (AdultRequirement, NumberHitsApprovedRequirement, 
@@ -12,14 +12,18 @@ from boto.mturk.question import ExternalQuestion
 
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import Q, DO_NOTHING
-from django.db.models.signals import pre_init
+from django.core.cache import cache
+from django.db import connections, models, router, transaction
+from django.db.models import Count, Q, DO_NOTHING
+from django.db.models.signals import pre_init, post_delete, post_save
 from django.utils import timezone
 
+from expdj.apps.experiments.cache import HIT_CACHE, bump_cache_version
 from expdj.apps.experiments.models import Experiment, ExperimentTemplate, Battery
+from expdj.apps.turk.fields import JSONBField
+from expdj.apps.turk.partitions import create_battery_partition
 from expdj.apps.turk.utils import (amazon_string_to_datetime, get_connection, get_credentials, 
-    to_dict, get_time_difference)
+    to_dict, get_time_difference, get_redis_connection)
 from expdj.settings import DOMAIN_NAME, BASE_DIR
 
 
@@ -400,6 +404,7 @@ class HIT(models.Model):
             djurk_assignment = Assignment.objects.get_or_create(
                     mturk_id=mturk_assignment.AssignmentId, hit=self)[0]
             djurk_assignment.update(mturk_assignment, hit=self)
+        clear_assignment_summary(self.battery_id)
         if update_all and int(assignments.PageNumber) *\
                             page_size < int(assignments.TotalNumResults):
             self.update_assignments(page_number + 1, page_size, update_all)
@@ -426,7 +431,7 @@ class Assignment(models.Model):
     # Convenience lookup dictionaries for the above lists
     reverse_status_lookup = dict((v, k) for k, v in STATUS_CHOICES)
 
-    mturk_id = models.CharField("Assignment ID",max_length=255,blank=True,null=True,help_text="A unique identifier for the assignment")
+    mturk_id = models.CharField("Assignment ID",max_length=255,blank=True,null=True,db_index=True,help_text="A unique identifier for the assignment")
     worker = models.ForeignKey(Worker,null=True,blank=True,help_text="The ID of the Worker who accepted the HIT")
     hit = models.ForeignKey(HIT,null=True,blank=True,related_name='assignments')
     status = models.CharField(max_length=1,choices=STATUS_CHOICES,null=True,blank=True,help_text="The status of the assignment")
@@ -513,6 +518,9 @@ class Assignment(models.Model):
 
         self.save()
 
+    class Meta:
+        index_together = [["hit","status"]]
+
     def __unicode__(self):
         return self.mturk_id
 
@@ -523,13 +531,14 @@ class Assignment(models.Model):
 
 class Result(models.Model):
     '''A result holds a battery id and an experiment template, to keep track of the battery/experiment combinations that a worker has completed'''
-    taskdata = JSONField(null=True,blank=True,load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    taskdata = JSONBField(null=True,blank=True,load_kwargs={'object_pairs_hook': collections.OrderedDict})
     version = models.CharField(max_length=128,null=True,blank=True,help_text="Experiment version (github commit) at completion time of result")
     worker = models.ForeignKey(Worker,null=False,blank=False,related_name='result_worker')
     experiment = models.ForeignKey(ExperimentTemplate,help_text="The Experiment Template completed by the worker in the battery",null=False,blank=False,on_delete=DO_NOTHING)
     battery = models.ForeignKey(Battery, help_text="Battery of Experiments deployed by the HIT.", verbose_name="Experiment Battery", null=False, blank=False,on_delete=DO_NOTHING)
     assignment = models.ForeignKey(Assignment,null=True,blank=True,related_name='assignment')
     finishtime = models.DateTimeField(null=True,blank=True,help_text=("The date and time, in UTC, the Worker finished the result"))
+    serve_time = models.DateTimeField(null=True,blank=True,help_text=("The date and time, in UTC, the experiment was last served to the Worker"))
     current_trial = models.PositiveIntegerField(null=True,blank=True,help_text=("The last (current) trial recorded as complete represented in the results."))
     language = models.CharField(max_length=128,null=True,blank=True,help_text="language of the browser associated with the result")
     browser = models.CharField(max_length=128,null=True,blank=True,help_text="browser of the result")
@@ -545,6 +554,10 @@ class Result(models.Model):
         verbose_name = "Result"
         verbose_name_plural = "Results"
         unique_together = ("worker","assignment","battery","experiment")
+        index_together = [["worker","battery","completed"],
+                          ["battery","experiment"],
+                          ["battery","completed"],
+                          ["completed","serve_time"]]
 
     def __repr__(self):
         return u"Result: id[%s],worker[%s],battery[%s],experiment[%s]" %(self.id,self.worker,self.battery,self.experiment)
@@ -556,16 +569,89 @@ class Result(models.Model):
         return to_dict(self.taskdata)
 
 
+def upsert_result(worker,experiment_id,battery_id,assignment=None,defaults=None):
+    '''upsert_result creates or updates the result for a worker, experiment,
+    battery and assignment, and returns it (without taskdata loaded). On
+    PostgreSQL, a serve for an assignment is a single INSERT ... ON CONFLICT on
+    the unique_together constraint. Local serves have no assignment (NULL), which
+    the constraint doesn't cover, so the worker row is locked for the transaction
+    instead: concurrent serves for one worker (double clicks, parallel tabs) are
+    serialized and never create duplicate results.
+    :param experiment_id: the exp_id of the experiments.models.ExperimentTemplate
+    :param battery_id: the id of the experiments.models.Battery
+    :param defaults: dictionary of fields to set on the result
+    '''
+    defaults = dict(defaults or dict())
+    defaults["serve_time"] = timezone.now()
+    if assignment != None and connections[router.db_for_write(Result)].vendor == 'postgresql':
+        return insert_or_update_result(worker,experiment_id,battery_id,assignment,defaults)
+    lookup = {"worker":worker,"experiment_id":experiment_id,"battery_id":battery_id,"assignment":assignment}
+    with transaction.atomic():
+        list(Worker.objects.select_for_update().filter(id=worker.id).values_list('id',flat=True))
+        result = Result.objects.filter(**lookup).defer('taskdata').order_by('id').first()
+        if result == None:
+            lookup.update(defaults)
+            return Result.objects.create(**lookup)
+        if defaults:
+            Result.objects.filter(id=result.id).update(**defaults)
+            for field,value in defaults.items():
+                setattr(result,field,value)
+    return result
+
+
+def insert_or_update_result(worker,experiment_id,battery_id,assignment,defaults):
+    '''insert_or_update_result inserts a result, or updates the fields in defaults
+    of the existing one, in one round trip (see upsert_result)
+    '''
+    db = router.db_for_write(Result)
+    quote_name = connections[db].ops.quote_name
+    result = Result(worker=worker,experiment_id=experiment_id,battery_id=battery_id,assignment=assignment,**defaults)
+    fields = [field for field in Result._meta.concrete_fields if not field.primary_key]
+    updated = [Result._meta.get_field(field_name).column for field_name in defaults]
+    returned = [field.column for field in Result._meta.concrete_fields if field.attname != "taskdata"]
+    sql = '''INSERT INTO %s (%s) VALUES (%s)
+             ON CONFLICT (worker_id, assignment_id, battery_id, experiment_id)
+             DO UPDATE SET %s RETURNING %s''' %(quote_name(Result._meta.db_table),
+                                               ", ".join([quote_name(field.column) for field in fields]),
+                                               ", ".join(["%s"] * len(fields)),
+                                               ", ".join(["%s = EXCLUDED.%s" %(quote_name(c),quote_name(c)) for c in updated]),
+                                               ", ".join([quote_name(c) for c in returned]))
+    params = [field.get_db_prep_save(getattr(result,field.attname),connections[db]) for field in fields]
+    # A raw query leaves the fields it doesn't return (taskdata) deferred
+    return list(Result.objects.raw(sql,params,using=db))[0]
+
+
 class Bonus(models.Model):
-    '''A bonus object keeps track of a users bonuses for a battery'''
+    '''A bonus object keeps track of a users bonuses for a battery, and is the
+    payout queue entry once the bonus is sent for payment'''
+
+    (_ACCRUING, _PENDING, _PAID, _FAILED) = ("Accruing", "Pending", "Paid", "Failed")
+    (ACCRUING, PENDING, PAID, FAILED) = ("A", "P", "G", "F")
+
+    STATUS_CHOICES = (
+            (ACCRUING, _ACCRUING),
+            (PENDING, _PENDING),
+            (PAID, _PAID),
+            (FAILED, _FAILED),
+    )
+
     worker = models.ForeignKey(Worker,null=False,blank=False,help_text="The ID of the Worker who is receiving bonus")
     battery = models.ForeignKey(Battery, help_text="Battery reciving bonuses for", verbose_name="Battery of experiments for bonus", null=False, blank=False)
-    amounts = JSONField(null=True,blank=True,help_text="dictionary of experiments with bonus amounts",load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    amounts = JSONBField(null=True,blank=True,help_text="dictionary of experiments with bonus amounts",load_kwargs={'object_pairs_hook': collections.OrderedDict})
     # {u'test_task': {'description': u'performance_var True EQUALS True', 'experiment_id': 113, 'amount': 3.0} # amount in dollars/cents
     granted = models.BooleanField(choices=((False, 'Not bonused'),
                                           (True, 'Bonus granted')),
                                            default=False,help_text="Participant bonus status",verbose_name="bonus status")
 
+    # Payout queue
+    status = models.CharField(max_length=1,choices=STATUS_CHOICES,default=ACCRUING,help_text="The payout status of the bonus")
+    assignment = models.ForeignKey(Assignment,null=True,blank=True,related_name='bonuses',help_text="The assignment the bonus is paid against")
+    idempotency_key = models.CharField(max_length=64,unique=True,null=True,blank=True,help_text="Unique request token sent with the payment, so retries never pay twice")
+    attempts = models.PositiveIntegerField(default=0,help_text="The number of payment attempts")
+    next_attempt_time = models.DateTimeField(null=True,blank=True,help_text=("The date and time, in UTC, the payment is next due to be attempted"))
+    paid_time = models.DateTimeField(null=True,blank=True,help_text=("The date and time, in UTC, the bonus was paid"))
+    last_error = models.TextField(null=True,blank=True,help_text="The error returned by the last failed payment attempt")
+
     def __unicode__(self):
         return "<%s_%s>" %(self.battery,self.worker)
 
@@ -583,6 +669,7 @@ class Bonus(models.Model):
         verbose_name = "Bonus"
         verbose_name_plural = "Bonuses"
         unique_together = ("worker","battery")
+        index_together = [["status","next_attempt_time"]]
 
 
 
@@ -591,8 +678,9 @@ class Blacklist(models.Model):
     worker = models.ForeignKey(Worker,null=False,blank=False,help_text="The ID of the Worker who is or is pending blacklising")
     blacklist_time = models.DateTimeField(null=True,blank=True,help_text=("Time of blacklist"))
     battery = models.ForeignKey(Battery, help_text="Battery blacklisted from", verbose_name="Battery of experiments", null=False, blank=False)
-    flags = JSONField(null=True,blank=True,help_text="dictionary of experiments with violations",load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    flags = JSONBField(null=True,blank=True,help_text="dictionary of experiments with violations",load_kwargs={'object_pairs_hook': collections.OrderedDict})
     # {u'test_task': {'description': u'credit_var True EQUALS True', 'experiment_id': 113}
+    flag_count = models.PositiveIntegerField(default=0,help_text="The number of experiments with violations")
     active = models.BooleanField(choices=((False, 'Not Blacklisted'),
                                           (True, 'Blacklisted')),
                                            default=False,help_text="Participant blacklist status",verbose_name="blacklist status")
@@ -605,3 +693,155 @@ class Blacklist(models.Model):
         verbose_name = "Blacklist"
         verbose_name_plural = "Blacklists"
         unique_together = ("worker","battery")
+        index_together = [["battery","active"]]
+
+
+class ResultArchive(models.Model):
+    '''A result archive is a compressed file of results moved out of the results table (completed results of an inactive battery, or abandoned incomplete results)'''
+    battery = models.ForeignKey(Battery,null=False,blank=False,related_name='result_archives')
+    storage = models.CharField(max_length=16,help_text="The storage holding the archive file (local or s3)")
+    location = models.CharField(max_length=512,help_text="The name of the archive file in the storage")
+    result_count = models.PositiveIntegerField(default=0,help_text="The number of results in the archive")
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "<%s_%s>" %(self.battery,self.location)
+
+    class Meta:
+        verbose_name = "Result Archive"
+        verbose_name_plural = "Result Archives"
+
+
+class ArchivedResult(models.Model):
+    '''An archived result is the stub left for a result moved to a ResultArchive, so a worker's history of completed experiments (eg, for battery dependencies) includes it'''
+    archive = models.ForeignKey(ResultArchive,null=False,blank=False,related_name='stubs')
+    result_id = models.PositiveIntegerField(help_text="The id the result had in the results table")
+    worker = models.ForeignKey(Worker,null=False,blank=False,related_name='archived_result_worker')
+    experiment = models.ForeignKey(ExperimentTemplate,null=False,blank=False)
+    battery = models.ForeignKey(Battery,null=False,blank=False)
+    finishtime = models.DateTimeField(null=True,blank=True)
+    completed = models.BooleanField(default=True,help_text="False for abandoned results archived by garbage collection")
+
+    class Meta:
+        verbose_name = "Archived Result"
+        verbose_name_plural = "Archived Results"
+        index_together = [["worker","battery"],["battery","experiment"]]
+
+
+# ASSIGNMENT SUMMARY ###########################################################
+# Assignment status counts for a battery, from one aggregate query, cached
+# briefly and dropped when the assignments of a battery HIT are updated.
+
+ASSIGNMENT_SUMMARY_SECONDS = 60
+
+# Summary keys for each assignment status (None is not yet submitted)
+assignment_summary_lookup = {Assignment.APPROVED:"accepted",
+                             Assignment.SUBMITTED:"submit",
+                             Assignment.REJECTED:"rejected",
+                             None:"none"}
+
+def get_assignment_summary_key(battery_id):
+    return "expdj:assignment_summary:%s" %(battery_id)
+
+def get_assignment_summary(battery_id):
+    '''get_assignment_summary returns a dictionary with the number of battery
+    assignments for each status (accepted, submit, rejected, none) and total
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    key = get_assignment_summary_key(battery_id)
+    summary = cache.get(key)
+    if summary == None:
+        summary = dict((name,0) for name in assignment_summary_lookup.values())
+        counts = Assignment.objects.filter(hit__battery_id=battery_id).values('status').annotate(count=Count('id'))
+        for count in counts:
+            name = assignment_summary_lookup.get(count['status'])
+            if name != None:
+                summary[name] += count['count']
+        summary["total"] = sum(summary.values())
+        cache.set(key,summary,ASSIGNMENT_SUMMARY_SECONDS)
+    return summary
+
+def clear_assignment_summary(battery_id):
+    cache.delete(get_assignment_summary_key(battery_id))
+
+
+# BLACKLIST CACHE ##############################################################
+# Active blacklists for a battery are kept in a redis set of worker ids, so the
+# serve path can check membership without a database query. The database is
+# the source of truth: the set is rebuilt from it when missing, and a sentinel
+# member marks a loaded set (so an empty blacklist is still cached).
+
+BLACKLIST_SENTINEL = "-"
+BLACKLIST_CACHE_SECONDS = 3600
+
+def get_blacklist_key(battery_id):
+    return "expdj:blacklist:%s" %(battery_id)
+
+def load_blacklist_cache(battery_id,connection=None):
+    '''load_blacklist_cache rebuilds the redis set of blacklisted workers for a
+    battery from the database, and returns the set of worker ids
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    connection = connection or get_redis_connection()
+    worker_ids = set(Blacklist.objects.filter(battery_id=battery_id,active=True).values_list('worker_id',flat=True))
+    key = get_blacklist_key(battery_id)
+    pipe = connection.pipeline()
+    pipe.delete(key)
+    pipe.sadd(key,BLACKLIST_SENTINEL,*worker_ids)
+    pipe.expire(key,BLACKLIST_CACHE_SECONDS)
+    pipe.execute()
+    return worker_ids
+
+def clear_blacklist_cache(battery_id):
+    '''clear_blacklist_cache drops the cached set for a battery, to be rebuilt
+    on the next check. Use after bulk writes that don't send signals.
+    '''
+    try:
+        get_redis_connection().delete(get_blacklist_key(battery_id))
+    except redis.RedisError:
+        pass
+
+def is_blacklisted(worker_id,battery_id):
+    '''is_blacklisted checks if a worker is actively blacklisted from a battery,
+    from the redis set when possible, and the database otherwise
+    :param worker_id: the id of the turk.models.Worker
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    try:
+        connection = get_redis_connection()
+        key = get_blacklist_key(battery_id)
+        pipe = connection.pipeline()
+        pipe.sismember(key,worker_id)
+        pipe.exists(key)
+        member,loaded = pipe.execute()
+        if loaded:
+            return bool(member)
+        return worker_id in load_blacklist_cache(battery_id,connection)
+    except redis.RedisError:
+        return Blacklist.objects.filter(worker_id=worker_id,battery_id=battery_id,active=True).exists()
+
+def update_blacklist_cache(sender,instance,**kwargs):
+    '''keep a loaded blacklist set in sync when a Blacklist is saved or deleted'''
+    active = instance.active and kwargs.get('signal') != post_delete
+    try:
+        connection = get_redis_connection()
+        key = get_blacklist_key(instance.battery_id)
+        if active:
+            # Only add to a loaded set, a missing set is rebuilt on the next check
+            if connection.exists(key):
+                connection.sadd(key,instance.worker_id)
+        else:
+            connection.srem(key,instance.worker_id)
+    except redis.RedisError:
+        pass
+
+post_save.connect(update_blacklist_cache, sender=Blacklist)
+post_delete.connect(update_blacklist_cache, sender=Blacklist)
+post_save.connect(create_battery_partition, sender=Battery)
+
+def hit_changed(sender,instance,**kwargs):
+    '''invalidate cached data of a HIT (see experiments/cache.py)'''
+    bump_cache_version(HIT_CACHE,instance.pk)
+
+post_save.connect(hit_changed, sender=HIT)
+post_delete.connect(hit_changed, sender=HIT)
@@ -0,0 +1,124 @@
+'''partitions.py: list partitioning of the turk_result table by battery
+
+Once the partition_results command has converted turk_result, it is a
+PostgreSQL table partitioned by LIST (battery_id), with one partition per
+battery (turk_result_b<id>) and a default partition for anything else. The
+ORM is unchanged: Django reads and writes the parent table, and queries by
+battery (exports, dashboards, the API) only touch that battery's partition.
+A battery's partition can be detached (for archiving) or dropped without
+touching the rest of the results. This needs PostgreSQL 11 or later (a
+default partition, and primary keys and ON CONFLICT on a partitioned table).
+'''
+
+from django.db import DatabaseError, connection, transaction
+
+
+RESULT_TABLE = "turk_result"
+DEFAULT_PARTITION = "turk_result_default"
+
+# Don't queue behind long running queries for the short DDL locks
+PARTITION_LOCK_TIMEOUT = "5s"
+
+# The first PostgreSQL version (as connection.pg_version) that can partition turk_result
+PARTITION_PG_VERSION = 110000
+
+
+def get_partition_name(battery_id):
+    return "%s_b%s" %(RESULT_TABLE,int(battery_id))
+
+
+def partitioning_supported():
+    return connection.vendor == 'postgresql' and connection.pg_version >= PARTITION_PG_VERSION
+
+
+def check_partitioning_supported():
+    '''check_partitioning_supported raises an error if the database can't partition
+    turk_result, before any of it is converted
+    '''
+    if connection.vendor != 'postgresql':
+        raise DatabaseError('partitioning results needs PostgreSQL')
+    if not partitioning_supported():
+        raise DatabaseError('partitioning results needs PostgreSQL 11 or later, the database is version %s'
+                            %(connection.pg_version))
+
+
+def results_partitioned():
+    '''results_partitioned returns True if turk_result is a partitioned table (never
+    on a database that can't partition it)
+    '''
+    if not partitioning_supported():
+        return False
+    cursor = connection.cursor()
+    cursor.execute('''SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+                      WHERE c.relname = %s''',[RESULT_TABLE])
+    return cursor.fetchone() != None
+
+
+def partition_exists(battery_id):
+    cursor = connection.cursor()
+    cursor.execute('''SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                      WHERE i.inhparent = %s::regclass AND c.relname = %s''',
+                   [RESULT_TABLE,get_partition_name(battery_id)])
+    return cursor.fetchone() != None
+
+
+def create_result_partition(battery_id):
+    '''create_result_partition creates the partition for a battery, moving any
+    of its results out of the default partition. Returns True if a partition
+    was created.
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    if not results_partitioned() or partition_exists(battery_id):
+        return False
+    partition = get_partition_name(battery_id)
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL lock_timeout = '%s'" %(PARTITION_LOCK_TIMEOUT))
+        cursor.execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' %(DEFAULT_PARTITION))
+        cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' %(partition,RESULT_TABLE))
+        cursor.execute('''WITH moved AS (DELETE FROM %s WHERE battery_id = %%s RETURNING *)
+                          INSERT INTO %s SELECT * FROM moved''' %(DEFAULT_PARTITION,partition),
+                       [int(battery_id)])
+        cursor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%s)'
+                       %(RESULT_TABLE,partition,int(battery_id)))
+    return True
+
+
+def create_battery_partition(sender,instance,created,**kwargs):
+    '''give a new battery its own result partition. If the table lock can't be
+    taken quickly, its results go to the default partition until the next
+    partition_results run moves them out.
+    '''
+    if not created:
+        return
+    try:
+        create_result_partition(instance.id)
+    except DatabaseError:
+        pass
+
+
+def detach_result_partition(battery_id):
+    '''detach_result_partition detaches a battery's partition, leaving its
+    results in a standalone table (eg, to archive), and returns the table name,
+    or None if the battery has no partition.
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    if not results_partitioned() or not partition_exists(battery_id):
+        return None
+    partition = get_partition_name(battery_id)
+    cursor = connection.cursor()
+    cursor.execute('ALTER TABLE %s DETACH PARTITION %s' %(RESULT_TABLE,partition))
+    return partition
+
+
+def drop_result_partition(battery_id):
+    '''drop_result_partition detaches and drops a battery's partition, and all
+    results in it. Returns True if a partition was dropped.
+    :param battery_id: the id of the experiments.models.Battery
+    '''
+    partition = detach_result_partition(battery_id)
+    if partition == None:
+        return False
+    cursor = connection.cursor()
+    cursor.execute('DROP TABLE %s' %(partition))
+    return True
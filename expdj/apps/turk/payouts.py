@@ -0,0 +1,220 @@
+'''payouts.py: the bonus payout queue
+
+Bonuses are queued for payment (Bonus.status PENDING) when a worker's credit is
+assigned, and paid in batches by the process_bonus_payouts task. Each MTurk
+credentials file has its own token bucket in redis, so all celery workers share
+one rate limit per requester account. Every payment carries the bonus
+idempotency key as the MTurk UniqueRequestToken, so a retry never pays twice.
+'''
+
+from datetime import timedelta
+import time
+import uuid
+
+from boto.mturk.price import Price
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from expdj.apps.turk.models import Bonus
+from expdj.apps.turk.utils import get_connection, get_credentials, get_redis_connection
+
+
+# Atomically refill the bucket for the time elapsed, and take tokens if available
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local allowed = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return allowed
+"""
+
+
+class TokenBucket(object):
+    '''A token bucket rate limiter kept in redis, shared by every process that
+    uses the same name.
+    '''
+
+    def __init__(self,name,rate,capacity,connection=None):
+        self.key = "expdj:tokenbucket:%s" %(name)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.connection = connection or get_redis_connection()
+        self.script = self.connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def consume(self,tokens=1):
+        '''consume takes tokens from the bucket, and returns False if there are
+        not enough (the caller should wait about 1/rate seconds)
+        '''
+        allowed = self.script(keys=[self.key],args=[self.rate,self.capacity,time.time(),tokens])
+        return bool(allowed)
+
+
+def get_bonus_bucket(credentials):
+    '''get_bonus_bucket returns the GrantBonus rate limiter for a credentials file
+    :param credentials: the name of the battery credentials file
+    '''
+    return TokenBucket("grant_bonus:%s" %(credentials),
+                       rate=settings.MTURK_BONUS_RATE,
+                       capacity=settings.MTURK_BONUS_BURST)
+
+
+def get_bonus_reason(bonus):
+    '''get_bonus_reason parses through worker bonus amounts, and returns a message to the worker for the reason
+    :param bonus: expdj.apps.turk.models.Bonus object
+    '''
+    amounts = dict(bonus.amounts)
+    reason = ""
+    for experiment_name,record in amounts.iteritems():
+        new_reason = "%s: granted $%s because %s\n" %(experiment_name,record["amount"],record["description"])
+        reason = "%s%s" %(reason,new_reason)
+    return reason
+
+
+def queue_bonus(bonus,assignment):
+    '''queue_bonus marks a bonus as pending payment against an assignment. A
+    bonus that is already queued or paid is left as it is.
+    :param bonus: turk.models.Bonus
+    :param assignment: turk.models.Assignment to pay the bonus against
+    :returns: True if the bonus was newly queued
+    '''
+    if bonus.granted == True or bonus.status in [Bonus.PENDING,Bonus.PAID]:
+        return False
+    if bonus.calculate_bonus() <= 0:
+        return False
+    if bonus.idempotency_key == None:
+        bonus.idempotency_key = uuid.uuid4().hex
+    bonus.assignment = assignment
+    bonus.status = Bonus.PENDING
+    bonus.next_attempt_time = timezone.now()
+    bonus.save()
+    return True
+
+
+def get_due_bonuses(limit):
+    '''get_due_bonuses returns pending bonuses that are due for a payment attempt'''
+    due = Q(next_attempt_time__isnull=True) | Q(next_attempt_time__lte=timezone.now())
+    bonuses = Bonus.objects.filter(due,status=Bonus.PENDING,assignment__isnull=False)
+    return bonuses.select_related('worker','battery','assignment__hit').order_by('next_attempt_time','id')[:limit]
+
+
+def claim_bonus(bonus,lease_seconds=300):
+    '''claim_bonus takes a pending bonus for this worker by pushing its next
+    attempt time past the lease, so concurrent workers skip it. If this process
+    dies mid-payment the bonus becomes due again when the lease runs out, and
+    the idempotency key makes the retry safe.
+    :returns: True if the bonus was claimed
+    '''
+    lease = timezone.now() + timedelta(seconds=lease_seconds)
+    claimed = Bonus.objects.filter(id=bonus.id,status=Bonus.PENDING,
+                                   next_attempt_time=bonus.next_attempt_time).update(next_attempt_time=lease)
+    if claimed == 1:
+        bonus.next_attempt_time = lease
+    return claimed == 1
+
+
+def release_bonus(bonus,next_attempt_time):
+    '''release_bonus gives back a claimed bonus that wasn't attempted (eg, throttled),
+    so it is due again at its previous attempt time
+    '''
+    Bonus.objects.filter(id=bonus.id,status=Bonus.PENDING,
+                         next_attempt_time=bonus.next_attempt_time).update(next_attempt_time=next_attempt_time)
+    bonus.next_attempt_time = next_attempt_time
+
+
+def send_bonus(connection,bonus):
+    '''send_bonus calls MTurk GrantBonus with the bonus idempotency key as the
+    UniqueRequestToken. This mirrors boto's MTurkConnection.grant_bonus, which
+    does not accept a request token.
+    '''
+    params = Price(bonus.calculate_bonus()).get_as_params('BonusAmount',1)
+    params['WorkerId'] = bonus.worker_id
+    params['AssignmentId'] = bonus.assignment.mturk_id
+    params['Reason'] = get_bonus_reason(bonus)
+    params['UniqueRequestToken'] = bonus.idempotency_key
+    return connection._process_request('GrantBonus',params)
+
+
+def record_bonus_failure(bonus,error):
+    '''record_bonus_failure schedules a retry with exponential backoff, or marks
+    the bonus failed once it runs out of attempts
+    '''
+    bonus.attempts += 1
+    bonus.last_error = str(error)[:2000]
+    if bonus.attempts >= settings.MTURK_BONUS_MAX_ATTEMPTS:
+        bonus.status = Bonus.FAILED
+        bonus.next_attempt_time = None
+    else:
+        backoff = settings.MTURK_BONUS_RETRY_SECONDS * (2 ** (bonus.attempts - 1))
+        bonus.next_attempt_time = timezone.now() + timedelta(seconds=backoff)
+    bonus.save(update_fields=["attempts","last_error","status","next_attempt_time"])
+
+
+def record_bonus_paid(bonus):
+    bonus.attempts += 1
+    bonus.status = Bonus.PAID
+    bonus.granted = True
+    bonus.paid_time = timezone.now()
+    bonus.next_attempt_time = None
+    bonus.last_error = None
+    bonus.save(update_fields=["attempts","status","granted","paid_time","next_attempt_time","last_error"])
+
+
+def pay_bonuses(batch_size=None):
+    '''pay_bonuses pays one batch of due bonuses, respecting the token bucket of
+    each credentials file. Returns a dictionary with the number of bonuses paid,
+    failed (for this attempt) and throttled, and whether more are due.
+    :param batch_size: the maximum number of bonuses to attempt
+    '''
+    batch_size = batch_size or settings.MTURK_BONUS_BATCH_SIZE
+    stats = {"paid":0,"failed":0,"throttled":0,"more":False}
+    connections = dict()
+    buckets = dict()
+    throttled = set()
+
+    bonuses = list(get_due_bonuses(batch_size))
+    for bonus in bonuses:
+        hit = bonus.assignment.hit
+        credentials = bonus.battery.credentials
+        if credentials in throttled:
+            stats["throttled"] += 1
+            continue
+        # Claimed before taking a token, so a bonus leased by another worker doesn't use one
+        due_time = bonus.next_attempt_time
+        if not claim_bonus(bonus):
+            continue
+        if credentials not in buckets:
+            buckets[credentials] = get_bonus_bucket(credentials)
+        if not buckets[credentials].consume():
+            release_bonus(bonus,due_time)
+            throttled.add(credentials)
+            stats["throttled"] += 1
+            continue
+
+        connection_key = (credentials,hit.sandbox)
+        try:
+            if connection_key not in connections:
+                aws_access_key_id,aws_secret_access_key = get_credentials(battery=bonus.battery)
+                connections[connection_key] = get_connection(aws_access_key_id,aws_secret_access_key,hit=hit)
+            send_bonus(connections[connection_key],bonus)
+        except Exception as error:
+            record_bonus_failure(bonus,error)
+            stats["failed"] += 1
+        else:
+            record_bonus_paid(bonus)
+            stats["paid"] += 1
+
+    stats["more"] = stats["throttled"] > 0 or len(bonuses) == batch_size
+    return stats
@@ -1,17 +1,29 @@
 from __future__ import absolute_import
 
+import json
 import numpy
 import os
+import time
 
-from boto.mturk.price import Price
+from datetime import timedelta
 from celery import shared_task, Celery
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
 from django.utils import timezone
 
-from expdj.apps.experiments.models import ExperimentTemplate, Battery
+from expdj.apps.experiments.models import ExperimentTemplate, Experiment, Battery
 from expdj.apps.experiments.utils import get_experiment_type
-from expdj.apps.turk.models import Result, Assignment, get_worker, HIT, Blacklist, Bonus
+from expdj.apps.experiments.versions import remove_experiment
+from expdj.apps.turk.archive import archive_results, delete_battery_archives
+from expdj.apps.turk.credit import (get_variable_column, parse_variable_name,
+    score_results, summarize_column, taskdata_in_sql)
+from expdj.apps.turk.models import (Result, Assignment, get_worker, HIT, Blacklist, Bonus,
+    clear_blacklist_cache)
+from expdj.apps.turk.partitions import drop_result_partition
+from expdj.apps.turk.payouts import pay_bonuses, queue_bonus
+from expdj.apps.turk.utils import bulk_update
 from expdj.settings import TURK
 
 #  trying to import Result object directly from models was giving an import
@@ -59,158 +71,298 @@ def assign_experiment_credit(worker_id):
                 grant_bonus(result.id)
 
 
+@shared_task
+def evaluate_credit(result_id,bonus=True,rejection=True):
+    '''evaluate_credit is the single credit evaluation pipeline for a finished
+    result. The result, the battery experiment and its credit conditions are
+    loaded once, bonus (performance) and rejection (catch) conditions are
+    evaluated in the same pass, and the Bonus and Blacklist updates are written
+    in one transaction.
+    :param result_id: the id of the result object, turk.models.Result
+    :param bonus: evaluate conditions on the performance variable (default True)
+    :param rejection: evaluate conditions on the rejection variable (default True)
+    '''
+    results = Result.objects.select_related('worker','battery','experiment')
+    if taskdata_in_sql():
+        results = results.defer('taskdata')
+    try:
+        result = results.get(id=result_id)
+    except Result.DoesNotExist:
+        return
+
+    experiment = get_result_experiment(result)
+    if experiment == None or result.completed != True:
+        return
+
+    battery = result.battery
+    scores = score_results(experiment,[result],
+                           bonus=bonus and battery.bonus_active,
+                           rejection=rejection and battery.blacklist_active)
+    if result.id not in scores:
+        return
+
+    violation = scores[result.id]["violation"]
+    bonus_record = scores[result.id]["bonus"]
+    with transaction.atomic():
+        if violation != None:
+            blacklist,_ = Blacklist.objects.select_for_update().get_or_create(worker=result.worker,battery=battery)
+            add_blacklist(blacklist,experiment,violation)
+        if bonus_record != None:
+            description,amount = bonus_record
+            worker_bonus,_ = Bonus.objects.select_for_update().get_or_create(worker=result.worker,battery=battery)
+            add_bonus(worker_bonus,experiment,description,amount)
+            Result.objects.filter(id=result.id).update(credit_granted=True)
+
+
 @shared_task
 def check_blacklist(result_id):
     '''check_blacklist compares a result (associated with an experiment) against
-    the rejection criteria, and adds a flag to the user/battery blacklist object
-    in the case of a violation. When the user/battery blacklist flag count
-    exceeds the battery.blacklist_threshold, the user is blacklisted.
-    :param result: a turk.models.Result object
+    the rejection criteria only. Kept for tasks queued before evaluate_credit,
+    which checks rejection and bonus criteria together.
+    :param result_id: the id of the result object, turk.models.Result
     '''
+    evaluate_credit(result_id,bonus=False)
 
-    result = Result.objects.get(id=result_id)
-    worker = result.worker
-    battery = result.battery
-    experiment_template = result.experiment
-    experiment = [b for b in battery.experiments.all() if b.template == experiment_template]
-
-    if len(experiment) > 0:
-        experiment = experiment[0]
-
-        # rejection criteria
-        do_catch = True if experiment_template.rejection_variable != None and experiment.include_catch == True else False
-        do_blacklist = battery.blacklist_active
-        found_violation = False
-
-        if result.completed == True and do_catch == True and do_blacklist == True:
-
-            # A credit condition can be for reward or rejection
-            for credit_condition in experiment.credit_conditions.all():
-                variable_name = credit_condition.variable.name
-                variables = get_variables(result,variable_name)
-                func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-                func_description = [x[0] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-
-                # Look through variables and determine if in violation of condition
-                for variable in variables:
-                    comparator = credit_condition.value
-                    if isinstance(variable,bool):
-                        comparator = bool(comparator)
-                    elif isinstance(variable,float) or isinstance(variable,int):
-                        variable = float(variable)
-                    if not isinstance(comparator,bool) and (isinstance(comparator,float) or isinstance(comparator,int)):
-                        comparator = float(comparator)
-
-                    # If the variable passes criteria and it's a rejection variable
-                    if func(variable,comparator):
-                        if credit_condition.variable == experiment_template.rejection_variable and found_violation == False:
-                            found_violation = True
-                            description = "%s %s %s %s" %(variable_name,variable,func_description,comparator)
-                            blacklist,_ = Blacklist.objects.get_or_create(worker=worker,battery=battery)
-                            add_blacklist(blacklist,experiment,description)
+
+@shared_task
+def experiment_reward(result_id):
+    '''experiment_reward records a bonus based on the reward criteria only. Kept
+    for tasks queued before evaluate_credit, which checks rejection and bonus
+    criteria together.
+    :param result_id: the id of the result object, turk.models.Result
+    '''
+    evaluate_credit(result_id,rejection=False)
+
+
+@shared_task
+def rescore_battery(battery_id,chunk_size=500):
+    '''rescore_battery re-evaluates the credit conditions for every completed
+    result in a battery, and should be fired when a researcher changes a
+    CreditCondition. Returns the number of results and the throughput.
+    :param battery_id: the id of the experiments.models.Battery
+    :param chunk_size: the number of results to load and write at once
+    '''
+    return rescore_battery_results(battery_id,chunk_size=chunk_size)
+
+
+def rescore_battery_results(battery_id,chunk_size=500,report=None):
+    '''rescore_battery_results streams the completed results of a battery in
+    chunks ordered by id, scores each chunk with the compiled credit conditions,
+    and writes the Bonus and Blacklist rows for the chunk in bulk.
+    :param battery_id: the id of the experiments.models.Battery
+    :param chunk_size: the number of results to load and write at once
+    :param report: optional function called with the running stats after each chunk
+    '''
+    battery = Battery.objects.get(id=battery_id)
+    experiments = battery.experiments.select_related('template').prefetch_related('credit_conditions__variable')
+    experiments = dict((e.template_id,e) for e in experiments)
+    results = Result.objects.filter(battery=battery,completed=True,
+                                    experiment_id__in=experiments.keys()).order_by('id')
+    if taskdata_in_sql():
+        results = results.defer('taskdata')
+
+    stats = {"battery":battery.id,"results":0,"bonuses":0,"violations":0,"seconds":0.0,"results_per_second":0.0}
+    start = time.time()
+    last_id = 0
+    while True:
+        chunk = list(results.filter(id__gt=last_id)[:chunk_size])
+        if len(chunk) == 0:
+            break
+        last_id = chunk[-1].id
+        bonuses,violations = apply_battery_scores(battery,experiments,chunk)
+        stats["results"] += len(chunk)
+        stats["bonuses"] += bonuses
+        stats["violations"] += violations
+        stats["seconds"] = time.time() - start
+        stats["results_per_second"] = stats["results"] / max(stats["seconds"],1e-6)
+        if report != None:
+            report(stats)
+    return stats
+
+
+def apply_battery_scores(battery,experiments,results):
+    '''apply_battery_scores scores a chunk of battery results and rewrites the
+    worker Bonus and Blacklist entries for the experiments in the chunk. Entries
+    for results that no longer satisfy a condition are removed, unless the bonus
+    was already granted. Returns the number of bonuses and violations found.
+    :param battery: experiments.models.Battery
+    :param experiments: dictionary of battery Experiments keyed by template id
+    :param results: list of completed turk.models.Result in the battery
+    '''
+    scores = dict()
+    by_experiment = dict()
+    for result in results:
+        by_experiment.setdefault(result.experiment_id,[]).append(result)
+    for template_id,experiment_results in by_experiment.iteritems():
+        scores.update(score_results(experiments[template_id],experiment_results,
+                                    bonus=battery.bonus_active,
+                                    rejection=battery.blacklist_active))
+
+    worker_ids = set([r.worker_id for r in results])
+    bonus_count = 0
+    violation_count = 0
+    with transaction.atomic():
+        bonuses = Bonus.objects.select_for_update().filter(battery=battery,worker_id__in=worker_ids)
+        bonuses = dict((b.worker_id,b) for b in bonuses)
+        blacklists = Blacklist.objects.select_for_update().filter(battery=battery,worker_id__in=worker_ids)
+        blacklists = dict((b.worker_id,b) for b in blacklists)
+        new_bonuses = dict()
+        new_blacklists = dict()
+        granted = []
+
+        for result in results:
+            experiment = experiments[result.experiment_id]
+            exp_id = result.experiment_id
+            score = scores.get(result.id,{"bonus":None,"violation":None})
+
+            if battery.bonus_active:
+                bonus = bonuses.get(result.worker_id) or new_bonuses.get(result.worker_id)
+                if score["bonus"] != None:
+                    description,amount = score["bonus"]
+                    if bonus == None:
+                        bonus = new_bonuses[result.worker_id] = Bonus(worker_id=result.worker_id,battery=battery)
+                    amounts = bonus.amounts or dict()
+                    amounts[exp_id] = {"experiment_id":experiment.id,"description":description,"amount":amount}
+                    bonus.amounts = amounts
+                    granted.append(result.id)
+                    bonus_count += 1
+                elif bonus != None and bonus.granted == False and bonus.amounts and exp_id in bonus.amounts:
+                    del bonus.amounts[exp_id]
+
+            if battery.blacklist_active:
+                blacklist = blacklists.get(result.worker_id) or new_blacklists.get(result.worker_id)
+                if score["violation"] != None:
+                    if blacklist == None:
+                        blacklist = new_blacklists[result.worker_id] = Blacklist(worker_id=result.worker_id,battery=battery)
+                    flags = blacklist.flags or dict()
+                    flags[exp_id] = {"experiment_id":experiment.id,"description":score["violation"]}
+                    blacklist.flags = flags
+                    violation_count += 1
+                elif blacklist != None and blacklist.flags and exp_id in blacklist.flags:
+                    del blacklist.flags[exp_id]
+
+        if battery.bonus_active:
+            Bonus.objects.bulk_create(new_bonuses.values())
+            bulk_update(bonuses.values(),["amounts"])
+            result_ids = [r.id for r in results]
+            Result.objects.filter(id__in=result_ids).exclude(id__in=granted).update(credit_granted=False)
+            Result.objects.filter(id__in=granted).update(credit_granted=True)
+
+        if battery.blacklist_active:
+            # If the blacklist count is greater than acceptable count, user is blacklisted
+            for blacklist in blacklists.values() + new_blacklists.values():
+                blacklist.flag_count = len(blacklist.flags or dict())
+                active = blacklist.flag_count > battery.blacklist_threshold
+                if active and not blacklist.active:
+                    blacklist.blacklist_time = timezone.now()
+                blacklist.active = active
+            Blacklist.objects.bulk_create(new_blacklists.values())
+            bulk_update(blacklists.values(),["flags","flag_count","active","blacklist_time"])
+
+    # Bulk writes don't send signals, so the cached blacklist is rebuilt
+    if battery.blacklist_active:
+        clear_blacklist_cache(battery.id)
+    return bonus_count,violation_count
+
+
+def get_result_experiment(result):
+    '''get_result_experiment returns the battery Experiment that a result was
+    completed for, with credit conditions (and their variables) prefetched, or
+    None if the experiment is no longer part of the battery.
+    :param result: a turk.models.Result object
+    '''
+    experiments = Experiment.objects.filter(battery_experiments__id=result.battery_id,
+                                            template_id=result.experiment_id)
+    return experiments.select_related('template').prefetch_related('credit_conditions__variable').first()
 
 
 def add_blacklist(blacklist,experiment,description):
     '''add_blacklist will add an entry to the blacklist flagged (json) list, and
     check if the new number exceeds the allowed threshold. If yes, the user
-    is blacklisted and not allowed to continue the battery.
+    is blacklisted and not allowed to continue the battery. An experiment is
+    only flagged (and counted) once, so a repeat violation writes nothing.
     :param blacklist: turk.models.Blacklist object
     :param experiment: experiments.models.Experiment
     '''
-    new_flag = {"experiment_id":experiment.id,
-                "description":description}
-    if blacklist.flags == None:
-        flags = dict()
-        flags[experiment.template.exp_id] = new_flag
+    exp_id = experiment.template.exp_id
+    flags = blacklist.flags or dict()
+    if exp_id in flags:
+        return
+
+    flag = {"experiment_id":experiment.id,
+            "description":description}
+    if blacklist.pk != None and connection.vendor == 'postgresql':
+        flag_count = add_blacklist_flag(blacklist,exp_id,flag)
+        if flag_count == None:
+            return # flagged meanwhile
+        flags[exp_id] = flag
         blacklist.flags = flags
+        blacklist.flag_count = flag_count
+        update_fields = []
     else:
-        blacklist.flags[experiment.template.exp_id] = new_flag
+        flags[exp_id] = flag
+        blacklist.flags = flags
+        # Rows flagged before flag_count existed start from their number of flags
+        blacklist.flag_count = max(blacklist.flag_count,len(flags) - 1) + 1
+        update_fields = ["flags","flag_count"]
 
     # If the blacklist count is greater than acceptable count, user is blacklisted
-    if len(blacklist.flags) > blacklist.battery.blacklist_threshold:
+    if not blacklist.active and blacklist.flag_count > blacklist.battery.blacklist_threshold:
         blacklist.active = True
         blacklist.blacklist_time = timezone.now()
-    blacklist.save()
+        update_fields += ["active","blacklist_time"]
+    if blacklist.pk == None:
+        blacklist.save()
+    elif len(update_fields) > 0:
+        blacklist.save(update_fields=update_fields)
 
 
-def get_bonus_reason(bonus):
-    '''get_bonus_reason parses through worker bonus amounts, and returns a message to the worker for the reason
-    :param bonus: expdj.apps.turk.models.Bonus object
+def add_blacklist_flag(blacklist,exp_id,flag):
+    '''add_blacklist_flag adds a flag to the jsonb flags of a stored blacklist and
+    increments its flag_count in one UPDATE, so concurrent violations are all
+    counted. Returns the new flag_count, or None if the experiment was already flagged.
     '''
-    amounts = dict(bonus.amounts)
-    reason = ""
-    for experiment_name,record in amounts.iteritems():
-        new_reason = "%s: granted $%s because %s\n" %(experiment_name,record["amount"],record["description"])
-        reason = "%s%s" %(reason,new_reason)
-    return reason
+    cursor = connection.cursor()
+    # Rows flagged before flag_count existed start from their number of flags
+    cursor.execute('''UPDATE %s SET flags = COALESCE(flags,'{}'::jsonb) || jsonb_build_object(%%s,%%s::jsonb),
+                      flag_count = GREATEST(flag_count,(SELECT COUNT(*) FROM jsonb_object_keys(COALESCE(flags,'{}'::jsonb)))) + 1
+                      WHERE id = %%s AND NOT COALESCE(flags,'{}'::jsonb) ? %%s
+                      RETURNING flag_count''' %(Blacklist._meta.db_table),
+                   [exp_id,json.dumps(flag),blacklist.pk,exp_id])
+    row = cursor.fetchone()
+    if row == None:
+        return None
+    return row[0]
+
 
 def grant_bonus(result_id):
-    '''grant_bonus will calculate and grant a total bonus for a worker
+    '''grant_bonus will calculate a total bonus for a worker, and queue it for
+    payment against the result assignment. Payments are made (rate limited and
+    retried) by process_bonus_payouts.
     :param result_id: the id the result to grant the bonus for
     '''
-    result = Result.objects.get(id=result_id)
-    worker = result.worker
-    battery = result.battery
-    result.assignment.hit.generate_connection()
+    result = Result.objects.select_related('assignment').get(id=result_id)
+    if result.assignment == None:
+        return
     try:
-        bonus = Bonus.objects.get(worker=worker,battery=battery)
-        amount = bonus.calculate_bonus()
-        price = Price(amount)
-        reason = get_bonus_reason(bonus)
-        result.assignment.hit.connection.grant_bonus(worker.id,result.assignment.mturk_id,price,reason)
-        bonus.granted = True
-        bonus.save()
+        bonus = Bonus.objects.get(worker=result.worker,battery=result.battery)
     except Bonus.DoesNotExist:
-        pass
+        return
+    if queue_bonus(bonus,result.assignment):
+        process_bonus_payouts.apply_async()
+
 
 @shared_task
-def experiment_reward(result_id):
-    '''experiment_reward will record bonus based on satisfying some criteria
-    The final bonus will be allocated at the end of the battery, after
-    a result is submit, with grant_bonus. This function currently has code
-    similar to check_blacklist, and the two are separate as this is expected
-    to change
-    :result_id: the id of the result object, turk.models.Result
+def process_bonus_payouts():
+    '''process_bonus_payouts pays a batch of queued bonuses, and queues itself
+    again while bonuses are still due. It is also run every minute by celery
+    beat, to pick up retries.
     '''
-
-    # Look up all result objects for worker
-    result = Result.objects.get(id=result_id)
-    battery = result.battery
-    worker = result.worker
-    experiment_template = result.experiment
-    experiment = [b for b in battery.experiments.all() if b.template == experiment_template]
-
-    if len(experiment)>0:
-        experiment=experiment[0]
-
-        do_bonus = True if experiment_template.performance_variable != None and experiment.include_bonus == True else False
-        bonus_active = battery.bonus_active
-
-        if result.completed == True and do_bonus == True and bonus_active == True:
-            for credit_condition in experiment.credit_conditions.all():
-                variable_name = credit_condition.variable.name
-                variables = get_variables(result,variable_name)
-                func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-                func_description = [x[0] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-
-                # Look through variables and determine if passes condition
-                for variable in variables:
-                    comparator = credit_condition.value
-                    if isinstance(variable,bool):
-                        comparator = bool(comparator)
-                    elif isinstance(variable,float) or isinstance(variable,int):
-                        variable = float(variable)
-                        comparator = float(comparator)
-
-                    # If the variable passes criteria and it's a performance variable
-                    if func(variable,comparator):
-                        if credit_condition.variable == experiment_template.performance_variable:
-                            description = "%s %s %s %s" %(variable_name,variable,func_description,comparator)
-                            bonus,_ = Bonus.objects.get_or_create(worker=worker,battery=battery)
-                            if credit_condition.amount != None:
-                                add_bonus(bonus,experiment,description,credit_condition.amount)
-                                result.credit_granted = True
-                                result.save()
+    stats = pay_bonuses()
+    if stats["more"] == True:
+        countdown = 1.0 / settings.MTURK_BONUS_RATE if stats["throttled"] > 0 else 0
+        process_bonus_payouts.apply_async(countdown=countdown)
+    return stats
 
 
 def add_bonus(bonus,experiment,description,amount):
@@ -234,6 +386,129 @@ def add_bonus(bonus,experiment,description,amount):
     bonus.save()
 
 
+# DELETION ####################################################################
+
+def delete_in_chunks(queryset,chunk_size=1000):
+    '''delete_in_chunks deletes the rows of a queryset by primary key in bounded
+    chunks, each its own DELETE (and transaction), so a large deletion never
+    holds long locks and can be resumed if interrupted. Each chunk is locked and
+    checked against the queryset again before it is deleted, so rows that stop
+    matching it meanwhile (eg, results completed) are kept. Returns the number
+    of rows deleted.
+    :param queryset: the queryset to delete
+    :param chunk_size: the number of rows to delete at once
+    '''
+    model = queryset.model
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by('pk').values_list('pk',flat=True)[:chunk_size])
+        if len(ids) == 0:
+            return deleted
+        with transaction.atomic():
+            list(model.objects.select_for_update().filter(pk__in=ids).values_list('pk',flat=True))
+            ids = list(queryset.filter(pk__in=ids).values_list('pk',flat=True))
+            model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+@shared_task
+def purge_battery(battery_id,chunk_size=1000):
+    '''purge_battery deletes a battery marked pending_deletion, with its results,
+    bonuses, blacklists, assignments and HITs, in chunks
+    :param battery_id: the id of the experiments.models.Battery
+    :param chunk_size: the number of rows to delete at once
+    '''
+    try:
+        battery = Battery.objects.get(id=battery_id,pending_deletion=True)
+    except Battery.DoesNotExist:
+        return
+    delete_in_chunks(Result.objects.filter(battery=battery),chunk_size)
+    drop_result_partition(battery_id)
+    delete_in_chunks(Bonus.objects.filter(battery=battery),chunk_size)
+    delete_in_chunks(Blacklist.objects.filter(battery=battery),chunk_size)
+    delete_in_chunks(Result.objects.filter(assignment__hit__battery=battery),chunk_size)
+    delete_in_chunks(Assignment.objects.filter(hit__battery=battery),chunk_size)
+    delete_in_chunks(HIT.objects.filter(battery=battery),chunk_size)
+    delete_battery_archives(battery)
+    clear_blacklist_cache(battery_id)
+    battery.delete()
+
+
+@shared_task
+def purge_experiment_template(exp_id,chunk_size=1000):
+    '''purge_experiment_template deletes an experiment template with its results
+    (in chunks), battery experiments, static files and, if no other template
+    uses it, its Cognitive Atlas task
+    :param exp_id: the exp_id of the experiments.models.ExperimentTemplate
+    :param chunk_size: the number of rows to delete at once
+    '''
+    try:
+        experiment = ExperimentTemplate.objects.get(exp_id=exp_id)
+    except ExperimentTemplate.DoesNotExist:
+        return
+    Experiment.objects.filter(template=experiment).delete()
+    delete_in_chunks(Result.objects.filter(experiment=experiment),chunk_size)
+
+    remove_experiment(get_experiment_type(experiment),experiment.exp_id)
+
+    task = experiment.cognitive_atlas_task
+    experiment.delete()
+
+    # Cognitive Atlas Task, if no other template uses it
+    if task != None and not task.experimenttemplate_set.exists():
+        # We might want to delete concepts too? Ok for now.
+        task.delete()
+
+
+# GARBAGE COLLECTION ##########################################################
+
+def get_abandoned_results(now=None):
+    '''get_abandoned_results returns the incomplete results that can no longer be
+    completed: the assignment deadline has passed, or (for local serves, or
+    assignments without a deadline) the experiment was last served more than
+    RESULT_ABANDONED_HOURS ago
+    '''
+    if now == None:
+        now = timezone.now()
+    served_before = now - timedelta(hours=settings.RESULT_ABANDONED_HOURS)
+    return Result.objects.filter(Q(assignment__deadline__lt=now) |
+                                 Q(assignment__deadline__isnull=True,serve_time__lt=served_before),
+                                 completed=False)
+
+
+@shared_task
+def collect_abandoned_results(batch_size=1000,archive=None):
+    '''collect_abandoned_results deletes (or archives) abandoned incomplete results
+    in batches, and returns counts. Run daily by celery beat.
+    :param batch_size: the number of results to delete at once
+    :param archive: archive the results instead of deleting them (default RESULT_GC_ARCHIVE)
+    '''
+    if archive == None:
+        archive = settings.RESULT_GC_ARCHIVE
+    stats = {"stamped":0,"deleted":0,"archived":0}
+
+    # Results served before serve_time was recorded are aged from now on
+    unstamped = Result.objects.filter(completed=False,serve_time__isnull=True)
+    now = timezone.now()
+    while True:
+        ids = list(unstamped.values_list('id',flat=True)[:batch_size])
+        if len(ids) == 0:
+            break
+        stats["stamped"] += Result.objects.filter(id__in=ids,serve_time__isnull=True).update(serve_time=now)
+
+    abandoned = get_abandoned_results()
+    if archive:
+        battery_ids = abandoned.order_by().values_list('battery_id',flat=True).distinct()
+        for battery in Battery.objects.filter(id__in=list(battery_ids)):
+            result_archive = archive_results(battery,abandoned.filter(battery=battery),batch_size)
+            if result_archive != None:
+                stats["archived"] += result_archive.result_count
+    else:
+        # Each chunk is checked against the queryset again, so results completed meanwhile are kept
+        stats["deleted"] = delete_in_chunks(abandoned,batch_size)
+    return stats
+
+
 # EXPERIMENT RESULT PARSING helper functions
 def get_unique_experiments(results):
     experiments = []
@@ -244,41 +519,26 @@ def get_unique_experiments(results):
 
 
 def get_variables(result,variable_name):
-    # First try looking for variable as it is
-    variables = find_variable(result,variable_name)
-    summary_funcs = {"avg":numpy.mean,
-                     "mean":numpy.mean,
-                     "average":numpy.mean,
-                     "med":numpy.median,
-                     "median":numpy.median,
-                     "sum":numpy.sum,
-                     "total":numpy.sum,
-                     "max":numpy.max,
-                     "min":numpy.min}
-
-    # Did the user specify a summary statistic?
-    if len(variables) == 0:
-        summary_func = variable_name.split("_")[0].lower()
-        if summary_func in summary_funcs.keys():
-            name = ["_".join(variable_name.split("_")[1:])][0]
-            summary_func = summary_funcs[summary_func]
-            variables = find_variable(result,name)
-            variables = [summary_func(variables)]
-    return variables
+    '''get_variables returns the values of a variable in the trialdata of a
+    result. If the variable isn't found and has a summary prefix (eg, avg_rt)
+    the summary of the variable is returned.
+    '''
+    if get_experiment_type(result.experiment) != "experiments":
+        return []
+    summary_func,name = parse_variable_name(variable_name)
+    values,_ = get_variable_column([result.taskdata],variable_name)
+    if len(values) == 0 and summary_func != None:
+        values,_ = get_variable_column([result.taskdata],name)
+        values,_ = summarize_column(values,numpy.zeros(len(values),dtype=int),summary_func,numpy.ones(1,dtype=bool))
+    return values.tolist()
 
 def find_variable(result,variable_name):
 
     # Surveys and games not yet implemented
-    experiment_type = get_experiment_type(result.experiment)
-    variables = []
-
-    # For experiments
-    if experiment_type == "experiments":
-        taskdata = result.taskdata
-        for trial in taskdata[0]["trialdata"]:
-            if variable_name in trial.keys():
-                variables.append(trial[variable_name])
-    return variables
+    if get_experiment_type(result.experiment) != "experiments":
+        return []
+    values,_ = get_variable_column([result.taskdata],variable_name)
+    return values.tolist()
 
 def get_unique_variables(results):
     variables = []
@@ -309,7 +569,10 @@ def check_battery_dependencies(current_battery, worker_id):
         worker_id = worker_id,
         completed=True
     )
-    
+    # Results of inactive batteries may have been archived, leaving a stub
+    archived_results = turk.models.ArchivedResult.objects.filter(worker_id=worker_id,completed=True)
+    worker_results = list(worker_results) + list(archived_results)
+
     worker_result_batteries = {}
     for result in worker_results:
         if worker_result_batteries.get(result.battery.id):
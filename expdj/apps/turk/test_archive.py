@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Result archive tests: results moved to an archive file are read back
+with the values they had in the results table."""
+
+from datetime import timedelta
+import collections
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from expdj.apps.experiments.models import Battery, ExperimentTemplate
+from expdj.apps.turk import archive as result_archive
+from expdj.apps.turk.archive import (ARCHIVE_FIELDS, ResultsWithArchived, archive_battery_results,
+                                     get_archived_results)
+from expdj.apps.turk.models import ArchivedResult, Result, ResultArchive, Worker
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.archive_root = tempfile.mkdtemp()
+        self.settings_override = self.settings(RESULT_ARCHIVE_ROOT=self.archive_root,RESULT_ARCHIVE_S3=None)
+        self.settings_override.enable()
+
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=2)
+        ExperimentTemplate.objects.bulk_create([ExperimentTemplate(exp_id="task_%s" %(i),name="task_%s" %(i),
+                                                                   time=5,reference="") for i in range(2)])
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(3)])
+        now = timezone.now()
+        taskdata = [collections.OrderedDict([("trial_index",0),("rt",512),("key_press",32)])]
+        Result.objects.bulk_create([Result(worker_id="WORKER%s" %(i),battery=self.battery,experiment_id="task_%s" %(i % 2),
+                                           taskdata=taskdata,version="abc123",language="en",browser="Firefox",
+                                           platform="Linux",current_trial=1,completed=True,credit_granted=i == 0,
+                                           serve_time=now - timedelta(minutes=10),finishtime=now)
+                                    for i in range(3)])
+        # An incomplete result stays in the results table
+        Result.objects.create(worker_id="WORKER0",battery=self.battery,experiment_id="task_1",completed=False)
+
+        self.read_archive_rows = result_archive.read_archive_rows
+        self.reads = []
+        def read_archive_rows(archive):
+            self.reads.append(archive.id)
+            return self.read_archive_rows(archive)
+        result_archive.read_archive_rows = read_archive_rows
+
+    def tearDown(self):
+        result_archive.read_archive_rows = self.read_archive_rows
+        self.settings_override.disable()
+        shutil.rmtree(self.archive_root)
+
+    def get_values(self,results):
+        return dict([(result.id,dict([(field_name,getattr(result,field_name)) for field_name in ARCHIVE_FIELDS]))
+                     for result in results])
+
+    def test_archive_round_trip(self):
+        expected = self.get_values(Result.objects.filter(battery=self.battery,completed=True))
+        archive = archive_battery_results(self.battery)
+        self.assertEqual(archive.result_count,3)
+        self.assertEqual(ArchivedResult.objects.filter(archive=archive).count(),3)
+        self.assertEqual(Result.objects.filter(battery=self.battery).count(),1)
+
+        archived = get_archived_results(self.battery.id)
+        self.assertEqual(self.get_values(archived),expected)
+        for result in archived:
+            self.assertIsNotNone(result.serve_time.tzinfo)
+            self.assertIsNotNone(result.finishtime.tzinfo)
+
+    def test_archive_experiment(self):
+        archive_battery_results(self.battery)
+        archived = get_archived_results(self.battery.id,"task_0")
+        self.assertEqual(sorted([result.worker_id for result in archived]),["WORKER0","WORKER2"])
+
+    def test_nothing_to_archive(self):
+        Result.objects.filter(battery=self.battery).update(completed=False)
+        self.assertEqual(archive_battery_results(self.battery),None)
+        self.assertEqual(ResultArchive.objects.filter(battery=self.battery).count(),0)
+
+    def test_archive_rows_cached(self):
+        archive = archive_battery_results(self.battery)
+        get_archived_results(self.battery.id)
+        get_archived_results(self.battery.id,"task_0")
+        self.assertEqual(self.reads,[archive.id])
+
+    def test_results_with_archived_pages(self):
+        archive_battery_results(self.battery)
+        live = Result.objects.filter(battery=self.battery).order_by('id')
+        results = ResultsWithArchived(live,self.battery.id)
+        self.assertEqual(len(results),4)
+        # A page the results table fills doesn't read the archive
+        self.assertEqual([result.id for result in results[0:1]],[live[0].id])
+        self.assertEqual(self.reads,[])
+        self.assertEqual(len(results[0:10]),4)
+        self.assertEqual(len(results[2:4]),2)
+        self.assertEqual(len(self.reads),1)
+
+        completed = ResultsWithArchived(live.filter(completed=False),self.battery.id,"task_1",completed=False)
+        self.assertEqual(len(completed),1)
+        self.assertEqual(len(completed[0:10]),1)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Garbage collection tests: incomplete results that can no longer be
+completed are deleted (or archived), and everything else is kept."""
+
+from datetime import timedelta
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from expdj.apps.experiments.models import Battery, ExperimentTemplate
+from expdj.apps.turk.archive import get_archived_results
+from expdj.apps.turk.models import Assignment, HIT, Result, ResultArchive, Worker
+from expdj.apps.turk.tasks import collect_abandoned_results, get_abandoned_results
+
+
+@override_settings(RESULT_ABANDONED_HOURS=48,RESULT_GC_ARCHIVE=False)
+class CollectAbandonedResultsTests(TestCase):
+
+    def setUp(self):
+        # Rows are bulk created, HIT.save would contact Amazon
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=1)
+        ExperimentTemplate.objects.bulk_create([ExperimentTemplate(exp_id="test_task",name="test task",
+                                                                   time=5,reference="")])
+        names = ["expired","pending","no_deadline","local","recent","unstamped","completed"]
+        Worker.objects.bulk_create([Worker(id=name) for name in names])
+        HIT.objects.bulk_create([HIT(battery=self.battery,owner=owner,mturk_id="HIT",title="hit",
+                                     description="hit",reward=1,assignment_duration_in_hours=1)])
+        hit = HIT.objects.get(mturk_id="HIT")
+        now = timezone.now()
+        deadlines = {"expired":now - timedelta(hours=1),"pending":now + timedelta(hours=1),
+                     "no_deadline":None,"completed":now - timedelta(hours=1)}
+        Assignment.objects.bulk_create([Assignment(mturk_id=name,worker_id=name,hit=hit,deadline=deadline)
+                                        for name,deadline in deadlines.items()])
+        serve_times = {"expired":now - timedelta(hours=2),"pending":now - timedelta(hours=72),
+                       "no_deadline":now - timedelta(hours=72),"local":now - timedelta(hours=72),
+                       "recent":now - timedelta(hours=1),"unstamped":None,"completed":now - timedelta(hours=2)}
+        Result.objects.bulk_create([Result(worker_id=name,battery=self.battery,experiment_id="test_task",
+                                           assignment=Assignment.objects.filter(mturk_id=name).first(),
+                                           serve_time=serve_times[name],completed=name == "completed")
+                                    for name in names])
+
+    def get_workers(self,results):
+        return sorted(results.values_list('worker_id',flat=True))
+
+    def test_get_abandoned_results(self):
+        self.assertEqual(self.get_workers(get_abandoned_results()),["expired","local","no_deadline"])
+        # The recent local serve is abandoned two days later
+        later = timezone.now() + timedelta(hours=48)
+        self.assertEqual(self.get_workers(get_abandoned_results(now=later)),
+                         ["expired","local","no_deadline","pending","recent"])
+
+    def test_collect_abandoned_results(self):
+        stats = collect_abandoned_results(batch_size=2)
+        self.assertEqual(stats,{"stamped":1,"deleted":3,"archived":0})
+        self.assertEqual(self.get_workers(Result.objects.all()),["completed","pending","recent","unstamped"])
+        self.assertIsNotNone(Result.objects.get(worker_id="unstamped").serve_time)
+
+    def test_collect_again(self):
+        collect_abandoned_results()
+        self.assertEqual(collect_abandoned_results(),{"stamped":0,"deleted":0,"archived":0})
+
+    def test_archive_abandoned_results(self):
+        archive_root = tempfile.mkdtemp()
+        try:
+            with self.settings(RESULT_ARCHIVE_ROOT=archive_root,RESULT_ARCHIVE_S3=None):
+                stats = collect_abandoned_results(batch_size=2,archive=True)
+                self.assertEqual(stats,{"stamped":1,"deleted":0,"archived":3})
+                self.assertEqual(ResultArchive.objects.filter(battery=self.battery).count(),1)
+                self.assertEqual(sorted([result.worker_id for result in get_archived_results(self.battery.id)]),
+                                 ["expired","local","no_deadline"])
+        finally:
+            shutil.rmtree(archive_root)
+        self.assertEqual(self.get_workers(Result.objects.all()),["completed","pending","recent","unstamped"])
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Credit tests: credit conditions evaluated over the trial data of many
+results at once (credit.py), and the single pass evaluation of a finished
+result into its Bonus and Blacklist (tasks.evaluate_credit)."""
+
+import unittest
+
+import numpy
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from expdj.apps.experiments.models import (Battery, CreditCondition, Experiment, ExperimentBooleanVariable,
+                                           ExperimentNumericVariable, ExperimentTemplate)
+from expdj.apps.turk.credit import (CompiledCondition, SQLTaskdataColumns, TaskdataColumns,
+                                    get_variable_column, parse_variable_name, summarize_column, to_array)
+from expdj.apps.turk.models import Blacklist, Bonus, Result, Worker
+from expdj.apps.turk.tasks import evaluate_credit
+
+
+def get_taskdata(*trialdatas):
+    return [{"trial_index":index,"trialdata":trialdata} for index,trialdata in enumerate(trialdatas)]
+
+
+class Variable(object):
+
+    def __init__(self,name):
+        self.name = name
+
+
+class Condition(object):
+    '''the fields of a CreditCondition read by CompiledCondition'''
+    operator_lookup = CreditCondition.operator_lookup
+
+    def __init__(self,variable_name,operator,value,amount=None):
+        self.id = None
+        self.variable_id = None
+        self.variable = Variable(variable_name)
+        self.operator = operator
+        self.value = value
+        self.amount = amount
+
+
+class CreditColumnTests(SimpleTestCase):
+
+    def test_parse_variable_name(self):
+        self.assertEqual(parse_variable_name("avg_rt"),(numpy.mean,"rt"))
+        self.assertEqual(parse_variable_name("median_reaction_time"),(numpy.median,"reaction_time"))
+        self.assertEqual(parse_variable_name("credit_var"),(None,"credit_var"))
+        self.assertEqual(parse_variable_name("avg"),(None,"avg"))
+
+    def test_get_variable_column(self):
+        taskdatas = [get_taskdata({"rt":500},{"rt":600},{"key_press":32}),
+                     None,
+                     get_taskdata([{"rt":100},{"rt":200}]),
+                     [{"trial_index":0}]]
+        values,owners = get_variable_column(taskdatas,"rt")
+        self.assertEqual(values.tolist(),[500.0,600.0,100.0,200.0])
+        self.assertEqual(owners.tolist(),[0,0,2,2])
+
+    def test_to_array(self):
+        self.assertEqual(to_array([True,False]).dtype,bool)
+        self.assertEqual(to_array([1,2.5]).dtype,float)
+        self.assertEqual(to_array([1,"a"]).dtype,object)
+
+    def test_summarize_column(self):
+        values = numpy.array([1.0,3.0,10.0,20.0,30.0])
+        owners = numpy.array([0,0,1,1,2])
+        include = numpy.array([True,True,False])
+        summaries,indices = summarize_column(values,owners,numpy.mean,include)
+        self.assertEqual(summaries.tolist(),[2.0,15.0])
+        self.assertEqual(indices.tolist(),[0,1])
+        summaries,indices = summarize_column(values,owners,numpy.median,numpy.array([False,True,True]))
+        self.assertEqual(summaries.tolist(),[15.0,30.0])
+        self.assertEqual(indices.tolist(),[1,2])
+
+    def test_summary_condition(self):
+        # Results with the variable itself are compared by it, others by the summary
+        columns = TaskdataColumns([get_taskdata({"rt":500},{"rt":600}),
+                                   get_taskdata({"rt":100},{"rt":200}),
+                                   get_taskdata({"avg_rt":700},{"rt":100}),
+                                   get_taskdata({"key_press":32})])
+        condition = CompiledCondition(Condition("avg_rt","GREATERTHAN","400"))
+        self.assertEqual(condition.evaluate(columns),["avg_rt 550.0 GREATERTHAN 400.0",None,
+                                                      "avg_rt 700.0 GREATERTHAN 400.0",None])
+
+    def test_boolean_condition(self):
+        columns = TaskdataColumns([get_taskdata({"credit_var":True}),
+                                   get_taskdata({"credit_var":True},{"credit_var":False})])
+        condition = CompiledCondition(Condition("credit_var","EQUALS","false"))
+        self.assertEqual(condition.evaluate(columns),[None,"credit_var False EQUALS False"])
+
+    def test_uncomparable_value(self):
+        columns = TaskdataColumns([get_taskdata({"rt":500})])
+        condition = CompiledCondition(Condition("rt","GREATERTHAN","fast"))
+        self.assertEqual(condition.evaluate(columns),[None])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "jsonb columns are on PostgreSQL")
+class SQLTaskdataColumnsTests(TestCase):
+
+    def test_same_columns(self):
+        owner = User.objects.create(username="owner")
+        battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                         maximum_time=30,number_of_experiments=1)
+        ExperimentTemplate.objects.create(exp_id="test_task",name="test task",time=5,reference="",template="jspsych")
+        taskdatas = [get_taskdata({"rt":500},{"rt":600,"correct":True}),
+                     None,
+                     get_taskdata([{"rt":100},{"correct":False}],"text"),
+                     get_taskdata({"rt":"slow"})]
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(len(taskdatas))])
+        results = [Result.objects.create(worker_id="WORKER%s" %(i),battery=battery,experiment_id="test_task",
+                                         taskdata=taskdata,completed=True) for i,taskdata in enumerate(taskdatas)]
+        # Ids out of order, the columns follow the order of the list
+        results.reverse()
+        python_columns = TaskdataColumns([r.taskdata for r in results])
+        sql_columns = SQLTaskdataColumns([r.id for r in results])
+        for variable_name in ["rt","correct","missing"]:
+            python_values,python_owners = python_columns.get_column(variable_name)
+            sql_values,sql_owners = sql_columns.get_column(variable_name)
+            self.assertEqual(sql_values.tolist(),python_values.tolist())
+            self.assertEqual(sql_values.dtype,python_values.dtype)
+            self.assertEqual(sql_owners.tolist(),python_owners.tolist())
+
+
+class EvaluateCreditTests(TestCase):
+
+    def setUp(self):
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=1,
+                                              bonus_active=True,blacklist_active=True)
+        performance = ExperimentNumericVariable.objects.create(name="avg_rt",description="reaction time")
+        rejection = ExperimentBooleanVariable.objects.create(name="credit_var",description="attention check")
+        template = ExperimentTemplate.objects.create(exp_id="test_task",name="test task",time=5,reference="",
+                                                     template="jspsych",performance_variable=performance,
+                                                     rejection_variable=rejection)
+        self.experiment = Experiment.objects.create(template=template,include_bonus=True,include_catch=True)
+        self.experiment.credit_conditions.add(
+            CreditCondition.objects.create(variable=performance,operator="LESSTHAN",value="400",amount=1.5),
+            CreditCondition.objects.create(variable=rejection,operator="EQUALS",value="false"))
+        self.battery.experiments.add(self.experiment)
+        Worker.objects.create(id="WORKER")
+
+    def create_result(self,*trialdatas):
+        return Result.objects.create(worker_id="WORKER",battery=self.battery,experiment_id="test_task",
+                                     taskdata=get_taskdata(*trialdatas),completed=True)
+
+    def test_bonus_and_violation(self):
+        result = self.create_result({"rt":300,"credit_var":True},{"rt":200,"credit_var":False})
+        evaluate_credit(result.id)
+        bonus = Bonus.objects.get(worker_id="WORKER",battery=self.battery)
+        self.assertEqual(bonus.amounts["test_task"]["amount"],1.5)
+        self.assertEqual(bonus.amounts["test_task"]["description"],"avg_rt 250.0 LESSTHAN 400.0")
+        blacklist = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        self.assertEqual(blacklist.flags["test_task"]["description"],"credit_var False EQUALS False")
+        self.assertEqual(blacklist.flag_count,1)
+        self.assertTrue(Result.objects.get(id=result.id).credit_granted)
+
+    def test_no_credit(self):
+        result = self.create_result({"rt":900,"credit_var":True})
+        evaluate_credit(result.id)
+        self.assertFalse(Bonus.objects.filter(worker_id="WORKER").exists())
+        self.assertFalse(Blacklist.objects.filter(worker_id="WORKER").exists())
+        self.assertFalse(Result.objects.get(id=result.id).credit_granted)
+
+    def test_rejection_only(self):
+        result = self.create_result({"rt":300,"credit_var":False})
+        evaluate_credit(result.id,bonus=False)
+        self.assertFalse(Bonus.objects.filter(worker_id="WORKER").exists())
+        self.assertTrue(Blacklist.objects.filter(worker_id="WORKER").exists())
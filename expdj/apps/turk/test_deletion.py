@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Deletion tests: batteries and experiment templates are purged in the
+background, one bounded DELETE per chunk."""
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from expdj.apps.experiments.models import Battery, CognitiveAtlasTask, Experiment, ExperimentTemplate
+from expdj.apps.turk.models import Assignment, Blacklist, Bonus, HIT, Result, Worker
+from expdj.apps.turk.tasks import delete_in_chunks, purge_battery, purge_experiment_template
+
+
+class PurgeTests(TestCase):
+
+    def setUp(self):
+        # Rows are bulk created, HIT.save would contact Amazon
+        self.owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=self.owner,
+                                              maximum_time=30,number_of_experiments=1)
+        self.other_battery = Battery.objects.create(name="other",credentials="credentials",owner=self.owner,
+                                                    maximum_time=30,number_of_experiments=1)
+        self.task = CognitiveAtlasTask.objects.create(cog_atlas_id="trm_1",name="task")
+        self.template = ExperimentTemplate.objects.create(exp_id="test_task",name="test task",time=5,reference="",
+                                                          template="jspsych",cognitive_atlas_task=self.task)
+        ExperimentTemplate.objects.create(exp_id="other_task",name="other task",time=5,reference="",template="jspsych")
+        self.battery.experiments.add(Experiment.objects.create(template=self.template))
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(25)])
+        HIT.objects.bulk_create([HIT(battery=battery,owner=self.owner,mturk_id="HIT_%s" %(battery.id),title="hit",
+                                     description="hit",reward=1,assignment_duration_in_hours=1)
+                                 for battery in [self.battery,self.other_battery]])
+        for battery in [self.battery,self.other_battery]:
+            hit = HIT.objects.get(battery=battery)
+            Assignment.objects.bulk_create([Assignment(mturk_id="ASSIGNMENT_%s_%s" %(battery.id,i),
+                                                       worker_id="WORKER%s" %(i),hit=hit) for i in range(25)])
+            Result.objects.bulk_create([Result(worker_id="WORKER%s" %(i),battery=battery,
+                                               experiment_id=["test_task","other_task"][i % 2],completed=True,
+                                               assignment=Assignment.objects.get(mturk_id="ASSIGNMENT_%s_%s" %(battery.id,i)))
+                                        for i in range(25)])
+            Bonus.objects.bulk_create([Bonus(worker_id="WORKER%s" %(i),battery=battery) for i in range(5)])
+            Blacklist.objects.bulk_create([Blacklist(worker_id="WORKER%s" %(i),battery=battery) for i in range(5)])
+
+    def test_delete_in_chunks(self):
+        results = Result.objects.filter(battery=self.battery)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(delete_in_chunks(results,chunk_size=10),25)
+        deletes = [q["sql"] for q in queries.captured_queries if q["sql"].startswith("DELETE")]
+        self.assertEqual(len(deletes),3)
+        self.assertEqual(results.count(),0)
+        self.assertEqual(Result.objects.filter(battery=self.other_battery).count(),25)
+
+    def test_purge_battery(self):
+        Battery.objects.filter(id=self.battery.id).update(pending_deletion=True,active=False)
+        purge_battery(self.battery.id,chunk_size=10)
+        self.assertFalse(Battery.objects.filter(id=self.battery.id).exists())
+        for model in [Result,Bonus,Blacklist,HIT]:
+            self.assertEqual(model.objects.filter(battery_id=self.battery.id).count(),0)
+        self.assertEqual(Assignment.objects.filter(hit__battery_id=self.battery.id).count(),0)
+        # The other battery is untouched
+        self.assertEqual(Result.objects.filter(battery=self.other_battery).count(),25)
+        self.assertEqual(Assignment.objects.filter(hit__battery=self.other_battery).count(),25)
+        self.assertEqual(Bonus.objects.filter(battery=self.other_battery).count(),5)
+
+    def test_purge_battery_not_pending(self):
+        purge_battery(self.battery.id)
+        self.assertTrue(Battery.objects.filter(id=self.battery.id).exists())
+        self.assertEqual(Result.objects.filter(battery=self.battery).count(),25)
+
+    def test_purge_experiment_template(self):
+        purge_experiment_template("test_task",chunk_size=5)
+        self.assertFalse(ExperimentTemplate.objects.filter(exp_id="test_task").exists())
+        self.assertFalse(Experiment.objects.filter(template_id="test_task").exists())
+        self.assertEqual(Result.objects.filter(experiment_id="test_task").count(),0)
+        self.assertEqual(Result.objects.filter(experiment_id="other_task").count(),24)
+        self.assertFalse(CognitiveAtlasTask.objects.filter(cog_atlas_id="trm_1").exists())
+
+    def test_purge_experiment_template_keeps_shared_task(self):
+        ExperimentTemplate.objects.filter(exp_id="other_task").update(cognitive_atlas_task=self.task)
+        purge_experiment_template("test_task")
+        self.assertTrue(CognitiveAtlasTask.objects.filter(cog_atlas_id="trm_1").exists())
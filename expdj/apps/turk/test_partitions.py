@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Result partition tests: partition_results converts a results table into
+one partition per battery, and battery partitions are created and detached
+without losing rows. The tests run on a scratch table shaped like
+turk_result, so the test database's results table is left alone."""
+
+from StringIO import StringIO
+import unittest
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk import partitions
+from expdj.apps.turk.management.commands import partition_results
+from expdj.apps.turk.partitions import (check_partitioning_supported, create_result_partition,
+                                        detach_result_partition, get_partition_name, partitioning_supported,
+                                        results_partitioned)
+
+
+TEST_TABLE = "turk_result_test"
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "partitioning is on PostgreSQL")
+class PartitionTests(TestCase):
+
+    def setUp(self):
+        if not partitioning_supported():
+            self.skipTest("partitioning needs PostgreSQL 11 or later")
+        owner = User.objects.create(username="owner")
+        self.batteries = [Battery.objects.create(name="battery_%s" %(i),credentials="credentials",owner=owner,
+                                                 maximum_time=30,number_of_experiments=1) for i in range(3)]
+
+        self.originals = {partitions:{},partition_results:{}}
+        for module,names in [(partitions,["RESULT_TABLE","DEFAULT_PARTITION"]),
+                             (partition_results,["RESULT_TABLE","DEFAULT_PARTITION","NEW_TABLE","SYNC_FUNCTION"])]:
+            for name in names:
+                self.originals[module][name] = getattr(module,name)
+        for module in [partitions,partition_results]:
+            module.RESULT_TABLE = TEST_TABLE
+            module.DEFAULT_PARTITION = "%s_default" %(TEST_TABLE)
+        partition_results.NEW_TABLE = "%s_partitioned" %(TEST_TABLE)
+        partition_results.SYNC_FUNCTION = "%s_sync_partitioned" %(TEST_TABLE)
+
+        cursor = connection.cursor()
+        cursor.execute('''CREATE TABLE %s (id serial PRIMARY KEY, battery_id integer NOT NULL,
+                          worker_id varchar(200) NOT NULL)''' %(TEST_TABLE))
+        cursor.execute('CREATE INDEX %s_battery_id ON %s (battery_id)' %(TEST_TABLE,TEST_TABLE))
+        # Results of the first two batteries, and of a battery that doesn't exist yet
+        for battery_id in [self.batteries[0].id,self.batteries[1].id,self.batteries[2].id + 1]:
+            for i in range(3):
+                cursor.execute('INSERT INTO %s (battery_id, worker_id) VALUES (%%s, %%s)' %(TEST_TABLE),
+                               [battery_id,"WORKER%s" %(i)])
+
+    def tearDown(self):
+        for module,values in self.originals.items():
+            for name,value in values.items():
+                setattr(module,name,value)
+
+    def count_rows(self,table,battery_id=None):
+        cursor = connection.cursor()
+        if battery_id == None:
+            cursor.execute('SELECT COUNT(*) FROM %s' %(table))
+        else:
+            cursor.execute('SELECT COUNT(*) FROM %s WHERE battery_id = %%s' %(table),[battery_id])
+        return cursor.fetchone()[0]
+
+    def partition_table(self):
+        call_command('partition_results',batch_size=2,stdout=StringIO())
+
+    def test_partition_table(self):
+        self.assertFalse(results_partitioned())
+        self.assertFalse(create_result_partition(self.batteries[0].id))
+        self.assertEqual(detach_result_partition(self.batteries[0].id),None)
+
+        self.partition_table()
+        self.assertTrue(results_partitioned())
+        self.assertEqual(self.count_rows(TEST_TABLE),9)
+        for battery in self.batteries:
+            self.assertTrue(partitions.partition_exists(battery.id))
+        self.assertEqual(self.count_rows(get_partition_name(self.batteries[0].id)),3)
+        self.assertEqual(self.count_rows(get_partition_name(self.batteries[2].id)),0)
+        self.assertEqual(self.count_rows("%s_default" %(TEST_TABLE)),3)
+
+        # New rows go to their battery's partition
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO %s (battery_id, worker_id) VALUES (%%s, 'WORKER3')" %(TEST_TABLE),
+                       [self.batteries[1].id])
+        self.assertEqual(self.count_rows(get_partition_name(self.batteries[1].id)),4)
+
+    def test_create_partition(self):
+        self.partition_table()
+        battery_id = self.batteries[2].id + 1
+        self.assertTrue(create_result_partition(battery_id))
+        self.assertFalse(create_result_partition(battery_id))
+        # Its results moved out of the default partition
+        self.assertEqual(self.count_rows(get_partition_name(battery_id)),3)
+        self.assertEqual(self.count_rows("%s_default" %(TEST_TABLE)),0)
+        self.assertEqual(self.count_rows(TEST_TABLE),9)
+
+    def test_detach_partition(self):
+        self.partition_table()
+        battery_id = self.batteries[0].id
+        partition = detach_result_partition(battery_id)
+        self.assertEqual(partition,get_partition_name(battery_id))
+        self.assertFalse(partitions.partition_exists(battery_id))
+        self.assertEqual(detach_result_partition(battery_id),None)
+        # The results are kept in the standalone table
+        self.assertEqual(self.count_rows(partition),3)
+        self.assertEqual(self.count_rows(TEST_TABLE,battery_id),0)
+        self.assertEqual(self.count_rows(TEST_TABLE),6)
+
+    def test_drop_partition(self):
+        self.partition_table()
+        battery_id = self.batteries[1].id
+        self.assertTrue(partitions.drop_result_partition(battery_id))
+        self.assertFalse(partitions.drop_result_partition(battery_id))
+        self.assertEqual(self.count_rows(TEST_TABLE),6)
+
+    def test_old_postgresql(self):
+        connection.__dict__["pg_version"] = 100000
+        try:
+            self.assertRaises(DatabaseError,check_partitioning_supported)
+            self.assertFalse(results_partitioned())
+        finally:
+            del connection.__dict__["pg_version"]
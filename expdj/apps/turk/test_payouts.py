@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Payout queue tests: the token bucket, bonus leasing, and the retry
+backoff. Redis is replaced by a fake running the bucket script in python, and
+MTurk by a fake send_bonus."""
+
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from expdj.apps.experiments.models import Battery
+from expdj.apps.turk import payouts
+from expdj.apps.turk.models import Assignment, Bonus, HIT, Worker
+from expdj.apps.turk.payouts import TokenBucket, claim_bonus, pay_bonuses, record_bonus_failure
+
+
+class FakeClock(object):
+
+    def __init__(self,now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeRedis(object):
+    '''A redis client running TOKEN_BUCKET_SCRIPT (ported to python) on a dictionary'''
+
+    def __init__(self):
+        self.buckets = dict()
+
+    def register_script(self,script):
+        def run_script(keys,args):
+            rate,capacity,now,requested = [float(arg) for arg in args]
+            tokens,timestamp = self.buckets.get(keys[0],(capacity,now))
+            tokens = min(capacity,tokens + max(0,now - timestamp) * rate)
+            allowed = 0
+            if tokens >= requested:
+                tokens = tokens - requested
+                allowed = 1
+            self.buckets[keys[0]] = (tokens,now)
+            return allowed
+        return run_script
+
+
+class TokenBucketTests(TestCase):
+
+    def setUp(self):
+        self.time = payouts.time
+        payouts.time = self.clock = FakeClock()
+
+    def tearDown(self):
+        payouts.time = self.time
+
+    def test_consume(self):
+        bucket = TokenBucket("test",rate=1,capacity=2,connection=FakeRedis())
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.clock.now += 1
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_buckets_are_separate(self):
+        connection = FakeRedis()
+        TokenBucket("first",rate=1,capacity=1,connection=connection).consume()
+        self.assertFalse(TokenBucket("first",rate=1,capacity=1,connection=connection).consume())
+        self.assertTrue(TokenBucket("second",rate=1,capacity=1,connection=connection).consume())
+
+
+@override_settings(MTURK_BONUS_MAX_ATTEMPTS=3,MTURK_BONUS_RETRY_SECONDS=30)
+class BonusQueueTests(TestCase):
+
+    def setUp(self):
+        # Rows are bulk created, HIT.save would contact Amazon
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=1,bonus_active=True)
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(3)])
+        HIT.objects.bulk_create([HIT(battery=self.battery,owner=owner,mturk_id="HIT",title="hit",
+                                     description="hit",reward=1,assignment_duration_in_hours=1)])
+        hit = HIT.objects.get(mturk_id="HIT")
+        Assignment.objects.bulk_create([Assignment(mturk_id="ASSIGNMENT%s" %(i),worker_id="WORKER%s" %(i),hit=hit)
+                                        for i in range(3)])
+        due = timezone.now() - timedelta(minutes=1)
+        amounts = {"test_task":{"amount":1.0,"description":"test condition"}}
+        Bonus.objects.bulk_create([Bonus(worker_id="WORKER%s" %(i),battery=self.battery,amounts=amounts,
+                                         status=Bonus.PENDING,next_attempt_time=due + timedelta(seconds=i),
+                                         idempotency_key="KEY%s" %(i),
+                                         assignment=Assignment.objects.get(mturk_id="ASSIGNMENT%s" %(i)))
+                                   for i in range(3)])
+
+        self.sent = []
+        self.connection = FakeRedis()
+        self.originals = dict([(name,getattr(payouts,name)) for name in
+                               ["send_bonus","get_credentials","get_connection","get_bonus_bucket"]])
+        payouts.send_bonus = lambda connection,bonus: self.sent.append(bonus.idempotency_key)
+        payouts.get_credentials = lambda battery: ("key","secret")
+        payouts.get_connection = lambda aws_access_key_id,aws_secret_access_key,hit: None
+        payouts.get_bonus_bucket = lambda credentials: TokenBucket(credentials,rate=0.001,capacity=1,
+                                                                   connection=self.connection)
+
+    def tearDown(self):
+        for name,function in self.originals.items():
+            setattr(payouts,name,function)
+
+    def test_claim_bonus(self):
+        bonus = Bonus.objects.get(idempotency_key="KEY0")
+        stale = Bonus.objects.get(idempotency_key="KEY0")
+        self.assertTrue(claim_bonus(bonus,lease_seconds=300))
+        self.assertGreater(Bonus.objects.get(id=bonus.id).next_attempt_time,timezone.now() + timedelta(seconds=290))
+        # Another worker's copy no longer matches the leased row
+        self.assertFalse(claim_bonus(stale))
+
+    def test_record_bonus_failure(self):
+        bonus = Bonus.objects.get(idempotency_key="KEY0")
+        record_bonus_failure(bonus,"first")
+        bonus = Bonus.objects.get(id=bonus.id)
+        self.assertEqual(bonus.status,Bonus.PENDING)
+        self.assertEqual(bonus.last_error,"first")
+        delay = (bonus.next_attempt_time - timezone.now()).total_seconds()
+        self.assertTrue(25 < delay <= 30,delay)
+
+        record_bonus_failure(bonus,"second")
+        delay = (Bonus.objects.get(id=bonus.id).next_attempt_time - timezone.now()).total_seconds()
+        self.assertTrue(55 < delay <= 60,delay)
+
+        record_bonus_failure(bonus,"third")
+        bonus = Bonus.objects.get(id=bonus.id)
+        self.assertEqual(bonus.status,Bonus.FAILED)
+        self.assertEqual(bonus.attempts,3)
+        self.assertEqual(bonus.next_attempt_time,None)
+
+    def test_pay_bonuses_throttled(self):
+        # One token: the first bonus is paid, the others are left due
+        due_times = dict(Bonus.objects.values_list('idempotency_key','next_attempt_time'))
+        stats = pay_bonuses(batch_size=10)
+        self.assertEqual(stats["paid"],1)
+        self.assertEqual(stats["throttled"],2)
+        self.assertTrue(stats["more"])
+        self.assertEqual(self.sent,["KEY0"])
+        self.assertEqual(Bonus.objects.get(idempotency_key="KEY0").status,Bonus.PAID)
+        for key in ["KEY1","KEY2"]:
+            self.assertEqual(Bonus.objects.get(idempotency_key=key).next_attempt_time,due_times[key])
+
+    def test_pay_bonuses_leased(self):
+        # A bonus leased by another worker after it was listed doesn't use the token
+        due = list(payouts.get_due_bonuses(10))
+        claim_bonus(Bonus.objects.get(idempotency_key="KEY0"))
+        get_due_bonuses = payouts.get_due_bonuses
+        payouts.get_due_bonuses = lambda limit: due
+        try:
+            stats = pay_bonuses(batch_size=10)
+        finally:
+            payouts.get_due_bonuses = get_due_bonuses
+        self.assertEqual(stats["paid"],1)
+        self.assertEqual(self.sent,["KEY1"])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Query plan regression tests for the hot Result, Assignment, HIT and payout
+queries. Each query is EXPLAINed with sequential scans disabled on a seeded
+database, and the plan must use the index declared for it: another index
+(eg, the foreign key's) would also avoid a Seq Scan, so a dropped or
+mismatched index fails the test."""
+
+import unittest
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import TestCase
+from django.utils import timezone
+
+from expdj.apps.experiments.models import Battery, ExperimentTemplate
+from expdj.apps.turk.models import Assignment, Blacklist, Bonus, HIT, Result, Worker
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "EXPLAIN plans are checked on PostgreSQL")
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Rows are bulk created, HIT.save would contact Amazon
+        owner = User.objects.create(username="owner")
+        Battery.objects.bulk_create([Battery(name="battery_%s" %(i),credentials="credentials",owner=owner,
+                                             maximum_time=30,number_of_experiments=3) for i in range(5)])
+        ExperimentTemplate.objects.bulk_create([ExperimentTemplate(exp_id="task_%s" %(i),name="task_%s" %(i),
+                                                                   time=5,reference="") for i in range(10)])
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(100)])
+        batteries = list(Battery.objects.all())
+        HIT.objects.bulk_create([HIT(battery=batteries[i % 5],owner=owner,mturk_id="HIT%s" %(i),title="hit",
+                                     description="hit",reward=1,assignment_duration_in_hours=1)
+                                 for i in range(20)])
+        hits = list(HIT.objects.all())
+        statuses = [Assignment.SUBMITTED,Assignment.APPROVED,Assignment.REJECTED,None]
+        Assignment.objects.bulk_create([Assignment(mturk_id="ASSIGNMENT%s" %(i),worker_id="WORKER%s" %(i % 100),
+                                                   hit=hits[i % 20],status=statuses[i % 4])
+                                        for i in range(400)])
+        Result.objects.bulk_create([Result(worker_id="WORKER%s" %(i % 100),battery=batteries[i % 5],
+                                           experiment_id="task_%s" %(i % 10),completed=i % 3 == 0)
+                                    for i in range(1000)])
+        cls.battery = batteries[0]
+        cls.hit = hits[0]
+
+    def explain(self,queryset):
+        sql,params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN %s" %(sql),params)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+    def get_index_names(self,model,columns):
+        cursor = connection.cursor()
+        constraints = connection.introspection.get_constraints(cursor,model._meta.db_table)
+        return [name for name,constraint in constraints.items()
+                if constraint["index"] and list(constraint["columns"]) == columns]
+
+    def assertUsesIndex(self,queryset,model,columns):
+        '''assertUsesIndex checks that the plan of a query uses the index of the columns'''
+        index_names = self.get_index_names(model,columns)
+        self.assertTrue(len(index_names) > 0,"%s has no index on %s" %(model.__name__,columns))
+        plan = self.explain(queryset)
+        self.assertNotIn("Seq Scan",plan,plan)
+        self.assertTrue(any([name in plan for name in index_names]),plan)
+
+    def test_worker_battery_results(self):
+        # get_worker_experiments
+        results = Result.objects.filter(worker_id="WORKER1",battery=self.battery,completed=True)
+        self.assertUsesIndex(results.values_list('experiment_id',flat=True),Result,
+                             ["worker_id","battery_id","completed"])
+
+    def test_battery_experiment_results(self):
+        # get_battery_results, export_experiment
+        self.assertUsesIndex(Result.objects.filter(battery=self.battery,experiment__exp_id="task_0"),Result,
+                             ["battery_id","experiment_id"])
+
+    def test_battery_completed_results(self):
+        # rescore_battery_results
+        self.assertUsesIndex(Result.objects.filter(battery=self.battery,completed=True,id__gt=0).order_by('id'),Result,
+                             ["battery_id","completed"])
+
+    def test_hit_assignments_by_status(self):
+        # manage_hit
+        self.assertUsesIndex(Assignment.objects.filter(hit=self.hit,status=Assignment.SUBMITTED),Assignment,
+                             ["hit_id","status"])
+
+    def test_assignment_by_mturk_id(self):
+        # Assignment.update, serve_hit
+        self.assertUsesIndex(Assignment.objects.filter(mturk_id="ASSIGNMENT1"),Assignment,["mturk_id"])
+
+    def test_battery_hits(self):
+        # view_battery
+        self.assertUsesIndex(HIT.objects.filter(battery=self.battery),HIT,["battery_id"])
+
+    def test_battery_assignment_summary(self):
+        # get_assignment_summary
+        counts = Assignment.objects.filter(hit__battery=self.battery).values('status').annotate(count=Count('id'))
+        self.assertUsesIndex(counts,HIT,["battery_id"])
+
+    def test_due_bonuses(self):
+        # payouts.get_due_bonuses
+        due = Q(next_attempt_time__isnull=True) | Q(next_attempt_time__lte=timezone.now())
+        self.assertUsesIndex(Bonus.objects.filter(due,status=Bonus.PENDING).order_by('next_attempt_time'),Bonus,
+                             ["status","next_attempt_time"])
+
+    def test_active_blacklists(self):
+        # load_blacklist_cache
+        self.assertUsesIndex(Blacklist.objects.filter(battery=self.battery,active=True).values_list('worker_id',flat=True),
+                             Blacklist,["battery_id","active"])
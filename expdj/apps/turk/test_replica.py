@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Replica routing tests: reads inside use_replica go to a configured,
+healthy replica, and everything else to the primary."""
+
+from django.db import DatabaseError
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from expdj import db_router
+from expdj.db_router import REPLICA, ReplicaReadMixin, ReplicaRouter, read_from_replica, use_replica
+from expdj.apps.turk.models import Result
+
+
+class FakeCursor(object):
+
+    def __init__(self,lag):
+        self.lag = lag
+
+    def execute(self,sql):
+        if isinstance(self.lag,Exception):
+            raise self.lag
+
+    def fetchone(self):
+        return [self.lag]
+
+
+class FakeConnection(object):
+
+    def __init__(self,lag):
+        self.lag = lag
+        self.checks = 0
+
+    def cursor(self):
+        self.checks += 1
+        return FakeCursor(self.lag)
+
+
+class View(object):
+
+    def dispatch(self,request,*args,**kwargs):
+        return ReplicaRouter().db_for_read(Result)
+
+
+class ReplicaView(ReplicaReadMixin,View):
+    pass
+
+
+class Request(object):
+
+    def __init__(self,method):
+        self.method = method
+
+
+@override_settings(REPLICA_MAX_LAG_SECONDS=30,REPLICA_LAG_CHECK_SECONDS=10)
+class ReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.originals = dict([(name,getattr(db_router,name)) for name in
+                               ["replica_configured","connections","time"]])
+        self.lag = dict(db_router._lag)
+        self.configured = True
+        self.connection = FakeConnection(0)
+        self.now = 1000.0
+        db_router.replica_configured = lambda: self.configured
+        db_router.connections = {REPLICA:self.connection}
+        db_router.time = type("Clock",(object,),{"time":staticmethod(lambda: self.now)})
+        db_router._lag.update({"checked":0.0,"healthy":False})
+        self.router = ReplicaRouter()
+
+    def tearDown(self):
+        for name,value in self.originals.items():
+            setattr(db_router,name,value)
+        db_router._lag.update(self.lag)
+
+    def test_reads_outside_block(self):
+        self.assertEqual(self.router.db_for_read(Result),"default")
+
+    def test_reads_in_block(self):
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Result),REPLICA)
+            self.assertEqual(self.router.db_for_write(Result),"default")
+        self.assertEqual(self.router.db_for_read(Result),"default")
+
+    def test_nested_blocks(self):
+        with use_replica():
+            with use_replica():
+                pass
+            self.assertEqual(self.router.db_for_read(Result),REPLICA)
+
+    def test_not_configured(self):
+        self.configured = False
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Result),"default")
+        self.assertEqual(self.connection.checks,0)
+
+    def test_lagging(self):
+        self.connection.lag = 60
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Result),"default")
+
+    def test_unreachable(self):
+        self.connection.lag = DatabaseError("could not connect")
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Result),"default")
+
+    def test_lag_checked_every_interval(self):
+        with use_replica():
+            self.router.db_for_read(Result)
+            self.connection.lag = 60
+            self.assertEqual(self.router.db_for_read(Result),REPLICA)
+            self.assertEqual(self.connection.checks,1)
+            self.now += 11
+            self.assertEqual(self.router.db_for_read(Result),"default")
+            self.assertEqual(self.connection.checks,2)
+
+    def test_view_decorator(self):
+        view = read_from_replica(lambda request: self.router.db_for_read(Result))
+        self.assertEqual(view(None),REPLICA)
+        self.assertEqual(self.router.db_for_read(Result),"default")
+
+    def test_view_mixin(self):
+        self.assertEqual(ReplicaView().dispatch(Request("GET")),REPLICA)
+        self.assertEqual(ReplicaView().dispatch(Request("POST")),"default")
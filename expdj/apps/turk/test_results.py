@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Result serving tests: serving an experiment again updates the worker's
+result instead of creating another one."""
+
+import time
+import unittest
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+
+from expdj.apps.experiments.models import Battery, ExperimentTemplate
+from expdj.apps.turk.models import Assignment, HIT, Result, Worker, upsert_result
+
+
+class UpsertResultTests(TestCase):
+
+    def setUp(self):
+        # Rows are bulk created, HIT.save would contact Amazon
+        owner = User.objects.create(username="owner")
+        self.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                              maximum_time=30,number_of_experiments=1)
+        ExperimentTemplate.objects.bulk_create([ExperimentTemplate(exp_id="test_task",name="test task",
+                                                                   time=5,reference="")])
+        Worker.objects.bulk_create([Worker(id="WORKER")])
+        self.worker = Worker.objects.get(id="WORKER")
+        HIT.objects.bulk_create([HIT(battery=self.battery,owner=owner,mturk_id="HIT",title="hit",
+                                     description="hit",reward=1,assignment_duration_in_hours=1)])
+        Assignment.objects.bulk_create([Assignment(mturk_id="ASSIGNMENT",worker=self.worker,
+                                                   hit=HIT.objects.get(mturk_id="HIT"))])
+        self.assignment = Assignment.objects.get(mturk_id="ASSIGNMENT")
+
+    def serve(self,assignment,browser):
+        return upsert_result(worker=self.worker,experiment_id="test_task",battery_id=self.battery.id,
+                             assignment=assignment,defaults={"browser":browser,"platform":"Linux"})
+
+    def check_repeated_serve(self,assignment):
+        first = self.serve(assignment,"Firefox")
+        time.sleep(0.01)
+        second = self.serve(assignment,"Chrome")
+        self.assertEqual(first.id,second.id)
+        results = Result.objects.filter(worker=self.worker,battery=self.battery,assignment=assignment)
+        self.assertEqual(results.count(),1)
+        result = results.get()
+        self.assertGreater(result.serve_time,first.serve_time)
+        self.assertEqual(result.browser,"Chrome")
+        self.assertEqual(result.completed,False)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "ON CONFLICT is on PostgreSQL")
+    def test_repeated_assignment_serve(self):
+        self.check_repeated_serve(self.assignment)
+
+    def test_repeated_local_serve(self):
+        self.check_repeated_serve(None)
+
+    def test_assignment_serve_keeps_taskdata(self):
+        result = self.serve(self.assignment,"Firefox")
+        Result.objects.filter(id=result.id).update(taskdata=[{"trial_index":0}],current_trial=1)
+        self.serve(self.assignment,"Firefox")
+        result = Result.objects.get(id=result.id)
+        self.assertEqual(list(result.taskdata),[{"trial_index":0}])
+        self.assertEqual(result.current_trial,1)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Scoring tests: rescoring a battery rewrites its existing Bonus and
+Blacklist rows with bulk updates of their jsonb columns, and a violation adds
+a flag to a Blacklist in one UPDATE."""
+
+import unittest
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+
+from expdj.apps.experiments.models import Battery, Experiment, ExperimentTemplate
+from expdj.apps.turk.models import Blacklist, Bonus, Result, Worker
+from expdj.apps.turk.tasks import add_blacklist, rescore_battery
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "jsonb columns are on PostgreSQL")
+class RescoreBatteryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="owner")
+        cls.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                             maximum_time=30,number_of_experiments=1,
+                                             bonus_active=True,blacklist_active=True)
+        template = ExperimentTemplate.objects.create(exp_id="test_task",name="test task",time=5,
+                                                     reference="",template="jspsych")
+        cls.experiment = Experiment.objects.create(template=template)
+        cls.battery.experiments.add(cls.experiment)
+        Worker.objects.bulk_create([Worker(id="WORKER%s" %(i)) for i in range(3)])
+        Result.objects.bulk_create([Result(worker_id="WORKER%s" %(i),battery=cls.battery,
+                                           experiment_id="test_task",completed=True) for i in range(3)])
+
+        # Entries scored before the experiment's credit conditions were removed
+        record = {"experiment_id":cls.experiment.id,"description":"old condition"}
+        amount = dict(record,amount=1.0)
+        Bonus.objects.bulk_create([Bonus(worker_id="WORKER%s" %(i),battery=cls.battery,
+                                         amounts={"test_task":amount,"other_task":amount}) for i in range(3)])
+        Blacklist.objects.bulk_create([Blacklist(worker_id="WORKER%s" %(i),battery=cls.battery,
+                                                 flags={"test_task":record},flag_count=1) for i in range(3)])
+
+    def test_rescore_updates_existing_rows(self):
+        stats = rescore_battery(self.battery.id)
+        self.assertEqual(stats["results"],3)
+        self.assertEqual(stats["bonuses"],0)
+        self.assertEqual(stats["violations"],0)
+        for bonus in Bonus.objects.filter(battery=self.battery):
+            self.assertEqual(list(bonus.amounts.keys()),["other_task"])
+        for blacklist in Blacklist.objects.filter(battery=self.battery):
+            self.assertEqual(dict(blacklist.flags),{})
+            self.assertEqual(blacklist.flag_count,0)
+            self.assertFalse(blacklist.active)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "jsonb columns are on PostgreSQL")
+class AddBlacklistTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="owner")
+        cls.battery = Battery.objects.create(name="battery",credentials="credentials",owner=owner,
+                                             maximum_time=30,number_of_experiments=3,
+                                             blacklist_active=True,blacklist_threshold=2)
+        cls.experiments = []
+        for i in range(3):
+            template = ExperimentTemplate.objects.create(exp_id="task_%s" %(i),name="task %s" %(i),time=5,
+                                                         reference="",template="jspsych")
+            cls.experiments.append(Experiment.objects.create(template=template))
+        Worker.objects.create(id="WORKER")
+        Blacklist.objects.create(worker_id="WORKER",battery=cls.battery,flag_count=1,
+                                 flags={"task_0":{"experiment_id":cls.experiments[0].id,"description":"first"}})
+
+    def test_concurrent_flags_counted(self):
+        # Two copies read before either violation is written
+        first = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        second = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        add_blacklist(first,self.experiments[1],"second")
+        add_blacklist(second,self.experiments[2],"third")
+        blacklist = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        self.assertEqual(sorted(blacklist.flags.keys()),["task_0","task_1","task_2"])
+        self.assertEqual(blacklist.flag_count,3)
+        self.assertTrue(blacklist.active)
+        self.assertNotEqual(blacklist.blacklist_time,None)
+
+    def test_repeat_flag_not_counted(self):
+        blacklist = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        add_blacklist(blacklist,self.experiments[1],"second")
+        stale = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        stale.flags = {}
+        add_blacklist(stale,self.experiments[1],"again")
+        blacklist = Blacklist.objects.get(worker_id="WORKER",battery=self.battery)
+        self.assertEqual(blacklist.flag_count,2)
+        self.assertEqual(blacklist.flags["task_1"]["description"],"second")
+        self.assertFalse(blacklist.active)
@@ -10,7 +10,7 @@ from expdj.apps.experiments.views import sync
 from expdj.apps.turk.views import (
     edit_hit, delete_hit, expire_hit, preview_hit, serve_hit, multiple_new_hit,
     end_assignment, finished_view, not_consent_view, survey_submit, manage_hit,
-    clone_hit, hit_detail
+    clone_hit, hit_detail, bonus_status
 )
 from expdj.apps.turk.api_views import BatteryResultAPIList
 
@@ -46,6 +46,13 @@ urlpatterns = patterns('',
     url(r'^hits/(?P<hid>\d+|[A-Z]{8})/delete$',delete_hit,name='delete_hit'),
     url(r'^hits/(?P<hid>\d+|[A-Z]{8})/expire$',expire_hit,name='expire_hit'),
 
+    # Bonuses
+    url(
+        r'^batteries/(?P<bid>\d+|[A-Z]{8})/bonuses$',
+        bonus_status,
+        name='bonus_status'
+    ),
+
     # Turk Deployments
     url(r'^accept/(?P<hid>\d+|[A-Z]{8})',serve_hit,name='serve_hit'),
     url(r'^turk/(?P<hid>\d+|[A-Z]{8})',preview_hit,name='preview_hit'),
@@ -7,8 +7,12 @@ from boto.mturk.connection import MTurkConnection
 from boto.mturk.price import Price
 from boto.mturk.question import ExternalQuestion
 import pandas
+import redis
 
 from django.conf import settings
+from django.db import connection
+from django.db.models import Case, Value, When
+from django.db.models.expressions import RawSQL
 
 from expdj.apps.experiments.models import Experiment
 from expdj.settings import BASE_DIR, MTURK_ALLOW
@@ -23,6 +27,47 @@ def to_dict(input_ordered_dict):
     return json.loads(json.dumps(input_ordered_dict))
 
 
+def parse_json_value(value):
+    '''parse_json_value reads a query string value as json (eg, 400, true),
+    falling back to the string itself
+    :param value: the string value
+    '''
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def filter_taskdata(results,variable,value):
+    '''filter_taskdata filters a Result queryset down to results with a trial
+    where the trialdata variable has the value. This is a jsonb containment
+    query, served by the GIN index on taskdata.
+    :param results: a turk.models.Result queryset
+    :param variable: the trialdata variable name
+    :param value: the value, eg 400, True or "correct"
+    '''
+    trialdata = {variable:value}
+    documents = [json.dumps([{"trialdata":trialdata}]),
+                 json.dumps([{"trialdata":[trialdata]}])]
+    table = results.model._meta.db_table
+    where = '("%s"."taskdata" @> %%s::jsonb OR "%s"."taskdata" @> %%s::jsonb)' %(table,table)
+    return results.extra(where=[where],params=documents)
+
+
+def taskdata_has_value(taskdata,variable,value):
+    '''taskdata_has_value is filter_taskdata for one result's taskdata in memory
+    (eg, an archived result)
+    '''
+    for trial in taskdata or []:
+        trialdata = trial.get("trialdata") if isinstance(trial,dict) else None
+        if not isinstance(trialdata,list):
+            trialdata = [trialdata]
+        for data in trialdata:
+            if isinstance(data,dict) and variable in data and data[variable] == value:
+                return True
+    return False
+
+
 PRODUCTION_HOST = u'mechanicalturk.amazonaws.com'
 SANDBOX_HOST = u'mechanicalturk.sandbox.amazonaws.com'
 
@@ -105,6 +150,19 @@ def get_connection(aws_access_key_id,aws_secret_access_key,hit=None):
         debug=debug)
 
 
+_redis_connection = None
+
+def get_redis_connection():
+    '''get_redis_connection returns a client for the redis database in
+    settings.REDIS_URL, shared by the uwsgi processes and celery workers. The
+    client (and its connection pool) is made once per process.
+    '''
+    global _redis_connection
+    if _redis_connection == None:
+        _redis_connection = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _redis_connection
+
+
 def get_app_url():
     if hasattr(settings, 'TURK') and settings.TURK is not None:
         if "app_url" in settings.TURK:
@@ -117,9 +175,9 @@ def get_worker_experiments(worker,battery,completed=False):
     :param completed: boolean, default False to return uncompleted experiments
     '''
     from expdj.apps.turk.models import Result
-    battery_tags = [x.template.exp_id for x in battery.experiments.all()]
-    worker_experiments = Result.objects.filter(worker=worker,battery=battery)
-    worker_tags = [x.experiment.exp_id for x in worker_experiments if x.completed==True]
+    battery_tags = list(battery.experiments.values_list('template_id',flat=True))
+    worker_tags = set(Result.objects.filter(worker=worker,battery=battery,completed=True)
+                                    .values_list('experiment_id',flat=True))
 
     if completed==False:
         experiment_selection = [e for e in battery_tags if e not in worker_tags]
@@ -129,6 +187,20 @@ def get_worker_experiments(worker,battery,completed=False):
                                      battery_experiments__id=battery.id)
 
 
+def get_snapshot_experiments(worker,snapshot,completed=False):
+    '''get_snapshot_experiments is get_worker_experiments for a battery snapshot
+    (see experiments/snapshot.py), with a single query for the worker's results
+    :param snapshot: the BatterySnapshot of the battery
+    :param completed: boolean, default False to return uncompleted experiments
+    '''
+    from expdj.apps.turk.models import Result
+    worker_tags = set(Result.objects.filter(worker=worker,battery_id=snapshot.id,completed=True)
+                                    .values_list('experiment_id',flat=True))
+    if completed==False:
+        return snapshot.get_experiments(exclude=worker_tags)
+    return snapshot.get_experiments(exp_ids=worker_tags)
+
+
 def get_time_difference(d1,d2,format='%Y-%m-%d %H:%M:%S'):
     '''calculate difference between two time strings, t1 and t2, returns minutes'''
     if isinstance(d1,str):
@@ -138,4 +210,23 @@ def get_time_difference(d1,d2,format='%Y-%m-%d %H:%M:%S'):
     return (d2 - d1).total_seconds() / 60
 
 
-
+def bulk_update(objects,fields):
+    '''bulk_update writes the given fields of many saved model instances with
+    a single UPDATE ... CASE statement per call
+    :param objects: list of model instances of the same model, with a pk
+    :param fields: list of field names to update
+    '''
+    if len(objects) == 0:
+        return 0
+    model = objects[0].__class__
+    updates = dict()
+    for field_name in fields:
+        field = model._meta.get_field(field_name)
+        if field.db_type(connection) == 'jsonb':
+            # A CASE of untyped literals is text, which can't be assigned to jsonb
+            whens = [When(pk=obj.pk,then=RawSQL("%s::jsonb",[field.get_db_prep_save(getattr(obj,field_name),connection)],
+                                                output_field=field)) for obj in objects]
+        else:
+            whens = [When(pk=obj.pk,then=Value(getattr(obj,field_name),output_field=field)) for obj in objects]
+        updates[field_name] = Case(*whens,output_field=field)
+    return model.objects.filter(pk__in=[obj.pk for obj in objects]).update(**updates)
@@ -18,14 +18,16 @@ from django.views.decorators.csrf import ensure_csrf_cookie
 
 from expdj.apps.experiments.models import (Battery, ExperimentTemplate)
 from expdj.apps.experiments.views import (check_battery_edit_permission, 
-    check_mturk_access, get_battery_intro, deploy_battery)
-from expdj.apps.experiments.utils import get_experiment_type, select_experiments
+    check_mturk_access, get_battery_intro, deploy_battery, get_battery)
+from expdj.apps.experiments.snapshot import get_battery_snapshot
+from expdj.apps.experiments.utils import get_experiment_type, get_next_experiments, select_experiments
 from expdj.apps.turk.forms import HITForm, WorkerContactForm
-from expdj.apps.turk.models import Worker, HIT, Assignment, Result, get_worker
+from expdj.apps.turk.models import (Worker, HIT, Assignment, Result, Bonus, get_worker,
+    upsert_result)
 from expdj.apps.turk.tasks import (assign_experiment_credit,
     get_unique_experiments, check_battery_dependencies)
 from expdj.apps.turk.utils import (get_connection, get_credentials, get_host,
-    get_worker_url, get_worker_experiments)
+    get_worker_url, get_worker_experiments, get_snapshot_experiments)
 from expdj.settings import BASE_DIR,STATIC_ROOT,MEDIA_ROOT
 
 media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
@@ -125,7 +127,9 @@ def serve_hit(request,hid):
         if hit.status in ["D"]:
             return render_to_response("turk/hit_expired.html")
 
-        battery = hit.battery
+        battery = get_battery_snapshot(hit.battery_id)
+        if battery == None:
+            raise Http404
         aws = get_amazon_variables(request)
 
         if "" in [aws["worker_id"],aws["hit_id"]]:
@@ -162,7 +166,7 @@ def serve_hit(request,hid):
             assignment.save()
 
         # Does the worker have experiments remaining for the hit?
-        uncompleted_experiments = get_worker_experiments(worker,hit.battery)
+        uncompleted_experiments = get_snapshot_experiments(worker,battery)
         experiments_left = len(uncompleted_experiments)  
         if experiments_left == 0:
             # Thank you for your participation - no more experiments!
@@ -174,18 +178,16 @@ def serve_hit(request,hid):
             last_experiment = True
 
         task_list = select_experiments(battery,uncompleted_experiments)
-        experimentTemplate = ExperimentTemplate.objects.filter(exp_id=task_list[0].template.exp_id)[0]
-        experiment_type = get_experiment_type(experimentTemplate)
-        task_list = battery.experiments.filter(template=experimentTemplate)
+        experiment_type = task_list[0].experiment_type
+        task_list = battery.get_experiments(exp_ids=[task_list[0].exp_id])
         template = "%s/mturk_battery.html" %(experiment_type)
 
         # Generate a new results object for the worker, assignment, experiment
-        result,_ = Result.objects.update_or_create(worker=worker,
-                                                   experiment=experimentTemplate,
-                                                   assignment=assignment, # assignment has record of HIT
-                                                   battery=hit.battery,
-                                                   defaults={"browser":browser,"platform":platform})
-        result.save()
+        result = upsert_result(worker=worker,
+                               experiment_id=task_list[0].exp_id,
+                               assignment=assignment, # assignment has record of HIT
+                               battery_id=battery.id,
+                               defaults={"browser":browser,"platform":platform})
 
         # Add variables to the context
         aws["amazon_host"] = host
@@ -205,7 +207,8 @@ def serve_hit(request,hid):
             next_page=None,
             result=result,
             last_experiment=last_experiment,
-            experiments_left=experiments_left-1
+            experiments_left=experiments_left-1,
+            next_experiments=get_next_experiments(battery,uncompleted_experiments,task_list)
         )
 
     else:
@@ -221,10 +224,12 @@ def preview_hit(request,hid):
     if request.user_agent.is_pc:
 
         hit =  get_hit(hid,request)
-        battery = hit.battery
+        battery = get_battery_snapshot(hit.battery_id)
+        if battery == None:
+            raise Http404
         context = get_amazon_variables(request)
 
-        context["instruction_forms"] = get_battery_intro(battery)
+        context["instruction_forms"] = battery.intro
         context["hit_uid"] = hid
         context["start_url"] = "/accept/%s/?assignmentId=%s&workerId=%s&turkSubmitTo=%s&hitId=%s" %(hid,
                                                                                                     context["assignment_id"],
@@ -279,7 +284,7 @@ def multiple_new_hit(request, bid):
 
     if mturk_permission == True:
         battery = Battery.objects.get(pk=bid)
-        if not request.user.has_perm('battery.edit_battery', battery):
+        if not check_battery_edit_permission(request,battery):
             return HttpResponseForbidden()
 
         is_owner = battery.owner == request.user
@@ -334,7 +339,7 @@ def edit_hit(request, bid, hid=None):
     if mturk_permission == True:
         battery = Battery.objects.get(pk=bid)
         header_text = "%s HIT" %(battery.name)
-        if not request.user.has_perm('battery.edit_battery', battery):
+        if not check_battery_edit_permission(request,battery):
             return HttpResponseForbidden()
 
         if hid:
@@ -438,6 +443,24 @@ def delete_hit(request, hid):
     else:
         return HttpResponseForbidden()
 
+# Bonus payout queue status
+@login_required
+def bonus_status(request, bid):
+    '''bonus_status shows the payout queue for a battery: bonuses waiting to be
+    paid, paid, and failed after all retries
+    :param bid: the battery id
+    '''
+    battery = get_battery(bid,request)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+
+    bonuses = Bonus.objects.filter(battery=battery).select_related('worker','assignment')
+    context = {"battery":battery,
+               "bonuses_pending":bonuses.filter(status=Bonus.PENDING).order_by('next_attempt_time'),
+               "bonuses_paid":bonuses.filter(status=Bonus.PAID).order_by('-paid_time'),
+               "bonuses_failed":bonuses.filter(status=Bonus.FAILED).order_by('-id')}
+    return render(request, "turk/bonus_status.html", context)
+
 @login_required
 def hit_detail(request, hid):
     hit = get_object_or_404(HIT, pk=hid)
@@ -457,7 +480,13 @@ def get_flagged_questions(number=None):
     return choice(questions,int(number))
 
 def check_battery_view(battery, worker_id):
-    missing_batteries, blocking_batteries = check_battery_dependencies(battery, worker_id)
+    '''check_battery_view returns a response if the worker has not met the
+    battery dependencies, and None otherwise
+    :param battery: the BatterySnapshot of the battery
+    '''
+    if not battery.has_dependencies():
+        return None
+    missing_batteries, blocking_batteries = check_battery_dependencies(Battery.objects.get(id=battery.id), worker_id)
     if missing_batteries or blocking_batteries:
         return render_to_response(
             "turk/battery_requirements_not_met.html",
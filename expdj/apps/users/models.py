@@ -1,8 +1,11 @@
 from django.contrib.auth.models import User as djUser
 from django.db.models import Q, DO_NOTHING
+from django.db.models.signals import post_delete, post_save
 from django.db import models
 from jsonfield import JSONField
 
+from expdj.apps.experiments.cache import USER_PERMISSIONS_CACHE, bump_cache_version
+
 class User(models.Model):
 
     def __str__(self):
@@ -18,3 +21,10 @@ class User(models.Model):
     )
     user = models.OneToOneField(djUser, on_delete=models.CASCADE)
     role = models.CharField("user role",max_length=100,choices=ROLE_CHOICES,null=True,blank=True,help_text="Name of user role.")
+
+
+def role_changed(sender, instance, **kwargs):
+    bump_cache_version(USER_PERMISSIONS_CACHE,instance.user_id)
+
+post_save.connect(role_changed, sender=User)
+post_delete.connect(role_changed, sender=User)
@@ -0,0 +1,106 @@
+'''db_router.py: send read-only analysis traffic to a replica
+
+Dashboards, exports and the results API read through the "replica" database
+(when one is configured) inside use_replica() or a read_from_replica view, so
+large reads stay off the primary that handles participant syncs. Everything
+else, and all writes, go to the primary. If the replica lags the primary by
+more than REPLICA_MAX_LAG_SECONDS, or can't be reached, reads fall back to the
+primary.
+'''
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+
+REPLICA = "replica"
+
+_state = threading.local()
+_lag = {"checked":0.0,"healthy":False}
+
+
+# Replication lag in seconds, zero when the replica has replayed everything it received
+LAG_SQL = '''
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+'''
+
+
+def replica_configured():
+    return REPLICA in settings.DATABASES
+
+
+def replica_is_healthy():
+    '''replica_is_healthy checks the replication lag at most every
+    REPLICA_LAG_CHECK_SECONDS (per process), and returns True if it is under
+    REPLICA_MAX_LAG_SECONDS
+    '''
+    now = time.time()
+    if now - _lag["checked"] < getattr(settings,"REPLICA_LAG_CHECK_SECONDS",10):
+        return _lag["healthy"]
+    _lag["checked"] = now
+    try:
+        cursor = connections[REPLICA].cursor()
+        cursor.execute(LAG_SQL)
+        lag = cursor.fetchone()[0]
+        _lag["healthy"] = lag != None and float(lag) <= getattr(settings,"REPLICA_MAX_LAG_SECONDS",30)
+    except DatabaseError:
+        _lag["healthy"] = False
+    return _lag["healthy"]
+
+
+@contextmanager
+def use_replica():
+    '''use_replica sends reads made inside the block to the replica'''
+    previous = getattr(_state,"replica",False)
+    _state.replica = True
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def read_from_replica(view):
+    '''read_from_replica is a view decorator, so the reads of a view go to the replica'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaReadMixin(object):
+    '''ReplicaReadMixin sends the reads of GET/HEAD/OPTIONS requests to a class
+    based view (eg, a REST framework view set) to the replica
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in ["GET","HEAD","OPTIONS"]:
+            with use_replica():
+                return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+        return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+
+
+class ReplicaRouter(object):
+    '''ReplicaRouter reads from the replica inside use_replica, when it is
+    configured and not lagging, and from the primary otherwise
+    '''
+
+    def db_for_read(self, model, **hints):
+        if getattr(_state,"replica",False) and replica_configured() and replica_is_healthy():
+            return REPLICA
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        return db == "default"
@@ -47,6 +47,21 @@ DATABASES = {
     }
 }
 
+# Dashboards, exports and the results API read from a 'replica' database, if
+# one is added to DATABASES (eg, in local_settings), while it lags the primary
+# by no more than REPLICA_MAX_LAG_SECONDS. See expdj/db_router.py
+#DATABASES['replica'] = {
+#    'ENGINE': 'django.db.backends.postgresql_psycopg2',
+#    'NAME': 'postgres',
+#    'USER': 'postgres',
+#    'HOST': 'db-replica',
+#    'PORT': '5432',
+#    'TEST': {'MIRROR': 'default'},
+#}
+DATABASE_ROUTERS = ['expdj.db_router.ReplicaRouter']
+REPLICA_MAX_LAG_SECONDS = 30
+REPLICA_LAG_CHECK_SECONDS = 10
+
 # Application definition
 
 INSTALLED_APPS = (
@@ -172,9 +187,19 @@ SENDFILE_BACKEND = 'sendfile.backends.development'
 PRIVATE_MEDIA_REDIRECT_HEADER = 'X-Accel-Redirect'
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
+# Shared by the uwsgi processes and celery workers, see experiments/cache.py for
+# the versioned keys of battery and experiment data. A redis outage reads as a miss.
 CACHES = {
             'default': {
-                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'BACKEND': 'django_redis.cache.RedisCache',
+                'LOCATION': 'redis://redis:6379/2',
+                'KEY_PREFIX': 'expdj',
+                'OPTIONS': {
+                    'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                    'SOCKET_CONNECT_TIMEOUT': 1,
+                    'SOCKET_TIMEOUT': 1,
+                    'IGNORE_EXCEPTIONS': True,
+                }
             }
 }
 
@@ -182,6 +207,9 @@ CACHES = {
 MANDRILL_API_KEY = "z2O_vfFUJB4L2yeF4Be9Tg" # this is a test key replace with a different one in production
 EMAIL_BACKEND = "djrill.mail.backends.djrill.DjrillBackend"
 
+# Redis, for state shared between uwsgi processes and celery workers
+REDIS_URL = 'redis://redis:6379/1'
+
 # Celery config
 BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
@@ -195,15 +223,65 @@ CELERY_QUEUES = (
 CELERY_IMPORTS = ('expdj.apps.turk.tasks', )
 
 # here is how to run a task regularly
-#CELERYBEAT_SCHEDULE = {
-#    'task name': {
-#        'task': 'task_name',
-#        'schedule': timedelta(days=1)
-#    },
-#}
+CELERYBEAT_SCHEDULE = {
+    'process-bonus-payouts': {
+        'task': 'expdj.apps.turk.tasks.process_bonus_payouts',
+        'schedule': timedelta(minutes=1)
+    },
+    'collect-abandoned-results': {
+        'task': 'expdj.apps.turk.tasks.collect_abandoned_results',
+        'schedule': timedelta(days=1)
+    },
+}
 
 CELERY_TIMEZONE = 'Europe/Berlin'
 
+# Bonus payouts: MTurk GrantBonus calls per second (and burst) for each credentials file
+MTURK_BONUS_RATE = 2.0
+MTURK_BONUS_BURST = 5
+MTURK_BONUS_BATCH_SIZE = 50
+MTURK_BONUS_MAX_ATTEMPTS = 8
+MTURK_BONUS_RETRY_SECONDS = 30 # doubled on each failed attempt
+
+# Result archives: completed results of inactive batteries, moved out of the
+# results table by the archive_results command. Files are kept under
+# RESULT_ARCHIVE_ROOT, or in an S3 compatible store if RESULT_ARCHIVE_S3 is set, eg
+# {"host":"minio","port":9000,"is_secure":False,"bucket":"expfactory-results",
+#  "access_key":"...","secret_key":"..."}
+RESULT_ARCHIVE_ROOT = os.path.join(BASE_DIR,"archive")
+RESULT_ARCHIVE_S3 = None
+
+# Incomplete results are abandoned once their assignment deadline passes, or
+# (without one) this long after the experiment was last served. They are
+# deleted daily, or archived if RESULT_GC_ARCHIVE
+RESULT_ABANDONED_HOURS = 48
+RESULT_GC_ARCHIVE = False
+
+# Local bare mirrors of the expfactory repositories (experiments, surveys, games),
+# fetched at most every EXPFACTORY_MIRROR_FETCH_SECONDS, and a fetch is killed after
+# EXPFACTORY_MIRROR_FETCH_TIMEOUT seconds. See experiments/mirror.py
+EXPFACTORY_REPOSITORY_URL = "https://github.com/expfactory/expfactory-%s.git"
+EXPFACTORY_MIRROR_ROOT = os.path.join(BASE_DIR,"mirror")
+EXPFACTORY_MIRROR_FETCH_SECONDS = 5 * 60
+EXPFACTORY_MIRROR_FETCH_TIMEOUT = 60
+
+# Threads copying changed experiment folders when installing experiments
+EXPERIMENT_INSTALL_THREADS = 4
+
+# Served experiments send Link headers preloading their assets and prefetching
+# those of the next experiment. With EXPERIMENT_PREFETCH_HINTS the page also has
+# prefetch links, for browsers that ignore the header
+EXPERIMENT_PREFETCH_HINTS = True
+
+# Installed versions of each experiment to keep, including the current one
+# (pages being served may still load the previous). See experiments/versions.py
+EXPERIMENT_VERSIONS_KEPT = 2
+
+# The local snapshot of Cognitive Atlas tasks and concepts is refreshed from the
+# API, on COGNITIVE_ATLAS_THREADS threads, when older than COGNITIVE_ATLAS_TTL_DAYS
+COGNITIVE_ATLAS_TTL_DAYS = 30
+COGNITIVE_ATLAS_THREADS = 8
+
 # REST FRAMEWORK
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
@@ -12,6 +12,7 @@ from expdj.apps.main import urls as main_urls
 from expdj.apps.turk import urls as turk_urls
 from django.conf.urls.static import static
 from expdj.apps.turk.utils import to_dict
+from expdj.db_router import ReplicaReadMixin
 from django.conf import settings
 from django.contrib import admin
 import os
@@ -20,7 +21,8 @@ import os
 from django.conf.urls import ( handler404, handler500 )
 
 # Sitemaps
-from expdj.api.sitemap import ExperimentTemplateSitemap, SurveyTemplateSitemap, GameTemplateSitemap
+from expdj.api.sitemap import (ExperimentTemplateSitemap, SurveyTemplateSitemap, GameTemplateSitemap,
+    cached_sitemap_view)
 sitemaps = {"experiments":ExperimentTemplateSitemap,
             "surveys":SurveyTemplateSitemap,
             "games":GameTemplateSitemap}
@@ -66,7 +68,7 @@ class ResultSerializer(serializers.HyperlinkedModelSerializer):
 
 
 # ViewSets define the view behavior.
-class ResultViewSet(viewsets.ModelViewSet):
+class ResultViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Result.objects.all()
     serializer_class = ResultSerializer
 
@@ -81,8 +83,10 @@ urlpatterns = [ url(r'^', include(main_urls)),
                 url(r'^', include(experiment_urls)),
                 url(r'^accounts/', include(users_urls)),
                 url(r'^', include(router.urls)),
-                url(r'^sitemap\.xml$', index, {'sitemaps': sitemaps}),
-                url(r'^sitemap-(?P<section>.+)\.xml$', sitemap, {'sitemaps': sitemaps}),
+                url(r'^sitemap\.xml$', cached_sitemap_view(index), {'sitemaps': sitemaps,
+                                                                     'sitemap_url_name': 'sitemap_section'}),
+                url(r'^sitemap-(?P<section>.+)\.xml$', cached_sitemap_view(sitemap), {'sitemaps': sitemaps},
+                    name='sitemap_section'),
                 url(r'^api/', include('rest_framework.urls', namespace='rest_framework')),
                 url(r'^admin/', include(admin.site.urls))
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -3,7 +3,12 @@ python manage.py makemigrations experiments
 python manage.py makemigrations turk
 python manage.py makemigrations main
 python manage.py migrate auth
+# convert json text columns to jsonb in batches, before migrate changes their type
+python manage.py convert_jsonb
 python manage.py migrate
+python manage.py convert_jsonb
+# partition results by battery, and give new batteries their partitions
+python manage.py partition_results
 python manage.py collectstatic --noinput
 mkdir /var/www/.well-known               
 mkdir /var/www/.well-known/acme-challenge